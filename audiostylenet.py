@@ -1,40 +1,15 @@
 import argparse
-import contextlib
 import numpy as np
 import os
-import shutil
-import tempfile
 import torch
-import torch.nn.functional as F
 
-from glob import glob
 from my_models import models
 from my_models.style_gan_2 import PretrainedGenerator1024
-from subprocess import Popen, PIPE
 from torchvision.utils import make_grid
-from utils import utils
+from utils import feature_cache, profiling, utils
 
-
-@contextlib.contextmanager
-def cd(newdir, cleanup=lambda: True):
-    prevdir = os.getcwd()
-    os.chdir(os.path.expanduser(newdir))
-    try:
-        yield
-    finally:
-        os.chdir(prevdir)
-        cleanup()
-
-
-@contextlib.contextmanager
-def tempdir():
-    dirpath = tempfile.mkdtemp()
-
-    def cleanup():
-        shutil.rmtree(dirpath)
-
-    with cd(dirpath, cleanup):
-        yield dirpath
+# Generator block resolutions the 256 x 256 frames can be taken from
+RENDER_SIZES = [256, 512, 1024]
 
 
 class AudioStyleNet:
@@ -42,10 +17,12 @@ class AudioStyleNet:
                  model_path,
                  device,
                  audio_type='deepspeech',
-                 T=8):
+                 T=8,
+                 precision='fp32'):
 
         self.device = device
-        torch.cuda.set_device(device)
+        if torch.device(device).type == 'cuda':
+            torch.cuda.set_device(device)
         self.T = T
         self.audio_type = audio_type
 
@@ -53,10 +30,12 @@ class AudioStyleNet:
         self.g = PretrainedGenerator1024().eval().to(self.device)
         for param in self.g.parameters():
             param.requires_grad = False
+        # Reduced precision synthesis, see Generator.set_precision()
+        self.g.set_precision(precision)
 
-        # Define audio encoder
+        # Define audio encoder, all weights are loaded from model_path
         self.audio_encoder = models.AudioExpressionNet3(
-            T).to(self.device).eval()
+            T, pretrained=False).to(self.device).eval()
 
         # Load weights
         self.load(model_path)
@@ -80,6 +59,20 @@ class AudioStyleNet:
 
         # Predict offset
         latent_offset = self.audio_encoder(audio, aux_input)
+
+        return self.add_offset(latent_offset, input_latent, direction,
+                               audio_multiplier=audio_multiplier,
+                               audio_truncation=audio_truncation,
+                               direction_multiplier=direction_multiplier)
+
+    def add_offset(self,
+                   latent_offset,
+                   input_latent,
+                   direction=None,
+                   audio_multiplier=2.,
+                   audio_truncation=.8,
+                   direction_multiplier=1.):
+
         prediction = input_latent.clone()
 
         # Adapt strength of direction
@@ -96,15 +89,15 @@ class AudioStyleNet:
 
         return prediction
 
-    def __call__(self,
-                 test_latent,
-                 test_sentence_path,
-                 direction=None,
-                 use_landmark_input=False,
-                 audio_multiplier=2.0,
-                 audio_truncation=0.8,
-                 direction_multiplier=1.0,
-                 max_sec=None):
+    def load_inputs(self, test_latent, test_sentence_path, direction=None, max_sec=None):
+        """
+        Loads the inputs of a video to the device. test_sentence_path is a
+        directory of extracted features or a wav file.
+
+        :returns (test_latent, audios, direction): shapes [1, 18, 512],
+                                                   [n_frames, 16, 29] and
+                                                   [1, 18, 512] (or None)
+        """
         # Load test latent
         if type(test_latent) is str:
             test_latent = torch.load(test_latent).unsqueeze(0).to(self.device)
@@ -122,22 +115,20 @@ class AudioStyleNet:
         # transforms.ToPILImage('RGB')(img).show()
         # 1 / 0
 
-        # Auxiliary input
-        aux_input = test_latent[:, 4:8]
-
-        # Load audio features
-        audio_paths = sorted(glob(test_sentence_path + f'*.{self.audio_type}.npy'))
-        audios = torch.stack([torch.tensor(np.load(p), dtype=torch.float32)
-                              for p in audio_paths]).to(self.device)
+        # Load audio features, a wav file is looked up in the feature cache
+        # and only extracted if it was not seen before
+        if os.path.isfile(test_sentence_path):
+            if self.audio_type != 'deepspeech':
+                raise ValueError(f"Can only extract deepspeech features from {test_sentence_path}")
+            audios = feature_cache.load_features(test_sentence_path)
+        else:
+            audios = utils.load_audio_features(test_sentence_path, self.audio_type)
 
         if max_sec is not None:
             max_frames = 25 * max_sec
             audios = audios[:max_frames]
 
-        # Pad audio features
-        pad = self.T // 2
-        audios = F.pad(audios, (0, 0, 0, 0, pad, pad - 1), 'constant', 0.)
-        audios = audios.unfold(0, self.T, 1).permute(0, 3, 1, 2)
+        audios = torch.tensor(np.array(audios), dtype=torch.float32).to(self.device)
 
         # Load direction if provided
         if direction is not None:
@@ -154,47 +145,132 @@ class AudioStyleNet:
             else:
                 direction = direction.unsqueeze(0).to(self.device)
 
-        video = []
+        return test_latent, audios, direction
 
-        # Generate
-        for i, audio in enumerate(audios):
-            audio = audio.unsqueeze(0)
-            with torch.no_grad():
-                input_latent = test_latent.clone()
-                latent = self.forward(audio, input_latent, aux_input, direction,
-                                      audio_multiplier=audio_multiplier,
-                                      audio_truncation=audio_truncation,
-                                      direction_multiplier=direction_multiplier)
+    def generate(self,
+                 test_latent,
+                 test_sentence_path,
+                 direction=None,
+                 use_landmark_input=False,
+                 audio_multiplier=2.0,
+                 audio_truncation=0.8,
+                 direction_multiplier=1.0,
+                 max_sec=None,
+                 batch_size=1,
+                 render_size=1024):
+        """
+        Generator over the frames of the video, yields batches of up to
+        batch_size frames as cpu tensors of shape [b, 3, 256, 256] in [0, 1].
+        With $AUDIOSTYLENET_PROFILE set, a profile of every video is written
+        there (see utils/profiling.py). render_size is the resolution of the
+        generator block the frames are taken from, 256 up to the generator
+        size.
+        """
+        if render_size not in RENDER_SIZES or render_size > self.g.size:
+            raise ValueError(f"render_size {render_size} is not one of "
+                             f"{[s for s in RENDER_SIZES if s <= self.g.size]}")
+        video_name = os.path.basename(os.path.normpath(test_sentence_path)).split('.')[0]
+        with profiling.from_env({'g': self.g, 'audio_encoder': self.audio_encoder},
+                                video_name):
+            yield from self._generate(test_latent, test_sentence_path, direction,
+                                      audio_multiplier, audio_truncation,
+                                      direction_multiplier, max_sec, batch_size,
+                                      render_size)
+
+    def _generate(self,
+                  test_latent,
+                  test_sentence_path,
+                  direction,
+                  audio_multiplier,
+                  audio_truncation,
+                  direction_multiplier,
+                  max_sec,
+                  batch_size,
+                  render_size):
+        with profiling.span('load_inputs'):
+            test_latent, audios, direction = self.load_inputs(
+                test_latent, test_sentence_path, direction, max_sec)
 
-                # Generate images
-                pred = self.g([latent], input_is_latent=True, noise=self.g.noises)[0]
+        # Auxiliary input
+        aux_input = test_latent[:, 4:8]
 
-                # Downsample
-                pred = utils.downsample_256(pred)
+        prefix = None
 
-            # Normalize
-            pred = make_grid(pred.cpu(), normalize=True, range=(-1, 1))
-            video.append(pred)
+        # Every audio frame is encoded once, the zero-padded windows of
+        # length T are assembled from the buffered expressions
+        with torch.no_grad(), profiling.span('encode_audio'):
+            stream = models.AudioExpressionStream(self.audio_encoder, aux_input)
 
-        return torch.stack(video)
+        # Generate
+        try:
+            for audio in list(audios.split(batch_size)) + [None]:
+                with torch.no_grad():
+                    with profiling.span('encode_audio'):
+                        if audio is None:
+                            latent_offset = stream.flush()
+                        else:
+                            latent_offset = stream.push(audio)
+                    b = latent_offset.shape[0]
+                    if b == 0:
+                        continue
+
+                    with profiling.span('add_offset'):
+                        input_latent = test_latent.repeat(b, 1, 1)
+                        latent = self.add_offset(latent_offset, input_latent, direction,
+                                                 audio_multiplier=audio_multiplier,
+                                                 audio_truncation=audio_truncation,
+                                                 direction_multiplier=direction_multiplier)
+
+                    # Layers reading only rows 0-3 are the same for every frame,
+                    # rows 8-17 are the same as well
+                    if prefix is None:
+                        with profiling.span('prefix'):
+                            prefix = self.g.prefix(latent[:1], noise=self.g.noises)
+                            self.g.freeze_styles(latent, start=8)
+
+                    # Generate images
+                    # render_size=256 stops at the 256 block instead of
+                    # rendering 1024 and downsampling
+                    pred = self.g([latent], input_is_latent=True,
+                                  noise=self.g.noises, prefix=prefix,
+                                  size=render_size)[0]
+
+                    # Downsample
+                    with profiling.span('downsample'):
+                        pred = utils.downsample_256(pred)
+
+                # Normalize
+                with profiling.span('normalize'):
+                    frames = torch.stack([make_grid(p, normalize=True, range=(-1, 1))
+                                          for p in pred.cpu()])
+                yield frames
+        finally:
+            self.g.unfreeze_styles()
+
+    def __call__(self, *args, **kwargs):
+        """
+        Returns the whole video as tensor of shape [n_frames, 3, 256, 256].
+        Arguments are the same as for generate().
+        """
+        return torch.cat(list(self.generate(*args, **kwargs)))
+
+    def render(self, test_latent, test_sentence_path, audiofile, f, **kwargs):
+        """
+        Generates the video and streams it to f while it is generated,
+        without keeping it in memory. Keyword arguments are passed on to
+        generate(). f='-' writes the video to stdout.
+        """
+        print(f"Saving to {f}")
+        with utils.VideoWriter(f, fps=25, audiofile=audiofile) as writer:
+            for frames in self.generate(test_latent, test_sentence_path, **kwargs):
+                with profiling.span('write'):
+                    writer.write(frames)
 
     def save_video(self, video, audiofile, f):
         print(f"Saving to {f}")
-        if not os.path.isabs(audiofile):
-            audiofile = os.path.join(os.getcwd(), audiofile)
-        if not os.path.isabs(f):
-            f = os.path.join(os.getcwd(), f)
-        with tempdir() as tmp_path:
-            # Save frames as video
-            utils.write_video(f'{tmp_path}/tmp.avi', video, fps=25)
-
-            # Add audio
-            p = Popen(['ffmpeg', '-y', '-i', f'{tmp_path}/tmp.avi', '-i', audiofile, '-codec', 'copy', '-shortest', f],
-                      stdout=PIPE, stderr=PIPE)
-            output, error = p.communicate()
-            if p.returncode != 0:
-                print("Adding audio from %s to video %s failed with error\n%d %s %s" % (
-                    audiofile, f'{tmp_path}/tmp.avi', p.returncode, output, error))
+        with utils.VideoWriter(f, fps=25, audiofile=audiofile) as writer:
+            for frames in video.split(25):
+                writer.write(frames)
 
 
 if __name__ == '__main__':
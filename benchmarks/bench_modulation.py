@@ -0,0 +1,94 @@
+"""
+Compares the two ways ModulatedConv2d can apply its style
+(Generator.set_modulation()): a grouped convolution with one modulated
+weight per sample ('grouped') and scaling the activations around one shared
+convolution ('activation'), per layer of the 1024 generator and for the
+whole generator, at several batch sizes.
+
+usage (from the repository root):
+    python -m benchmarks.bench_modulation --device cuda:0
+    python -m benchmarks.bench_modulation --device cpu --max_size 256 --batch_sizes 1 4 16
+"""
+
+import argparse
+import torch
+
+from benchmarks.bench_ops import timeit
+from my_models.style_gan_2 import MODULATIONS, Generator, ModulatedConv2d
+
+
+def conv_configs(max_size):
+    """ (name, in_channel, out_channel, input size, upsample) of the StyledConvs """
+    channels = {4: 512, 8: 512, 16: 512, 32: 512, 64: 512, 128: 256, 256: 128, 512: 64, 1024: 32}
+    configs = []
+    size = 8
+    while size <= max_size:
+        configs.append((f'b{size}.conv1', channels[size // 2], channels[size], size // 2, True))
+        configs.append((f'b{size}.conv2', channels[size], channels[size], size, False))
+        size *= 2
+    return configs
+
+
+def bench_layers(args, device):
+    results = []
+    for name, in_channel, out_channel, size, upsample in conv_configs(args.max_size):
+        conv = ModulatedConv2d(in_channel, out_channel, 3, 512, upsample=upsample).to(device)
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, in_channel, size, size, device=device)
+            style = torch.randn(batch_size, 512, device=device)
+
+            row = {'layer': name, 'batch_size': batch_size}
+            outs = {}
+            with torch.no_grad():
+                for mode in MODULATIONS:
+                    conv.modulation_mode = mode
+                    outs[mode] = conv(x, style)
+                    row[mode] = timeit(lambda: conv(x, style), device, args.n_iters)
+            row['max_diff'] = (outs['grouped'] - outs['activation']).abs().max().item()
+            results.append(row)
+    return results
+
+
+def bench_generator(args, device):
+    g = Generator(args.max_size, 512, 8).eval().to(device)
+    noise = [n.to(device) for n in g.make_noise()]
+
+    results = []
+    for batch_size in args.batch_sizes:
+        latent = torch.randn(batch_size, g.n_latent, 512, device=device)
+
+        row = {'layer': 'generator', 'batch_size': batch_size}
+        outs = {}
+        with torch.no_grad():
+            for mode in MODULATIONS:
+                g.set_modulation(mode)
+                outs[mode] = g([latent], input_is_latent=True, noise=noise)[0]
+                row[mode] = timeit(lambda: g([latent], input_is_latent=True, noise=noise),
+                                   device, args.n_iters)
+        row['max_diff'] = (outs['grouped'] - outs['activation']).abs().max().item()
+        results.append(row)
+    g.set_modulation('grouped')
+    return results
+
+
+def print_results(results):
+    print(f"{'layer':<16}{'batch':>6}{'grouped':>12}{'activation':>12}{'speedup':>10}{'max_diff':>12}")
+    for row in results:
+        print(f"{row['layer']:<16}{row['batch_size']:>6}{row['grouped']:12.3f}{row['activation']:12.3f}"
+              f"{row['grouped'] / row['activation']:10.2f}{row['max_diff']:12.2e}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--max_size', type=int, default=1024)
+    parser.add_argument('--n_iters', type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    print(f"Times in ms per call on {device}, speedup of 'activation' over 'grouped'")
+    print_results(bench_layers(args, device) + bench_generator(args, device))
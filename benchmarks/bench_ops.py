@@ -0,0 +1,132 @@
+"""
+Compares the native implementations of upfirdn2d and fused_leaky_relu with
+the compiled CUDA extensions on the shapes used by the 1024 generator.
+
+usage (from the repository root):
+    python -m benchmarks.bench_ops --device cuda:0
+    python -m benchmarks.bench_ops --device cpu --max_size 256
+"""
+
+import argparse
+import time
+import torch
+
+from my_models.style_gan_2 import make_kernel
+from op.fused_act import FusedLeakyReLUFunction, fused, fused_leaky_relu_native
+from op.upfirdn2d import UpFirDn2d, upfirdn2d_native, upfirdn2d_op
+
+
+def timeit(fn, device, n_iters):
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    fn()  # Warm up
+    sync()
+    a = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    sync()
+    b = time.perf_counter()
+    return 1000. * (b - a) / n_iters
+
+
+def forward_backward(op, *inputs):
+    def fn():
+        x = inputs[0].detach().requires_grad_()
+        op(x, *inputs[1:]).sum().backward()
+    return fn
+
+
+def bench_upfirdn2d(args, device):
+    kernel = make_kernel([1, 3, 3, 1]).to(device)
+
+    configs = []
+    size = 8
+    while size <= args.max_size:
+        channel = min(512, 32768 // size)
+        # ToRGB skip upsampling, blur after transposed conv
+        configs.append((f'upsample {size}', 3, size // 2, kernel * 4, 2, 1, (2, 1)))
+        configs.append((f'blur {size}', channel, size + 1, kernel * 4, 1, 1, (1, 1)))
+        size *= 2
+
+    results = []
+    for name, channel, size, k, up, down, pad in configs:
+        x = torch.randn(args.batch_size, channel, size, size, device=device)
+
+        def native(x, k=k, up=up, down=down, pad=pad):
+            return upfirdn2d_native(
+                x, k, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
+
+        row = {
+            'op': f'upfirdn2d {name}',
+            'native': timeit(lambda: native(x), device, args.n_iters),
+            'native_bw': timeit(forward_backward(native, x), device, args.n_iters),
+        }
+
+        if upfirdn2d_op is not None and device.type == 'cuda':
+            def extension(x, k=k, up=up, down=down, pad=pad):
+                return UpFirDn2d.apply(
+                    x, k, (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1]))
+
+            row['extension'] = timeit(lambda: extension(x), device, args.n_iters)
+            row['extension_bw'] = timeit(forward_backward(extension, x), device, args.n_iters)
+            row['max_diff'] = (native(x) - extension(x)).abs().max().item()
+
+        results.append(row)
+
+    return results
+
+
+def bench_fused_leaky_relu(args, device):
+    results = []
+    size = 8
+    while size <= args.max_size:
+        channel = min(512, 32768 // size)
+        x = torch.randn(args.batch_size, channel, size, size, device=device)
+        bias = torch.randn(channel, device=device)
+
+        row = {
+            'op': f'fused_leaky_relu {size}',
+            'native': timeit(lambda: fused_leaky_relu_native(x, bias),
+                             device, args.n_iters),
+            'native_bw': timeit(forward_backward(fused_leaky_relu_native, x, bias),
+                                device, args.n_iters),
+        }
+
+        if fused is not None and device.type == 'cuda':
+            def extension(x, bias=bias):
+                return FusedLeakyReLUFunction.apply(x, bias, 0.2, 2 ** 0.5)
+
+            row['extension'] = timeit(lambda: extension(x), device, args.n_iters)
+            row['extension_bw'] = timeit(forward_backward(extension, x), device, args.n_iters)
+            row['max_diff'] = (fused_leaky_relu_native(x, bias) - extension(x)).abs().max().item()
+
+        results.append(row)
+        size *= 2
+
+    return results
+
+
+def print_results(results):
+    columns = ['native', 'native_bw', 'extension', 'extension_bw', 'max_diff']
+    print(f"{'op':<28}" + ''.join(f'{c:>14}' for c in columns))
+    for row in results:
+        values = [f'{row[c]:14.4f}' if c in row else f"{'-':>14}" for c in columns]
+        print(f"{row['op']:<28}" + ''.join(values))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_size', type=int, default=1024)
+    parser.add_argument('--n_iters', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+
+    print(f"Times in ms per call on {device} (batch size {args.batch_size}), _bw: forward + backward")
+    results = bench_upfirdn2d(args, device) + bench_fused_leaky_relu(args, device)
+    print_results(results)
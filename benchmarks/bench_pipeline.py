@@ -0,0 +1,297 @@
+"""
+Times every stage of the talking-head pipeline separately on synthetic
+inputs with randomly initialized weights, so it runs without the pretrained
+models and on CPU:
+
+    load_features   packed and per-frame audio features
+    audio_encoder   AudioExpressionNet3 over a clip (streamed and windowed)
+    generator       Generator.forward at several batch sizes
+    downsample_256
+    normalize       make_grid normalization of the generated frames
+    video           encoding and muxing with utils.VideoWriter
+
+Every stage reports frames/sec, latency percentiles (ms per call) and peak
+memory as JSON, to compare results across commits. Peak memory is the
+maximum the stage allocated above what was allocated when it started: device
+memory on CUDA, the resident set size of the process sampled every
+millisecond on CPU (Linux only, null elsewhere).
+
+usage (from the repository root):
+    python -m benchmarks.bench_pipeline --out bench.json
+    python -m benchmarks.bench_pipeline --device cpu --size 256 --batch_sizes 1 4 --n_iters 3
+"""
+
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import torch
+import wave
+
+from my_models.models import AudioExpressionNet3, AudioExpressionStream
+from my_models.style_gan_2 import Generator
+from torchvision.utils import make_grid
+from utils import utils
+from utils.profiling import rss
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class PeakMemory:
+    """
+    Peak memory in MB allocated inside the with block above the memory at its
+    start (self.peak). On CPU a thread samples the RSS of the process, the
+    lifetime peak (ru_maxrss) would include all earlier stages.
+    """
+    def __init__(self, device, interval=0.001):
+        self.device = device
+        self.interval = interval
+        self.peak = None
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.max_rss = max(self.max_rss, rss())
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.start = torch.cuda.memory_allocated(self.device)
+            return self
+
+        self.start = rss()
+        if self.start is not None:
+            self.max_rss = self.start
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = (torch.cuda.max_memory_allocated(self.device) - self.start) / 2 ** 20
+        elif self.start is not None:
+            self.stop.set()
+            self.thread.join()
+            self.max_rss = max(self.max_rss, rss())
+            self.peak = (self.max_rss - self.start) / 2 ** 20
+
+
+def measure(fn, device, n_iters, n_frames, n_warmup=1):
+    """
+    Runs fn n_warmup + n_iters times and returns latency percentiles in ms,
+    frames/sec (with n_frames frames per call) and peak memory of these calls
+    """
+    times = []
+    with PeakMemory(device) as memory:
+        for _ in range(n_warmup):
+            fn()
+        sync(device)
+
+        for _ in range(n_iters):
+            a = time.perf_counter()
+            fn()
+            sync(device)
+            times.append(1000. * (time.perf_counter() - a))
+    times = np.array(times)
+
+    return {
+        'n_iters': n_iters,
+        'frames_per_call': n_frames,
+        'fps': float(1000. * n_frames / times.mean()),
+        'latency_ms': {
+            'mean': float(times.mean()),
+            'p50': float(np.percentile(times, 50)),
+            'p90': float(np.percentile(times, 90)),
+            'p99': float(np.percentile(times, 99)),
+        },
+        'peak_memory_mb': memory.peak,
+    }
+
+
+def bench_load_features(args, device, tmp):
+    audio = np.random.randn(args.n_frames, 16, 29).astype(np.float32)
+
+    packed = os.path.join(tmp, 'packed/')
+    os.makedirs(packed)
+    np.save(utils.packed_audio_path(packed, 'deepspeech'), audio)
+
+    per_frame = os.path.join(tmp, 'per_frame/')
+    os.makedirs(per_frame)
+    for i, a in enumerate(audio):
+        np.save(per_frame + f'{i + 1:05d}.deepspeech.npy', a)
+
+    def load(path):
+        return lambda: torch.tensor(np.array(utils.load_audio_features(path)),
+                                    device=device)
+
+    return {
+        'packed': measure(load(packed), device, args.n_iters, args.n_frames),
+        'per_frame': measure(load(per_frame), device, args.n_iters, args.n_frames),
+    }
+
+
+def bench_audio_encoder(args, device):
+    model = AudioExpressionNet3(args.T, pretrained=False).eval().to(device)
+    audio = torch.randn(args.n_frames, 16, 29, device=device)
+    latent = torch.randn(1, 4, 512, device=device)
+
+    def streamed():
+        with torch.no_grad():
+            stream = AudioExpressionStream(model, latent)
+            out = [stream.push(chunk) for chunk in audio.split(args.chunk_size)]
+            return torch.cat(out + [stream.flush()])
+
+    def windowed():
+        # Zero-padded windows of length T around every frame
+        pad = args.T // 2
+        windows = torch.nn.functional.pad(audio, (0, 0, 0, 0, pad, pad - 1))
+        windows = windows.unfold(0, args.T, 1).permute(0, 3, 1, 2)
+        with torch.no_grad():
+            return torch.cat([model(w, latent.expand(len(w), -1, -1))
+                              for w in windows.split(args.chunk_size)])
+
+    # Both paths compute the same latent offsets
+    max_diff = (streamed() - windowed()).abs().max().item()
+
+    return {
+        'streamed': measure(streamed, device, args.n_iters, args.n_frames),
+        'windowed': measure(windowed, device, args.n_iters, args.n_frames),
+        'max_diff': max_diff,
+    }
+
+
+def bench_generator(args, device, g):
+    results = {}
+    for batch_size in args.batch_sizes:
+        latent = torch.randn(batch_size, g.n_latent, 512, device=device)
+
+        for render_size in sorted({g.size, min(g.size, 256)}, reverse=True):
+            def forward():
+                with torch.no_grad():
+                    g([latent], input_is_latent=True, noise=g.noises, size=render_size)
+
+            results[f'batch_{batch_size}_size_{render_size}'] = measure(
+                forward, device, args.n_iters, batch_size)
+
+    return results
+
+
+def bench_postprocess(args, device, size):
+    batch_size = max(args.batch_sizes)
+    img = torch.randn(batch_size, 3, size, size, device=device)
+    small = utils.downsample_256(img)
+
+    def normalize():
+        torch.stack([make_grid(p, normalize=True, range=(-1, 1))
+                     for p in small.cpu()])
+
+    return {
+        'downsample_256': measure(lambda: utils.downsample_256(img), device,
+                                  args.n_iters, batch_size),
+        'normalize': measure(normalize, device, args.n_iters, batch_size),
+    }
+
+
+def write_silence(path, seconds, rate=16000):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(b'\0\0' * int(seconds * rate))
+
+
+def bench_video(args, device, tmp):
+    frames = torch.rand(args.n_frames, 3, 256, 256)
+    audiofile = os.path.join(tmp, 'silence.wav')
+    write_silence(audiofile, args.n_frames / 25.)
+
+    def encode(audiofile):
+        def fn():
+            with utils.VideoWriter(os.path.join(tmp, 'out.mp4'), fps=25,
+                                   audiofile=audiofile, audio_codec='aac') as writer:
+                for chunk in frames.split(args.chunk_size):
+                    writer.write(chunk)
+        return fn
+
+    # Frames are on the cpu, no device memory involved
+    cpu = torch.device('cpu')
+    return {
+        'encode': measure(encode(None), cpu, args.n_iters, args.n_frames),
+        'encode_mux': measure(encode(audiofile), cpu, args.n_iters, args.n_frames),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--size', type=int, default=1024, help="Generator resolution")
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--n_frames', type=int, default=200, help="Frames of the synthetic clip")
+    parser.add_argument('--chunk_size', type=int, default=16)
+    parser.add_argument('--T', type=int, default=8)
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--stages', type=str, nargs='+',
+                        default=['load_features', 'audio_encoder', 'generator', 'postprocess', 'video'])
+    parser.add_argument('--out', type=str, default=None, help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'torch': torch.__version__,
+        'device': str(device),
+        'device_name': torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor(),
+        'args': vars(args),
+        'stages': {},
+    }
+
+    tmp = tempfile.mkdtemp()
+    try:
+        if 'load_features' in args.stages:
+            report['stages']['load_features'] = bench_load_features(args, device, tmp)
+        if 'audio_encoder' in args.stages:
+            report['stages']['audio_encoder'] = bench_audio_encoder(args, device)
+        if 'generator' in args.stages:
+            g = Generator(args.size, 512, 8).eval().to(device)
+            g.noises = [n.to(device) for n in g.make_noise()]
+            report['stages']['generator'] = bench_generator(args, device, g)
+            del g
+        if 'postprocess' in args.stages:
+            report['stages']['postprocess'] = bench_postprocess(args, device, args.size)
+        if 'video' in args.stages:
+            report['stages']['video'] = bench_video(args, device, tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+    report = json.dumps(report, indent=2)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            f.write(report + '\n')
+        print(f"Saved report to {args.out}")
+    else:
+        print(report)
@@ -0,0 +1,90 @@
+"""
+Regression test and benchmark of the reduced precision generator
+(Generator.set_precision). Renders the same fixed latents (seed 0) in float32
+and in the given precisions, reports the time per image and the PSNR of the
+reduced precision images to the float32 ones, and exits with an error if
+the PSNR of any image is below --min_psnr.
+
+usage (from the repository root):
+    python -m benchmarks.bench_precision --device cuda:0 --precisions fp16 bf16
+    python -m benchmarks.bench_precision --device cpu --precisions bf16 --n_images 4
+"""
+
+import argparse
+import sys
+import torch
+
+from benchmarks.bench_ops import timeit
+from benchmarks.bench_render_size import psnr, render
+from my_models.style_gan_2 import Generator, PretrainedGenerator1024
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--precisions', type=str, nargs='+', default=None,
+                        help="Default: fp16 and bf16 on CUDA, bf16 on CPU")
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--n_images', type=int, default=16)
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--truncation', type=float, default=0.7)
+    parser.add_argument('--render_size', type=int, default=1024)
+    parser.add_argument('--min_psnr', type=float, default=35.,
+                        help="Fail if the PSNR of an image to float32 is lower")
+    parser.add_argument('--random_weights', action='store_true',
+                        help="Use an untrained generator")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.precisions is None:
+        args.precisions = ['fp16', 'bf16'] if device.type == 'cuda' else ['bf16']
+    torch.manual_seed(0)
+
+    if args.random_weights:
+        g = Generator(1024, 512, 8)
+        g.latent_avg = torch.zeros(512)
+        g.noises = g.make_noise()
+    else:
+        g = PretrainedGenerator1024()
+    g = g.eval().to(device)
+
+    # Fixed latents
+    with torch.no_grad():
+        z = torch.randn(args.n_images, 512, device=device)
+        latents = g.style(z).view(-1, 1, g.style_dim).repeat(1, g.n_latent, 1)
+        latents = g.latent_avg.to(device) + args.truncation * (latents - g.latent_avg.to(device))
+
+    results = {}
+    refs = None
+    for precision in ['fp32'] + args.precisions:
+        g.set_precision(precision)
+        with torch.no_grad():
+            imgs = torch.cat([render(g, latent, args.render_size)
+                              for latent in latents.split(args.batch_size)])
+            latent = latents[:args.batch_size]
+            t = timeit(lambda: render(g, latent, args.render_size), device,
+                       args.n_iters) / latent.shape[0]
+        if refs is None:
+            refs = imgs
+            results[precision] = (t, None)
+        else:
+            results[precision] = (t, psnr(imgs, refs))
+    g.set_precision('fp32')
+
+    print(f"Precision report on {device} (batch size {args.batch_size}, {args.n_images} images, "
+          f"render size {args.render_size})")
+    print(f"{'':<8}{'ms / image':>14}{'speedup':>10}{'PSNR dB':>10}{'min PSNR':>10}")
+    failed = []
+    for precision, (t, p) in results.items():
+        speedup = results['fp32'][0] / t
+        if p is None:
+            print(f"{precision:<8}{t:14.2f}{speedup:10.2f}{'-':>10}{'-':>10}")
+            continue
+        print(f"{precision:<8}{t:14.2f}{speedup:10.2f}{p.mean():10.2f}{p.min():10.2f}")
+        if p.min() < args.min_psnr:
+            failed.append(precision)
+
+    if failed:
+        print(f"FAILED: PSNR to fp32 below {args.min_psnr} dB for {', '.join(failed)}")
+        sys.exit(1)
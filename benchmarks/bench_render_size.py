@@ -0,0 +1,96 @@
+"""
+Compares rendering at 1024 followed by downsample_256 with stopping the
+generator at the 256 block (size=256), which skips the 512 and 1024 blocks
+and returns the image accumulated by the 256 ToRGB skip path.
+
+Reports the time per image of both paths and the difference of the 256
+output to the downsampled 1024 image (PSNR and, with --lpips, the LPIPS
+distance).
+
+usage (from the repository root):
+    python -m benchmarks.bench_render_size --device cuda:0 --batch_size 4
+    python -m benchmarks.bench_render_size --device cpu --n_images 4 --random_weights
+"""
+
+import argparse
+import torch
+
+from benchmarks.bench_ops import timeit
+from my_models.style_gan_2 import Generator, PretrainedGenerator1024
+from utils.utils import downsample_256
+
+
+def psnr(a, b):
+    """ PSNR of images in [-1, 1], per image """
+    mse = ((a - b) / 2.).pow(2).mean([1, 2, 3])
+    return 10. * torch.log10(1. / mse)
+
+
+def render(g, latent, size):
+    img, _ = g([latent], input_is_latent=True, noise=g.noises, size=size)
+    return downsample_256(img).clamp(-1., 1.)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--n_images', type=int, default=32)
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--truncation', type=float, default=0.7)
+    parser.add_argument('--lpips', action='store_true')
+    parser.add_argument('--random_weights', action='store_true',
+                        help="Use an untrained generator (timings only)")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    if args.random_weights:
+        g = Generator(1024, 512, 8)
+        g.latent_avg = torch.zeros(512)
+        g.noises = g.make_noise()
+    else:
+        g = PretrainedGenerator1024()
+    g = g.eval().to(device)
+
+    # Sample latents
+    with torch.no_grad():
+        z = torch.randn(args.n_images, 512, device=device)
+        latents = g.style(z).view(-1, 1, g.style_dim).repeat(1, g.n_latent, 1)
+        latents = g.latent_avg.to(device) + args.truncation * (latents - g.latent_avg.to(device))
+
+    if args.lpips:
+        from lpips import PerceptualLoss
+        lpips = PerceptualLoss(model='net-lin', net='vgg', use_gpu=device.type == 'cuda',
+                               gpu_id=device.index or 0)
+
+    # Quality
+    psnrs, dists = [], []
+    with torch.no_grad():
+        for latent in latents.split(args.batch_size):
+            ref = render(g, latent, 1024)
+            img = render(g, latent, 256)
+            psnrs.append(psnr(img, ref))
+            if args.lpips:
+                dists.append(lpips(img, ref).view(-1))
+    psnrs = torch.cat(psnrs)
+
+    # Speed
+    latent = latents[:args.batch_size]
+    times = {}
+    with torch.no_grad():
+        for size in [1024, 256]:
+            times[size] = timeit(lambda: render(g, latent, size), device,
+                                 args.n_iters) / latent.shape[0]
+
+    print(f"Render size report on {device} (batch size {args.batch_size}, {args.n_images} images)")
+    print(f"{'':<28}{'ms / image':>14}")
+    print(f"{'1024 + downsample_256':<28}{times[1024]:14.2f}")
+    print(f"{'size=256':<28}{times[256]:14.2f}")
+    print(f"speedup: {times[1024] / times[256]:.2f}x")
+    print(f"PSNR to 1024 + downsample_256: {psnrs.mean():.2f} dB (min {psnrs.min():.2f})")
+    if args.lpips:
+        dists = torch.cat(dists)
+        print(f"LPIPS to 1024 + downsample_256: {dists.mean():.4f} (max {dists.max():.4f})")
@@ -0,0 +1,244 @@
+"""
+Checks that the optimized inference paths of AudioStyleNet produce the same
+output as the simple ones, on synthetic inputs with randomly initialized
+weights (runs on CPU, without the pretrained models):
+
+    forward   AudioExpressionNet3.forward against the original loop over
+              the timesteps of the window
+    windows   AudioExpressionNet3 on batches of sliding windows (slices of
+              the unfolded audio, not contiguous) against one window at a time
+    stream    AudioExpressionStream, which encodes every frame once, against
+              AudioExpressionNet3 on the zero-padded windows
+    generator the generator with the cached prefix of latent rows 0-3, with
+              rows 8+ frozen (Generator.freeze_styles) and with both, in
+              both modulation modes, against the plain forward, and
+              freeze_styles() rejecting latents whose rows 8+ vary
+    generate  AudioStyleNet.generate() (streamed encoder, cached prefix,
+              frozen styles) against the plain per-frame path: the encoder
+              on one window and the full generator forward for every frame,
+              and with batch_size > 1 against batch_size=1
+
+usage (from the repository root):
+    python -m benchmarks.check_audiostylenet
+    python -m benchmarks.check_audiostylenet --device cuda:0 --batch_sizes 2 4 16
+"""
+
+import argparse
+import numpy as np
+import shutil
+import tempfile
+import torch
+import torch.nn.functional as F
+
+from audiostylenet import AudioStyleNet
+from my_models.models import AudioExpressionNet3, AudioExpressionStream
+from my_models.style_gan_2 import MODULATIONS, Generator
+from utils import utils
+
+
+def sliding_windows(audio, T):
+    """ Zero-padded windows of length T around every frame, [n, T, 16, 29] """
+    pad = T // 2
+    audio = F.pad(audio, (0, 0, 0, 0, pad, pad - 1), 'constant', 0.)
+    return audio.unfold(0, T, 1).permute(0, 3, 1, 2)
+
+
+def forward_loop(model, audio, latent):
+    """ AudioExpressionNet3.forward with the fully connected layers run per timestep """
+    b = audio.shape[0]
+    audio = audio.permute(0, 1, 3, 2).reshape(b * model.T, 29, 16)
+    conv_res = model.convNet(audio).view(b * model.T, 1, -1)
+
+    latent = model.latent_in(latent.clone().view(b, -1))
+
+    expression = []
+    conv_res = conv_res.view(b, model.T, 1, -1).transpose(0, 1)  # [T, b, 1, 64]
+    for t in conv_res:
+        z_ = F.leaky_relu(model.adain1(model.fc1(t), latent), 0.02)
+        z_ = F.leaky_relu(model.fc2(z_))
+        z_ = model.fc3(z_)
+        expression.append(model.fc_out(z_))
+    expression = torch.stack(expression, dim=1)  # [b, T, expression_dim]
+
+    if model.T > 1:
+        expression_T = expression.transpose(1, 2)
+        attention = model.attentionNet(expression_T).unsqueeze(-1)
+        expression = torch.bmm(expression_T, attention)
+
+    return expression.view(b, 4, 512)
+
+
+def reference_frames(model, audio, latent):
+    """ Frames of AudioStyleNet.generate() rendered one at a time without caches, [n, 3, h, w] """
+    frames = []
+    with torch.no_grad():
+        for window in sliding_windows(audio, model.T):
+            latent_offset = model.audio_encoder(window.unsqueeze(0), latent[:, 4:8])
+            frame_latent = model.add_offset(latent_offset, latent)
+            img = model.g([frame_latent], input_is_latent=True, noise=model.g.noises)[0]
+            img = utils.downsample_256(img)
+            # Same as make_grid(normalize=True, range=(-1, 1))
+            frames.append(((img.clamp(-1., 1.) + 1.) / 2.).cpu())
+    return torch.cat(frames)
+
+
+def random_model(args, device):
+    """ AudioStyleNet with an untrained generator of size args.size """
+    model = AudioStyleNet.__new__(AudioStyleNet)
+    model.device = device
+    model.T = args.T
+    model.audio_type = 'deepspeech'
+
+    model.g = Generator(args.size, 512, 8).eval().to(device)
+    model.g.register_buffer('latent_avg', torch.randn(512, device=device))
+    model.g.noises = [n.to(device) for n in model.g.make_noise()]
+    model.audio_encoder = AudioExpressionNet3(args.T, pretrained=False).eval().to(device)
+    return model
+
+
+def report(name, diff, tolerance):
+    print(f"{name:<40} max diff {diff:.2e}")
+    assert diff <= tolerance, f"{name} differs by {diff:.2e} (tolerance {tolerance:.0e})"
+
+
+def check_forward(args, model, audio, latent):
+    windows = sliding_windows(audio, args.T).contiguous()
+    aux_input = latent[:, 4:8].expand(len(windows), -1, -1)
+
+    with torch.no_grad():
+        ref = forward_loop(model.audio_encoder, windows, aux_input)
+        out = model.audio_encoder(windows, aux_input)
+    report('forward vectorized', (out - ref).abs().max().item(), args.tolerance)
+
+
+def check_windows(args, model, audio, latent):
+    windows = sliding_windows(audio, args.T)
+    aux_input = latent[:, 4:8]
+
+    with torch.no_grad():
+        ref = torch.cat([model.audio_encoder(w.unsqueeze(0), aux_input) for w in windows])
+        for batch_size in args.batch_sizes:
+            out = torch.cat([model.audio_encoder(w, aux_input.expand(len(w), -1, -1))
+                             for w in windows.split(batch_size)])
+            report(f'windows batch_size={batch_size}', (out - ref).abs().max().item(),
+                   args.tolerance)
+
+
+def check_stream(args, model, audio, latent):
+    aux_input = latent[:, 4:8]
+
+    with torch.no_grad():
+        windows = sliding_windows(audio, args.T)
+        ref = model.audio_encoder(windows, aux_input.expand(len(windows), -1, -1))
+
+        # Chunks shorter and longer than T
+        for chunk_size in [1, 3, args.n_frames]:
+            stream = AudioExpressionStream(model.audio_encoder, aux_input)
+            out = [stream.push(chunk) for chunk in audio.split(chunk_size)]
+            out = torch.cat(out + [stream.flush()])
+            assert out.shape == ref.shape, f"{out.shape} != {ref.shape}"
+            report(f'stream chunk_size={chunk_size}', (out - ref).abs().max().item(),
+                   args.tolerance)
+
+
+def check_generator(args, model, audio, latent):
+    g = model.g
+    # Frames of one video share rows 0-3 and 8+, only rows 4-7 vary
+    latents = latent.repeat(len(args.batch_sizes) + 2, 1, 1)
+    latents[:, 4:8] += torch.randn_like(latents[:, 4:8])
+
+    with torch.no_grad():
+        for mode in MODULATIONS:
+            g.set_modulation(mode)
+            ref = g([latents], input_is_latent=True, noise=g.noises)[0]
+            prefix = g.prefix(latents[:1], noise=g.noises)
+
+            out = g([latents], input_is_latent=True, noise=g.noises, prefix=prefix)[0]
+            report(f'generator {mode} prefix', (out - ref).abs().max().item(), args.tolerance)
+
+            g.freeze_styles(latents, start=8)
+            try:
+                out = g([latents], input_is_latent=True, noise=g.noises)[0]
+                report(f'generator {mode} frozen', (out - ref).abs().max().item(), args.tolerance)
+                out = g([latents], input_is_latent=True, noise=g.noises, prefix=prefix)[0]
+                report(f'generator {mode} prefix + frozen', (out - ref).abs().max().item(),
+                       args.tolerance)
+
+                # Other rows 8+ than the frozen ones
+                other = latents.clone()
+                other[:, 8:] += 1.
+                try:
+                    g([other], input_is_latent=True, noise=g.noises)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("forward accepted rows 8+ other than the frozen ones")
+            finally:
+                g.unfreeze_styles()
+        g.set_modulation('grouped')
+
+        # Rows 8+ varying within the batch
+        varying = latents.clone()
+        varying[1:, 8:] += 1.
+        try:
+            g.freeze_styles(varying, start=8)
+        except ValueError:
+            pass
+        else:
+            g.unfreeze_styles()
+            raise AssertionError("freeze_styles accepted rows 8+ varying between samples")
+    print(f"{'freeze_styles varying rows':<40} rejected")
+
+
+def check_generate(args, model, audio, latent):
+    tmp = tempfile.mkdtemp()
+    try:
+        np.save(utils.packed_audio_path(tmp, 'deepspeech'), audio.cpu().numpy())
+        ref = model(latent[0], tmp, batch_size=1, render_size=args.size)
+        plain = reference_frames(model, audio, latent)
+        assert ref.shape == plain.shape, f"{ref.shape} != {plain.shape}"
+        report('generate against per-frame forward', (ref - plain).abs().max().item(),
+               args.tolerance)
+
+        for batch_size in args.batch_sizes:
+            out = model(latent[0], tmp, batch_size=batch_size, render_size=args.size)
+            assert out.shape == ref.shape, f"{out.shape} != {ref.shape}"
+            report(f'generate batch_size={batch_size}', (out - ref).abs().max().item(),
+                   args.tolerance)
+
+        # Blocks below 256 would return smaller frames
+        try:
+            model(latent[0], tmp, render_size=128)
+        except ValueError:
+            print(f"{'generate render_size=128':<40} rejected")
+        else:
+            raise AssertionError("generate() accepted render_size=128")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--n_frames', type=int, default=13)
+    parser.add_argument('--T', type=int, default=8)
+    parser.add_argument('--size', type=int, default=256,
+                        help="Generator resolution, generate() renders at least 256")
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    model = random_model(args, device)
+    audio = torch.randn(args.n_frames, 16, 29, device=device)
+    latent = torch.randn(1, model.g.n_latent, 512, device=device)
+
+    check_forward(args, model, audio, latent)
+    check_windows(args, model, audio, latent)
+    check_stream(args, model, audio, latent)
+    check_generator(args, model, audio, latent)
+    check_generate(args, model, audio, latent)
+    print("OK")
@@ -0,0 +1,86 @@
+"""
+Checks that the vectorized post-processing of the DeepSpeech output in
+utils/audio_handler.py (interpolation to the target fps and windowing) is
+bit-identical to the original per-column / per-window loops, and times both.
+
+usage (from this directory):
+    python bench_audio_handler.py --seconds 3600
+"""
+
+import argparse
+import numpy as np
+import time
+
+from utils.audio_handler import interpolate_features, make_windows
+
+
+def interpolate_features_loop(features, input_rate, output_rate, output_len=None):
+    num_features = features.shape[1]
+    input_len = features.shape[0]
+    seq_len = input_len / float(input_rate)
+    if output_len is None:
+        output_len = int(seq_len * output_rate)
+    input_timestamps = np.arange(input_len) / float(input_rate)
+    output_timestamps = np.arange(output_len) / float(output_rate)
+    output_features = np.zeros((output_len, num_features))
+    for feat in range(num_features):
+        output_features[:, feat] = np.interp(output_timestamps,
+                                             input_timestamps,
+                                             features[:, feat])
+    return output_features
+
+
+def make_windows_loop(features, window_size, window_stride):
+    zero_pad = np.zeros((int(window_size / 2), features.shape[1]))
+    features = np.concatenate((zero_pad, features, zero_pad), axis=0)
+    windows = []
+    for window_index in range(0, features.shape[0] - window_size, window_stride):
+        windows.append(features[window_index:window_index + window_size])
+    return np.array(windows)
+
+
+def timed(fn, *args):
+    a = time.perf_counter()
+    out = fn(*args)
+    return out, 1000. * (time.perf_counter() - a)
+
+
+def check(network_output, target_fps, window_size, window_stride, output_len=None):
+    ref, t_ref = timed(interpolate_features_loop, network_output, 50, target_fps, output_len)
+    out, t_out = timed(interpolate_features, network_output, 50, target_fps, output_len)
+    assert ref.dtype == out.dtype and np.array_equal(ref, out), \
+        f"interpolate_features differs, max diff {np.abs(ref - out).max()}"
+
+    ref_w, t_ref_w = timed(make_windows_loop, ref, window_size, window_stride)
+    out_w, t_out_w = timed(make_windows, out, window_size, window_stride)
+    if len(ref_w) == 0:
+        ref_w = ref_w.reshape(out_w.shape)
+    assert ref_w.dtype == out_w.dtype and np.array_equal(ref_w, out_w), "make_windows differs"
+
+    return t_ref, t_out, t_ref_w, t_out_w
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=600., help="Length of the synthetic audio")
+    parser.add_argument('--target_fps', type=float, default=25.)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+
+    # Edge cases: short inputs, other frame rates and strides, output_len
+    # beyond the input (rounding of the audio length)
+    for n, fps, size, stride, output_len in [
+            (1, 25., 16, 1, None), (2, 25., 16, 1, 3), (7, 30., 16, 2, None),
+            (50, 60., 8, 1, None), (101, 25., 16, 1, 52), (999, 29.97, 16, 3, None)]:
+        check(rng.randn(n, 29).astype(np.float32), fps, size, stride, output_len)
+
+    # DeepSpeech logits come at 50 fps
+    network_output = rng.randn(int(50 * args.seconds), 29).astype(np.float32)
+    num_frames = int(round(args.seconds * args.target_fps))
+    t_ref, t_out, t_ref_w, t_out_w = check(network_output, args.target_fps, 16, 1, num_frames)
+
+    print(f"Outputs are bit-identical ({args.seconds:.0f} s of audio)")
+    print(f"interpolate_features: {t_ref:.1f} ms -> {t_out:.1f} ms")
+    print(f"make_windows:         {t_ref_w:.1f} ms -> {t_out_w:.1f} ms")
@@ -20,7 +20,8 @@ import os
 import argparse
 
 from glob import glob
-from utils.audio_feature_extractor import audio_feature_extractor
+from utils.audio_feature_extractor import audio_batch_feature_extractor, audio_feature_extractor, \
+    audio_stream_feature_extractor
 from utils.audio_handler import AudioHandler
 
 filename = './audio/merkel_2018_cut.wav'
@@ -32,6 +33,11 @@ parser.add_argument('--ds_fname', default='./ds_graph/output_graph.pb', help='Pa
 parser.add_argument('--audiofiles', default=filename, help='Path of input speech sequence')
 parser.add_argument('--out_path', default='./output', help='Output path')
 parser.add_argument('--target_fps', default=25, help='Target frame rate')
+parser.add_argument('--per_frame', action='store_true', help='Write one file per frame instead of one packed file')
+parser.add_argument('--batch_size', type=int, default=1, help='Number of files per graph call, > 1 enables the batch mode')
+parser.add_argument('--n_workers', type=int, default=None, help='Processes for resampling and MFCC in batch mode (default: number of cpus)')
+parser.add_argument('--chunk_seconds', type=float, default=None, help='Process long audio in chunks of this length (approximate at chunk borders)')
+parser.add_argument('--overlap_seconds', type=float, default=2., help='Context on both sides of every chunk')
 
 args = parser.parse_args()
 target_fps = float(args.target_fps)
@@ -57,10 +63,27 @@ config['audio_window_stride'] = 1
 
 audio_handler = AudioHandler(config)
 
-# Loop over found audiofiles
+# Output directory per audiofile
+if args.out_path[-1] != '/':
+    args.out_path += '/'
+out_paths = []
 for audiofile in audiofiles:
-    if args.out_path[-1] != '/':
-        args.out_path += '/'
     out_path = args.out_path + audiofile.split('/')[-1].split('.')[0] + '/'
     os.makedirs(out_path, exist_ok=True)
-    audio_feature_extractor(audio_handler, audiofile, target_fps, out_path)
+    out_paths.append(out_path)
+
+if args.chunk_seconds is not None:
+    for audiofile, out_path in zip(audiofiles, out_paths):
+        audio_stream_feature_extractor(audio_handler, audiofile, target_fps, out_path,
+                                       per_frame=args.per_frame, chunk_seconds=args.chunk_seconds,
+                                       overlap_seconds=args.overlap_seconds)
+elif args.batch_size > 1:
+    audio_batch_feature_extractor(audio_handler, audiofiles, target_fps, out_paths,
+                                  per_frame=args.per_frame, batch_size=args.batch_size,
+                                  n_workers=args.n_workers)
+else:
+    # Loop over found audiofiles
+    for audiofile, out_path in zip(audiofiles, out_paths):
+        audio_feature_extractor(audio_handler, audiofile, target_fps, out_path, per_frame=args.per_frame)
+
+audio_handler.close()
@@ -1,62 +1,183 @@
-'''
-Max-Planck-Gesellschaft zur Foerderung der Wissenschaften e.V. (MPG) is holder of all proprietary rights on this
-computer program.
-
-You can only use this computer program if you have closed a license agreement with MPG or you get the right to use
-the computer program from someone who is authorized to grant you that right.
-
-Any use of the computer program without a valid license is prohibited and liable to prosecution.
-
-Copyright 2019 Max-Planck-Gesellschaft zur Foerderung der Wissenschaften e.V. (MPG). acting on behalf of its
-Max Planck Institute for Intelligent Systems and the Max Planck Institute for Biological Cybernetics.
-All rights reserved.
-
-More information about VOCA is available at http://voca.is.tue.mpg.de.
-For comments or questions, please email us at voca@tue.mpg.de
-'''
-
-
-import numpy as np
-import time
-
-from scipy.io import wavfile
-
-
-def process_audio(audio_handler, audio, sample_rate, target_fps):
-    tmp_audio = {'subj': {'seq': {'audio': audio, 'sample_rate': sample_rate}}}
-    return audio_handler.process(tmp_audio, target_fps)['subj']['seq']['audio']
-
-
-def audio_feature_extractor(audio_handler, audio_fname, target_fps, out_path):
-    print('Load audio file')
-    sample_rate, audio = wavfile.read(audio_fname)
-    if audio.ndim != 1:
-        print('Audio has multiple channels, only first channel is considered')
-        audio = audio[:, 0]
-
-    print('Process audio')
-
-    # torch.cuda.synchronize()
-    a = time.perf_counter()
-    processed_audio = process_audio(audio_handler, audio, sample_rate, target_fps)
-    b = time.perf_counter()
-    print('processing time:', 1000.0 * (b - a) / processed_audio.shape[0])
-
-    print('audio processed type:', type(processed_audio))
-    print('audio processed shape:', processed_audio.shape)
-
-    num_frames = processed_audio.shape[0]
-    print('num_frames:', num_frames)
-
-    # Visualize
-    # import matplotlib.pyplot as plt
-    # from matplotlib import cm
-    # fig, ax = plt.subplots()
-    # mfcc_data = np.swapaxes(processed_audio[0], 0, 1)
-    # cax = ax.imshow(processed_audio[0], interpolation='nearest', cmap=cm.coolwarm, origin='lower')
-    # plt.show()
-
-    for i in range(1, num_frames + 1):
-        fname = out_path + '/' + str(i).zfill(5) + '.deepspeech'
-        np.save(fname, processed_audio[i - 1])
-        # np.savetxt(fname, processed_audio[i], delimiter=',')
+'''
+Max-Planck-Gesellschaft zur Foerderung der Wissenschaften e.V. (MPG) is holder of all proprietary rights on this
+computer program.
+
+You can only use this computer program if you have closed a license agreement with MPG or you get the right to use
+the computer program from someone who is authorized to grant you that right.
+
+Any use of the computer program without a valid license is prohibited and liable to prosecution.
+
+Copyright 2019 Max-Planck-Gesellschaft zur Foerderung der Wissenschaften e.V. (MPG). acting on behalf of its
+Max Planck Institute for Intelligent Systems and the Max Planck Institute for Biological Cybernetics.
+All rights reserved.
+
+More information about VOCA is available at http://voca.is.tue.mpg.de.
+For comments or questions, please email us at voca@tue.mpg.de
+'''
+
+
+import numpy as np
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from scipy.io import wavfile
+from utils.audio_handler import prepare_input
+
+
+def process_audio(audio_handler, audio, sample_rate, target_fps):
+    tmp_audio = {'subj': {'seq': {'audio': audio, 'sample_rate': sample_rate}}}
+    return audio_handler.process(tmp_audio, target_fps)['subj']['seq']['audio']
+
+
+def audio_feature_extractor(audio_handler, audio_fname, target_fps, out_path, per_frame=False):
+    """
+    Writes the features of all frames into one array out_path/deepspeech.packed.npy
+    of shape [num_frames, 16, 29] (row i belongs to frame i + 1). With per_frame,
+    the legacy layout with one file per frame (00001.deepspeech.npy, ...) is
+    written instead.
+    """
+    print('Load audio file')
+    sample_rate, audio = wavfile.read(audio_fname)
+    if audio.ndim != 1:
+        print('Audio has multiple channels, only first channel is considered')
+        audio = audio[:, 0]
+
+    print('Process audio')
+
+    # torch.cuda.synchronize()
+    a = time.perf_counter()
+    processed_audio = process_audio(audio_handler, audio, sample_rate, target_fps)
+    b = time.perf_counter()
+    print('processing time:', 1000.0 * (b - a) / processed_audio.shape[0])
+
+    print('audio processed type:', type(processed_audio))
+    print('audio processed shape:', processed_audio.shape)
+
+    num_frames = processed_audio.shape[0]
+    print('num_frames:', num_frames)
+
+    # Visualize
+    # import matplotlib.pyplot as plt
+    # from matplotlib import cm
+    # fig, ax = plt.subplots()
+    # mfcc_data = np.swapaxes(processed_audio[0], 0, 1)
+    # cax = ax.imshow(processed_audio[0], interpolation='nearest', cmap=cm.coolwarm, origin='lower')
+    # plt.show()
+
+    save_features(processed_audio, out_path, per_frame)
+
+
+def save_features(processed_audio, out_path, per_frame=False, start=0):
+    if not per_frame:
+        np.save(out_path + '/deepspeech.packed.npy', processed_audio.astype(np.float32))
+        return
+
+    for i in range(1, processed_audio.shape[0] + 1):
+        fname = out_path + '/' + str(start + i).zfill(5) + '.deepspeech'
+        np.save(fname, processed_audio[i - 1])
+        # np.savetxt(fname, processed_audio[i], delimiter=',')
+
+
+def audio_stream_feature_extractor(audio_handler, audio_fname, target_fps, out_path,
+                                   per_frame=False, chunk_seconds=10., overlap_seconds=2.):
+    """
+    Like audio_feature_extractor(), but processes the audio in chunks (see
+    AudioHandler.stream_deepspeech()) and writes the features as they are
+    computed, for audio of hours. The packed file is written under a
+    temporary name and only renamed when it is complete, an interrupted run
+    leaves no partly filled deepspeech.packed.npy behind.
+    """
+    sample_rate, audio = read_audio(audio_fname, mmap=True)
+    n_windows = audio_handler.num_windows(len(audio), sample_rate, target_fps)
+    print(f"Process audio in chunks of {chunk_seconds} s, {n_windows} frames")
+
+    if not per_frame:
+        path = out_path + '/deepspeech.packed.npy'
+        out = np.lib.format.open_memmap(
+            path + '.tmp', mode='w+', dtype=np.float32,
+            shape=(n_windows, audio_handler.audio_window_size, audio_handler.num_audio_features))
+
+    a = time.perf_counter()
+    i = 0
+    for windows in audio_handler.stream_deepspeech(audio, sample_rate, target_fps,
+                                                   chunk_seconds, overlap_seconds):
+        if per_frame:
+            save_features(windows, out_path, per_frame, start=i)
+        else:
+            out[i:i + len(windows)] = windows
+        i += len(windows)
+        print(f"{i}/{n_windows} frames, {i / (time.perf_counter() - a):.1f} frames/s")
+
+    if not per_frame:
+        out.flush()
+        del out
+        if i != n_windows:
+            raise RuntimeError(f"Extracted {i} of {n_windows} frames, {path}.tmp is incomplete")
+        os.replace(path + '.tmp', path)
+
+
+def read_audio(audio_fname, mmap=False):
+    sample_rate, audio = wavfile.read(audio_fname, mmap=mmap)
+    if audio.ndim != 1:
+        audio = audio[:, 0]
+    return sample_rate, audio
+
+
+def load_input(audio_fname):
+    """ Reads a wav file and computes the input of the graph (in a worker process) """
+    sample_rate, audio = read_audio(audio_fname)
+    return prepare_input(audio, sample_rate), audio.shape[0], sample_rate
+
+
+def prefetch(pool, fn, args, n):
+    """ Like pool.map, but with at most n results in flight or not yet consumed """
+    futures = deque()
+    for arg in args:
+        futures.append(pool.submit(fn, arg))
+        if len(futures) >= n:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def audio_batch_feature_extractor(audio_handler, audio_fnames, target_fps, out_paths,
+                                  per_frame=False, batch_size=16, n_workers=None):
+    """
+    Extracts the features of many files. Reading, resampling and MFCC run in
+    n_workers processes (default: number of cpus, 0: in this process) while
+    the graph runs on batches of up to batch_size utterances in one session.
+    Files are sorted by length, so the utterances of a batch need little
+    padding. Outputs are the same as for audio_feature_extractor().
+    """
+    # Only the wav headers are read here
+    lengths = [len(read_audio(f, mmap=True)[1]) for f in audio_fnames]
+    order = sorted(range(len(audio_fnames)), key=lambda i: lengths[i])
+
+    fnames = [audio_fnames[i] for i in order]
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_workers > 0:
+        pool = ProcessPoolExecutor(n_workers)
+        inputs = prefetch(pool, load_input, fnames, 2 * batch_size + n_workers)
+    else:
+        pool = None
+        inputs = map(load_input, fnames)
+
+    a = time.perf_counter()
+    n_frames = 0
+    try:
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            batch_inputs = [next(inputs) for _ in batch]
+
+            for i, processed_audio in zip(batch, audio_handler.process_batch(batch_inputs, target_fps)):
+                save_features(processed_audio, out_paths[i], per_frame)
+                n_frames += processed_audio.shape[0]
+
+            print(f"{start + len(batch)}/{len(order)} files, "
+                  f"{n_frames / (time.perf_counter() - a):.1f} frames/s")
+    finally:
+        if pool is not None:
+            pool.shutdown()
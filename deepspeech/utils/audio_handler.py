@@ -19,25 +19,193 @@ import copy
 import resampy
 import numpy as np
 import tensorflow as tf
+from math import gcd
 from python_speech_features import mfcc
 
+# mfcc window and step at 16 kHz, 25 ms and 10 ms
+MFCC_WINDOW = 400
+MFCC_STEP = 160
+
 
 def interpolate_features(features, input_rate, output_rate, output_len=None):
-    num_features = features.shape[1]
+    """
+    Linear interpolation of all feature columns at once. Bit-identical to
+    calling np.interp per column (same interval search and the same
+    arithmetic), for finite features.
+    """
     input_len = features.shape[0]
     seq_len = input_len / float(input_rate)
     if output_len is None:
         output_len = int(seq_len * output_rate)
-    input_timestamps = np.arange(input_len) / float(input_rate)
-    output_timestamps = np.arange(output_len) / float(output_rate)
-    output_features = np.zeros((output_len, num_features))
-    for feat in range(num_features):
-        output_features[:, feat] = np.interp(output_timestamps,
-                                             input_timestamps,
-                                             features[:, feat])
+    return interpolate_frames(features, input_rate, output_rate, np.arange(output_len))
+
+
+def interpolate_frames(features, input_rate, output_rate, frames, offset=0):
+    """
+    Interpolates the output frames with the given indices. Row i of features
+    is input frame offset + i, the result is the same as interpolating the
+    whole sequence as long as the inputs around the requested frames are
+    given (and for frames beyond the end, the last input).
+    """
+    input_len = features.shape[0]
+    input_timestamps = np.arange(offset, offset + input_len) / float(input_rate)
+    output_timestamps = frames / float(output_rate)
+    features = np.asarray(features, dtype=np.float64)
+
+    # Interval of every output timestamp, input_timestamps[j] <= t < input_timestamps[j + 1]
+    j = np.searchsorted(input_timestamps, output_timestamps, side='right') - 1
+    j = np.clip(j, 0, input_len - 1)
+    output_features = features[j]
+
+    # Like np.interp, timestamps on or beyond an input timestamp take its value
+    inner = (j < input_len - 1) & (output_timestamps != input_timestamps[j])
+    j = j[inner]
+    slope = (features[j + 1] - features[j]) / \
+        (input_timestamps[j + 1] - input_timestamps[j])[:, np.newaxis]
+    output_features[inner] = slope * (output_timestamps[inner] - input_timestamps[j])[:, np.newaxis] + features[j]
+
     return output_features
 
 
+def make_windows(features, window_size, window_stride):
+    """
+    Zero-pads features [n, num_features] by window_size / 2 on both sides and
+    returns the windows as read-only view, shape [n_windows, window_size, num_features]
+    """
+    zero_pad = np.zeros((int(window_size / 2), features.shape[1]))
+    features = np.concatenate((zero_pad, features, zero_pad), axis=0)
+
+    # Same windows as range(0, len(features) - window_size, window_stride)
+    n_windows = len(range(0, features.shape[0] - window_size, window_stride))
+    return strided_windows(features, n_windows, window_size, window_stride)
+
+
+def strided_windows(features, n_windows, window_size, window_stride):
+    """ Read-only view of n_windows windows of features, starting at row 0 """
+    return np.lib.stride_tricks.as_strided(
+        features,
+        (n_windows, window_size, features.shape[1]),
+        (window_stride * features.strides[0], features.strides[0], features.strides[1]),
+        writeable=False)
+
+
+def audio_to_input_vector(audio, fs, numcep, numcontext):
+    # Get mfcc coefficients
+    features = mfcc(audio, samplerate=fs, numcep=numcep)
+
+    # We only keep every second feature (BiRNN stride = 2)
+    features = features[::2]
+
+    # One stride per time step in the input
+    num_strides = len(features)
+
+    # Add empty initial and final contexts
+    empty_context = np.zeros((numcontext, numcep), dtype=features.dtype)
+    features = np.concatenate((empty_context, features, empty_context))
+
+    # Create a view into the array with overlapping strides of size
+    # numcontext (past) + 1 (present) + numcontext (future)
+    window_size = 2 * numcontext + 1
+    train_inputs = np.lib.stride_tricks.as_strided(
+        features,
+        (num_strides, window_size, numcep),
+        (features.strides[0], features.strides[0], features.strides[1]),
+        writeable=False)
+
+    # Flatten the second and third dimensions
+    train_inputs = np.reshape(train_inputs, [num_strides, -1])
+
+    train_inputs = np.copy(train_inputs)
+    train_inputs = (train_inputs - np.mean(train_inputs)) / np.std(train_inputs)
+
+    # Return results
+    return train_inputs
+
+
+def prepare_input(audio_sample, sample_rate, n_input=26, n_context=9):
+    """
+    Resamples the audio to 16 kHz and computes the normalized MFCC input of
+    the DeepSpeech graph. Needs no tensorflow session, so it can run in
+    worker processes.
+    """
+    resampled_audio = resampy.resample(audio_sample.astype(float), sample_rate, 16000)
+    return audio_to_input_vector(resampled_audio.astype('int16'), 16000, n_input, n_context)
+
+
+def resample_chunks(audio, sample_rate, chunk_seconds=10., margin_seconds=0.1):
+    """
+    Yields the audio resampled to 16 kHz in consecutive chunks. Every chunk
+    starts at an input sample which maps to a whole output sample and is
+    resampled together with margin_seconds of its neighbours, which covers
+    the support of the resampling filter. The chunks add up to the resampled
+    whole audio, equal up to float rounding.
+    """
+    if sample_rate == 16000:
+        for start in range(0, len(audio), int(chunk_seconds * 16000)):
+            yield audio[start:start + int(chunk_seconds * 16000)].astype(float)
+        return
+
+    step = sample_rate // gcd(sample_rate, 16000)
+    chunk = max(1, int(chunk_seconds * sample_rate) // step) * step
+    margin = (int(margin_seconds * sample_rate) // step + 1) * step
+    for start in range(0, len(audio), chunk):
+        lo = max(0, start - margin)
+        hi = min(len(audio), start + chunk + margin)
+        resampled = resampy.resample(audio[lo:hi].astype(float), sample_rate, 16000)
+        first = (start - lo) * 16000 // sample_rate
+        last = (min(start + chunk, len(audio)) - lo) * 16000 // sample_rate
+        yield resampled[first:last]
+
+
+def mfcc_chunks(chunks, numcep, preemph=0.97):
+    """
+    Yields the mfcc features of consecutive chunks of 16 kHz int16 audio,
+    together exactly mfcc() of the whole audio. The audio is cut at frame
+    boundaries, the preemphasis continues from the previous sample and the
+    last frames, which mfcc() pads with zeros, come with the last chunk.
+    Every yielded block but the last has an even number of frames.
+    """
+    buf = np.zeros(0, dtype='int16')
+    prev = None
+    for chunk in chunks:
+        buf = np.concatenate((buf, chunk))
+
+        # Leave more than one window for the end
+        n = (len(buf) - MFCC_WINDOW - 1) // MFCC_STEP
+        n -= n % 2
+        if n > 0:
+            yield mfcc_frames(buf[:(n - 1) * MFCC_STEP + MFCC_WINDOW], prev, numcep, preemph)
+            prev = buf[n * MFCC_STEP - 1]
+            buf = buf[n * MFCC_STEP:]
+
+    yield mfcc_frames(buf, prev, numcep, preemph)
+
+
+def mfcc_frames(audio, prev, numcep, preemph):
+    # Preemphasis of the chunk, the first sample continues from prev
+    first = audio[0] if prev is None else audio[0] - preemph * prev
+    emphasized = np.append(first, audio[1:] - preemph * audio[:-1])
+    return mfcc(emphasized, samplerate=16000, numcep=numcep, preemph=0)
+
+
+def input_statistics(features, numcontext):
+    """
+    Mean and standard deviation over all input vectors of
+    audio_to_input_vector(), computed from the mfcc features [n, numcep]
+    without building the input vectors. Row t of features appears in
+    counts[t] input vectors, the zero contexts make up the rest.
+    """
+    n, numcep = features.shape
+    t = np.arange(n)
+    counts = np.minimum(t + numcontext, n - 1) - np.maximum(0, t - numcontext) + 1
+    size = n * (2 * numcontext + 1) * numcep
+    num_zeros = size - counts.sum() * numcep
+
+    mean = np.dot(counts, features.sum(axis=1)) / size
+    var = (np.dot(counts, ((features - mean) ** 2).sum(axis=1)) + num_zeros * mean ** 2) / size
+    return mean, np.sqrt(var)
+
+
 class AudioHandler:
     def __init__(self, config):
         self.config = config
@@ -53,6 +221,24 @@ class AudioHandler:
         self.graph = tf.get_default_graph()
         tf.import_graph_def(self.graph_def, name="deepspeech")
 
+        self.input_tensor = self.graph.get_tensor_by_name('deepspeech/input_node:0')
+        self.seq_length = self.graph.get_tensor_by_name('deepspeech/input_lengths:0')
+        self.layer_6 = self.graph.get_tensor_by_name('deepspeech/logits:0')
+
+        # Opened on first use and kept alive for all following calls
+        self._sess = None
+
+    @property
+    def sess(self):
+        if self._sess is None:
+            self._sess = tf.Session(graph=self.graph)
+        return self._sess
+
+    def close(self):
+        if self._sess is not None:
+            self._sess.close()
+            self._sess = None
+
     def process(self, audio, target_fps=60):
         if self.audio_feature_type.lower() == "none":
             return None
@@ -61,97 +247,175 @@ class AudioHandler:
         else:
             raise NotImplementedError("Audio features not supported")
 
-    def convert_to_deepspeech(self, audio, target_fps=60):
-        def audioToInputVector(audio, fs, numcep, numcontext):
-            # Get mfcc coefficients
-            features = mfcc(audio, samplerate=fs, numcep=numcep)
-
-            # We only keep every second feature (BiRNN stride = 2)
-            features = features[::2]
-
-            # One stride per time step in the input
-            num_strides = len(features)
-
-            # Add empty initial and final contexts
-            empty_context = np.zeros((numcontext, numcep), dtype=features.dtype)
-            features = np.concatenate((empty_context, features, empty_context))
-
-            # Create a view into the array with overlapping strides of size
-            # numcontext (past) + 1 (present) + numcontext (future)
-            window_size = 2 * numcontext + 1
-            train_inputs = np.lib.stride_tricks.as_strided(
-                features,
-                (num_strides, window_size, numcep),
-                (features.strides[0], features.strides[0], features.strides[1]),
-                writeable=False)
-
-            # Flatten the second and third dimensions
-            train_inputs = np.reshape(train_inputs, [num_strides, -1])
-
-            train_inputs = np.copy(train_inputs)
-            train_inputs = (train_inputs - np.mean(train_inputs)) / np.std(train_inputs)
-
-            # Return results
-            return train_inputs
+    def run_graph(self, input_vectors):
+        """
+        Runs the graph on a batch of input vectors of different lengths. The
+        inputs are zero-padded to the longest one, the BiRNN only runs over
+        the valid time steps of every input (input_lengths).
+
+        :param input_vectors: list of np.array, shapes [n_i, 494]
+        :returns: list of np.array, shapes [n_i, 29]
+        """
+        lengths = [len(x) for x in input_vectors]
+        batch = np.zeros((len(input_vectors), max(lengths), input_vectors[0].shape[1]),
+                         dtype=input_vectors[0].dtype)
+        for i, x in enumerate(input_vectors):
+            batch[i, :len(x)] = x
+
+        network_output = self.sess.run(self.layer_6, feed_dict={self.input_tensor: batch,
+                                                                self.seq_length: lengths})
+
+        # Logits are time major, [time, batch, 29]
+        return [network_output[:n, i] for i, n in enumerate(lengths)]
+
+    def make_windows(self, network_output, num_samples, sample_rate, target_fps):
+        """ Resamples the network output to target_fps and cuts it into windows """
+        # Resample network output from 50 fps to target_fps fps
+        audio_len_s = float(num_samples) / sample_rate
+        num_frames = int(round(audio_len_s * target_fps))
+        network_output = interpolate_features(network_output, 50, target_fps,
+                                              output_len=num_frames)
+
+        # Make windows
+        return make_windows(network_output, self.audio_window_size, self.audio_window_stride)
+
+    def num_windows(self, num_samples, sample_rate, target_fps):
+        """ Number of windows of an utterance of num_samples samples """
+        num_frames = int(round(float(num_samples) / sample_rate * target_fps))
+        pad = int(self.audio_window_size / 2)
+        return len(range(0, num_frames + 2 * pad - self.audio_window_size, self.audio_window_stride))
+
+    def stream_deepspeech(self, audio_sample, sample_rate, target_fps=60,
+                          chunk_seconds=10., overlap_seconds=2.):
+        """
+        Computes the features of a long utterance chunk by chunk and yields
+        the windows [n, window_size, 29] as soon as they are complete. All
+        yielded windows together correspond to the output of
+        convert_to_deepspeech(), memory does not grow with the audio length
+        apart from the mfcc features (26 values per 20 ms).
+
+        Resampling and mfcc run over chunks of chunk_seconds. The mfcc
+        features are exact, the resampling equal up to float rounding. The
+        input vectors are normalized with the statistics of the whole
+        utterance, so the first windows come after this first pass.
+
+        The graph runs on chunks of chunk_seconds with overlap_seconds of
+        context on both sides, which also covers the numcontext = 9 steps of
+        every input vector, and only the center of every chunk is kept. The
+        BiRNN of DeepSpeech sees the whole utterance in
+        convert_to_deepspeech(). In chunks, its state at the borders only
+        depends on the overlap, so the features are close to, but not exactly
+        the same as, those of the whole utterance. The interpolation to
+        target_fps and the windows are stitched exactly at chunk borders.
+        """
+        n_input = 26
+        n_context = 9
+        n_windows = self.num_windows(len(audio_sample), sample_rate, target_fps)
+        num_frames = int(round(float(len(audio_sample)) / sample_rate * target_fps))
+        size = self.audio_window_size
+        stride = self.audio_window_stride
+
+        # First pass, mfcc features (BiRNN stride = 2) and their statistics
+        resampled = (c.astype('int16') for c in resample_chunks(audio_sample, sample_rate, chunk_seconds))
+        features = np.concatenate([f[::2] for f in mfcc_chunks(resampled, n_input)])
+        mean, std = input_statistics(features, n_context)
+
+        # Input vectors as view, see audio_to_input_vector()
+        num_strides = len(features)
+        empty_context = np.zeros((n_context, n_input), dtype=features.dtype)
+        features = np.concatenate((empty_context, features, empty_context))
+        inputs = strided_windows(features, num_strides, 2 * n_context + 1, 1)
+
+        chunk = max(1, int(chunk_seconds * 50))
+        overlap = int(overlap_seconds * 50)
+
+        # logits[i] is graph step logits_offset + i, frames[i] is frame
+        # frames_offset + i of the zero-padded target_fps features
+        logits = np.zeros((0, self.num_audio_features))
+        logits_offset = 0
+        frames = np.zeros((int(size / 2), self.num_audio_features))
+        frames_offset = 0
+        next_frame = 0
+        next_window = 0
+
+        for start in range(0, num_strides, chunk):
+            lo = max(0, start - overlap)
+            hi = min(num_strides, start + chunk + overlap)
+            input_vector = (np.reshape(inputs[lo:hi], [hi - lo, -1]) - mean) / std
+            network_output = self.run_graph([input_vector])[0]
+            logits = np.concatenate((logits, network_output[start - lo:min(start + chunk, hi) - lo]))
+            last = start + chunk >= num_strides
+
+            # Resample network output from 50 fps to target_fps fps, frames
+            # before the last graph step are final
+            if last:
+                end = num_frames
+            else:
+                last_timestamp = (logits_offset + len(logits) - 1) / 50.
+                end = next_frame + np.searchsorted(
+                    np.arange(next_frame, num_frames) / float(target_fps), last_timestamp, side='left')
+            frame_indices = np.arange(next_frame, end)
+            frames = np.concatenate((frames, interpolate_frames(
+                logits, 50, target_fps, frame_indices, logits_offset)))
+            next_frame = end
+            if last:
+                frames = np.concatenate((frames, np.zeros((int(size / 2), frames.shape[1]))))
+
+            # Drop the graph steps before the next frame
+            input_timestamps = np.arange(logits_offset, logits_offset + len(logits)) / 50.
+            drop = max(0, np.searchsorted(input_timestamps, next_frame / float(target_fps), side='right') - 1)
+            logits = logits[drop:]
+            logits_offset += drop
+
+            # Yield the complete windows
+            end_window = n_windows
+            if not last:
+                available = frames_offset + len(frames) - size
+                end_window = min(n_windows, available // stride + 1) if available >= 0 else 0
+            if end_window > next_window:
+                first = next_window * stride - frames_offset
+                yield np.array(strided_windows(frames[first:], end_window - next_window, size, stride))
+                next_window = end_window
+
+                drop = min(len(frames), next_window * stride - frames_offset)
+                frames = frames[drop:]
+                frames_offset += drop
+
+    def process_batch(self, inputs, target_fps=60):
+        """
+        Computes the features of several utterances with one graph call
+
+        :param inputs: list of (input_vector, num_samples, sample_rate), with
+                       input_vector as returned by prepare_input()
+        :returns: list of np.array, shapes [num_frames_i, window_size, 29]
+        """
+        network_outputs = self.run_graph([x for x, _, _ in inputs])
+        return [self.make_windows(network_output, num_samples, sample_rate, target_fps)
+                for network_output, (_, num_samples, sample_rate) in zip(network_outputs, inputs)]
 
+    def convert_to_deepspeech(self, audio, target_fps=60):
         if type(audio) == dict:
             pass
         else:
             raise ValueError('Wrong type for audio')
 
-        # Load graph and place_hoders
-        # with tf.gfile.GFile(self.config['deepspeech_graph_fname'], "rb") as f:
-        #     graph_def = tf.GraphDef()
-        #     graph_def.ParseFromString(f.read())
+        processed_audio = copy.deepcopy(audio)
+        for subj in audio.keys():
+            for seq in audio[subj].keys():
+                print('process %s - %s' % (subj, seq))
 
-        # graph = tf.get_default_graph()
-        # tf.import_graph_def(graph_def, name="deepspeech")
-        # input_tensor = graph.get_tensor_by_name('deepspeech/input_node:0')
-        # seq_length = graph.get_tensor_by_name('deepspeech/input_lengths:0')
-        # layer_6 = graph.get_tensor_by_name('deepspeech/logits:0')
+                audio_sample = audio[subj][seq]['audio']
+                sample_rate = audio[subj][seq]['sample_rate']
+                print(f"raw {audio_sample.shape}")
+                input_vector = prepare_input(audio_sample, sample_rate)
+                print(f"input vector {input_vector.shape}")
 
-        input_tensor = self.graph.get_tensor_by_name('deepspeech/input_node:0')
-        seq_length = self.graph.get_tensor_by_name('deepspeech/input_lengths:0')
-        layer_6 = self.graph.get_tensor_by_name('deepspeech/logits:0')
+                network_output = self.run_graph([input_vector])[0]
+                print(f"network output {network_output.shape}")
 
-        n_input = 26
-        n_context = 9
+                windows = self.make_windows(network_output, audio_sample.shape[0],
+                                            sample_rate, target_fps)
+                print(f"windows {windows.shape}")
 
-        processed_audio = copy.deepcopy(audio)
-        # with tf.Session(graph=graph) as sess:
-        with tf.Session(graph=self.graph) as sess:
-            for subj in audio.keys():
-                for seq in audio[subj].keys():
-                    print('process %s - %s' % (subj, seq))
-
-                    audio_sample = audio[subj][seq]['audio']
-                    sample_rate = audio[subj][seq]['sample_rate']
-                    print(f"raw {audio_sample.shape}")
-                    resampled_audio = resampy.resample(audio_sample.astype(float), sample_rate, 16000)
-                    print(f"resampled {resampled_audio.shape}")
-                    input_vector = audioToInputVector(resampled_audio.astype('int16'), 16000, n_input, n_context)
-                    print(f"input vector {input_vector.shape}")
-
-                    # import pdb; pdb.set_trace()
-
-                    network_output = sess.run(layer_6, feed_dict={input_tensor: input_vector[np.newaxis, ...],
-                                                                  seq_length: [input_vector.shape[0]]})
-                    print(f"network output {network_output.shape}")
-
-                    # Resample network output from 50 fps to target_fps fps
-                    audio_len_s = float(audio_sample.shape[0]) / sample_rate
-                    num_frames = int(round(audio_len_s * target_fps))
-                    network_output = interpolate_features(network_output[:, 0], 50, target_fps,
-                                                          output_len=num_frames)
-                    print(f"network output 25fps {network_output.shape}")
-
-                    # Make windows
-                    zero_pad = np.zeros((int(self.audio_window_size / 2), network_output.shape[1]))
-                    network_output = np.concatenate((zero_pad, network_output, zero_pad), axis=0)
-                    windows = []
-                    for window_index in range(0, network_output.shape[0] - self.audio_window_size, self.audio_window_stride):
-                        windows.append(network_output[window_index:window_index + self.audio_window_size])
-                    print(f"windows {np.array(windows).shape}")
-
-                    processed_audio[subj][seq]['audio'] = np.array(windows)
+                processed_audio[subj][seq]['audio'] = windows
         return processed_audio
@@ -274,6 +274,8 @@ if __name__ == '__main__':
     parser.add_argument('--gpu', type=int)
     parser.add_argument('--verbose', action="store_true")
     parser.add_argument('--audio_type', type=str, default='deepspeech')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help="Generator precision, bf16 on CPU, fp16 or bf16 on GPU")
     parser.add_argument('--audio_multiplier', type=float, default=2.0)
     parser.add_argument('--audio_truncation', type=float, default=0.8)
     args = parser.parse_args()
@@ -285,7 +287,8 @@ if __name__ == '__main__':
         model_path=args.model_path,
         device=device,
         audio_type=args.audio_type,
-        T=8
+        T=8,
+        precision=args.precision
     )
 
     dataset = args.dataset
@@ -0,0 +1,162 @@
+"""
+Exports the inference graph of AudioStyleNet, audio encoder plus generator
+for a fixed window length T, batch size and render size, as TorchScript
+module and as ONNX file. upfirdn2d and fused_leaky_relu are recorded with
+their native implementations, the exported graph has no custom ops.
+
+The graph maps a batch of audio windows and input latents to video frames:
+
+    audio          [batch_size, T, 16, 29]
+    input_latent   [batch_size, 18, 512]
+    -> frames      [batch_size, 3, 256, 256] in [0, 1]
+
+audio_multiplier and audio_truncation are fixed at export, directions are
+not supported. After the export, the outputs of both files are compared to
+eager mode on new random inputs.
+
+usage:
+    python export_audiostylenet.py --model_path model/audiostylenet.pt --out model/audiostylenet
+    model = torch.jit.load('model/audiostylenet.ts.pt')
+"""
+
+import argparse
+import sys
+import torch
+
+from my_models import models
+from my_models.style_gan_2 import Generator
+from op import backend
+from torch import nn
+from utils.utils import downsample_256
+
+
+class InferenceGraph(nn.Module):
+    """
+    Audio encoder, add_offset, generator and normalization of AudioStyleNet
+    as one module without Python control flow over the inputs.
+
+    args:
+        g (Generator): with latent_avg and noises
+        audio_encoder (AudioExpressionNet3):
+        audio_multiplier (float):
+        audio_truncation (float):
+        render_size (int): see AudioStyleNet.generate()
+    """
+    def __init__(self, g, audio_encoder, audio_multiplier=2., audio_truncation=.8,
+                 render_size=1024):
+        super().__init__()
+        self.g = g
+        self.audio_encoder = audio_encoder
+        self.audio_multiplier = audio_multiplier
+        self.audio_truncation = audio_truncation
+        self.render_size = render_size
+
+        # Constant noise, stored with the exported module
+        self.register_buffer('latent_avg', g.latent_avg.detach().clone())
+        self.n_noises = len(g.noises)
+        for i, noise in enumerate(g.noises):
+            self.register_buffer(f'noise{i}', noise.detach().clone())
+
+    def forward(self, audio, input_latent):
+        latent_offset = self.audio_encoder(audio, input_latent[:, 4:8])
+
+        # AudioStyleNet.add_offset without in-place updates
+        rows = input_latent[:, 4:8] + latent_offset * self.audio_multiplier
+        rows = self.latent_avg + self.audio_truncation * (rows - self.latent_avg)
+        latent = torch.cat((input_latent[:, :4], rows, input_latent[:, 8:]), dim=1)
+
+        noise = [getattr(self, f'noise{i}') for i in range(self.n_noises)]
+        img, _ = self.g([latent], input_is_latent=True, noise=noise, size=self.render_size)
+        img = downsample_256(img)
+
+        # Same as make_grid(normalize=True, range=(-1, 1))
+        return (img.clamp(-1., 1.) + 1.) / 2.
+
+
+def example_inputs(graph, batch_size, device, seed=0):
+    torch.manual_seed(seed)
+    audio = torch.randn(batch_size, graph.audio_encoder.T, 16, 29, device=device)
+    input_latent = graph.latent_avg + 0.5 * torch.randn(batch_size, 18, 512, device=device)
+    return audio, input_latent
+
+
+def export(graph, inputs, out, opset=17):
+    """ Writes <out>.ts.pt and <out>.onnx, returns the TorchScript module """
+    graph = graph.eval()
+    with torch.no_grad(), backend.native():
+        traced = torch.jit.trace(graph, inputs, check_trace=False)
+        traced = torch.jit.freeze(traced)
+        traced.save(out + '.ts.pt')
+        print(f"Saved TorchScript module to {out}.ts.pt")
+
+        torch.onnx.export(graph, inputs, out + '.onnx', opset_version=opset,
+                          input_names=['audio', 'input_latent'], output_names=['frames'])
+        print(f"Saved ONNX model to {out}.onnx")
+    return traced
+
+
+def parity(graph, traced, out, inputs):
+    """ Max absolute difference of the exported models to eager mode """
+    with torch.no_grad():
+        ref = graph(*inputs)
+        diffs = {'torchscript': (traced(*inputs) - ref).abs().max().item()}
+
+    try:
+        import onnxruntime
+    except ImportError:
+        print("onnxruntime is not installed, skipping the ONNX parity check")
+        return diffs
+
+    session = onnxruntime.InferenceSession(out + '.onnx', providers=['CPUExecutionProvider'])
+    frames = session.run(None, {'audio': inputs[0].cpu().numpy(),
+                                'input_latent': inputs[1].cpu().numpy()})[0]
+    diffs['onnx'] = (torch.from_numpy(frames) - ref.cpu()).abs().max().item()
+    return diffs
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model/audiostylenet.pt')
+    parser.add_argument('--out', type=str, default='model/audiostylenet')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--T', type=int, default=8)
+    parser.add_argument('--render_size', type=int, default=1024, choices=[256, 512, 1024])
+    parser.add_argument('--audio_multiplier', type=float, default=2.0)
+    parser.add_argument('--audio_truncation', type=float, default=0.8)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help="Maximum difference of the exported frames to eager mode")
+    parser.add_argument('--random_weights', action='store_true',
+                        help="Export an untrained model, e.g. to test the export")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+
+    if args.random_weights:
+        g = Generator(1024, 512, 8)
+        g.latent_avg = torch.zeros(512)
+        g.noises = g.make_noise()
+        audio_encoder = models.AudioExpressionNet3(args.T, pretrained=False)
+    else:
+        from audiostylenet import AudioStyleNet
+        model = AudioStyleNet(model_path=args.model_path, device=device, T=args.T)
+        g, audio_encoder = model.g, model.audio_encoder
+    g = g.eval().to(device)
+    audio_encoder = audio_encoder.eval().to(device)
+    for param in list(g.parameters()) + list(audio_encoder.parameters()):
+        param.requires_grad = False
+
+    graph = InferenceGraph(g, audio_encoder, args.audio_multiplier, args.audio_truncation,
+                           args.render_size).to(device)
+
+    traced = export(graph, example_inputs(graph, args.batch_size, device), args.out, args.opset)
+
+    # Compare on other inputs than the traced ones
+    diffs = parity(graph, traced, args.out, example_inputs(graph, args.batch_size, device, seed=1))
+    for name, diff in diffs.items():
+        print(f"{name}: max abs difference to eager mode {diff:.2e}")
+    if max(diffs.values()) > args.tolerance:
+        print(f"FAILED: difference above {args.tolerance}")
+        sys.exit(1)
@@ -33,9 +33,10 @@ def int_to_one_hot(labels):
 
 def downsample_256(img):
     b, c, h, w = img.shape
-    factor = h // 256
-    img = img.reshape(b, c, h // factor, factor, w // factor, factor)
-    img = img.mean([3, 5])
+    if h > 256:
+        factor = h // 256
+        img = img.reshape(b, c, h // factor, factor, w // factor, factor)
+        img = img.mean([3, 5])
     return img
 
 
@@ -176,6 +177,7 @@ def control_latent_video(args):
 
     # Init generator
     g = style_gan_2.PretrainedGenerator1024().eval().to(device)
+    g.set_precision(args.precision)
 
     save_dir = 'saves/control_latent/videos/'
     tmp_dir = save_dir + '.temp/'
@@ -219,6 +221,7 @@ def control_latent(args):
 
     # Init Generator
     g = style_gan_2.PretrainedGenerator1024().eval().to(device)
+    g.set_precision(args.precision)
 
     if args.input_latent == 'random':
         input_latent = g.get_latent(
@@ -257,7 +260,7 @@ def control_latent(args):
     os.system(f'rm -r {tmp_dir}')
 
 
-def demo():
+def demo(render_size=1024):
     """
     Matplotlib slideshow
     """
@@ -295,7 +298,8 @@ def demo():
     # Init generator
     g = style_gan_2.PretrainedGenerator1024().eval().to(device)
 
-    img, _ = g([input_latents], input_is_latent=True, noise=g.noises)
+    img, _ = g([input_latents], input_is_latent=True, noise=g.noises,
+               size=render_size)
     img = downsample_256(img)
     img = torch.stack([make_grid(i, normalize=True, range=(-1, 1))
                        for i in img])
@@ -323,7 +327,8 @@ def demo():
             latent[:, :8] = (latent + new_direction)[:, :8]
 
             # Decode
-            img, _ = g([latent], input_is_latent=True, noise=g.noises)
+            img, _ = g([latent], input_is_latent=True, noise=g.noises,
+                       size=render_size)
 
             # Downsample to 256 x 256
             img = downsample_256(img)
@@ -362,6 +367,10 @@ if __name__ == '__main__':
     parser.add_argument('--find_direction', action='store_true')
     parser.add_argument('--control_latent', action='store_true')
     parser.add_argument('--demo', action='store_true')
+    parser.add_argument('--render_size', type=int, default=1024,
+                        help="Generator output size in the demo, 256 is faster")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help="Generator precision when controlling latents")
     parser.add_argument('-i', '--input_latent', type=str,
                         default='saves/projected_images/generated.pt')
     parser.add_argument('-v', '--vec', type=str,
@@ -387,6 +396,6 @@ if __name__ == '__main__':
         else:
             control_latent(args)
     elif args.demo:
-        demo()
+        demo(args.render_size)
     else:
         raise NotImplementedError
@@ -22,7 +22,7 @@ MAPPING = {
 
 
 class AudioExpressionNet3(nn.Module):
-    def __init__(self, T):
+    def __init__(self, T, pretrained=True):
         super(AudioExpressionNet3, self).__init__()
 
         def _set_requires_grad_false(layer):
@@ -44,16 +44,18 @@ class AudioExpressionNet3(nn.Module):
         )
 
         # Load pre-trained convNet
-        self.convNet.load_state_dict(torch.load(
-            'model/audio2expression_convNet_justus.pt'))
+        if pretrained:
+            self.convNet.load_state_dict(torch.load(
+                'model/audio2expression_convNet_justus.pt'))
 
         latent_dim = 128
         pca_dim = 512
         self.latent_in = nn.Linear(self.expression_dim, latent_dim)
-        pca = 'model/audio_dataset_pca512.pt'
-        weight = torch.load(pca)[:latent_dim]
-        with torch.no_grad():
-            self.latent_in.weight = nn.Parameter(weight)
+        if pretrained:
+            pca = 'model/audio_dataset_pca512.pt'
+            weight = torch.load(pca)[:latent_dim]
+            with torch.no_grad():
+                self.latent_in.weight = nn.Parameter(weight)
 
         self.fc1 = nn.Linear(64, 128)
         self.adain1 = model_utils.LinearAdaIN(latent_dim, 128)
@@ -62,10 +64,11 @@ class AudioExpressionNet3(nn.Module):
         self.fc_out = nn.Linear(pca_dim, self.expression_dim)
 
         # Init fc_out with 512 precomputed pca components
-        pca = 'model/audio_dataset_offset_to_mean_4to8_pca512.pt'
-        weight = torch.load(pca)[:pca_dim].T
-        with torch.no_grad():
-            self.fc_out.weight = nn.Parameter(weight)
+        if pretrained:
+            pca = 'model/audio_dataset_offset_to_mean_4to8_pca512.pt'
+            weight = torch.load(pca)[:pca_dim].T
+            with torch.no_grad():
+                self.fc_out.weight = nn.Parameter(weight)
 
         # attention
         self.attentionNet = nn.Sequential(
@@ -90,11 +93,44 @@ class AudioExpressionNet3(nn.Module):
             nn.Softmax(dim=1)
         )
 
+    def fc_expression(self, conv_res, latent):
+        # input shape: [b, 1, 64], latent: [b, latent_dim]
+        z_ = F.leaky_relu(self.adain1(self.fc1(conv_res), latent), 0.02)
+        z_ = F.leaky_relu(self.fc2(z_))
+        z_ = self.fc3(z_)
+        return self.fc_out(z_)  # [b, expression_dim]
+
+    def encode_frames(self, audio, latent):
+        """
+        Computes the expression vectors of single audio frames, independent
+        of the window they are used in.
+
+        :param audio: torch.tensor, shape [n, 16, 29]
+        :param latent: torch.tensor, encoded latent (output of latent_in), shape [n, latent_dim]
+        :returns expression: torch.tensor, shape [n, expression_dim]
+        """
+        n = audio.shape[0]
+        audio = audio.permute(0, 2, 1)  # [n, 29, 16]
+        conv_res = self.convNet(audio).view(n, 1, -1)  # [n, 1, 64]
+        return self.fc_expression(conv_res, latent)
+
+    def attend(self, expression_T):
+        # input shape: [b, expression_dim, T]
+        b = expression_T.shape[0]
+
+        if self.T > 1:
+            attention = self.attentionNet(
+                expression_T).unsqueeze(-1)  # [b, T, 1]
+            expression_T = torch.bmm(expression_T, attention)
+
+        return expression_T.view(b, 4, 512)  # shape: [b, 4, 512]
+
     def forward(self, audio, latent):
         # input shape: [b, T, 16, 29]
         b = audio.shape[0]
         audio = audio.permute(0, 1, 3, 2)  # [b, T, 29, 16]
-        audio = audio.view(b * self.T, 29, 16)  # [b * T, 29, 16]
+        # Batches of sliding windows are not contiguous
+        audio = audio.reshape(b * self.T, 29, 16)  # [b * T, 29, 16]
 
         # Convolution
         conv_res = self.convNet(audio)
@@ -102,26 +138,71 @@ class AudioExpressionNet3(nn.Module):
 
         latent = self.latent_in(latent.clone().view(b, -1))
 
-        # Fully connected
-        expression = []
-        conv_res = conv_res.view(b, self.T, 1, -1)  # [b, T, 1, 64]
-        conv_res = conv_res.transpose(0, 1)  # [T, b, 1, 64]
-        for t in conv_res:
-            z_ = F.leaky_relu(self.adain1(self.fc1(t), latent), 0.02)
-            z_ = F.leaky_relu(self.fc2(z_))
-            z_ = self.fc3(z_)
-            expression.append(self.fc_out(z_))
-        expression = torch.stack(expression, dim=1)  # [b, T, expression_dim]
+        # Fully connected, all timesteps in one batch
+        latent = latent.repeat_interleave(self.T, dim=0)  # [b * T, latent_dim]
+        expression = self.fc_expression(conv_res, latent)  # [b * T, expression_dim]
+        expression = expression.view(b, self.T, -1)  # [b, T, expression_dim]
 
         # expression = expression[:, (self.T // 2):(self.T // 2) + 1]
 
-        if self.T > 1:
-            expression_T = expression.transpose(1, 2)  # [b, expression_dim, T]
-            attention = self.attentionNet(
-                expression_T).unsqueeze(-1)  # [b, T, 1]
-            expression = torch.bmm(expression_T, attention)
+        return self.attend(expression.transpose(1, 2))
+
+
+class AudioExpressionStream:
+    """
+    Incremental inference of AudioExpressionNet3 over the audio frames of one
+    clip. Every frame's expression vector is computed only once and the last
+    T - 1 of them are kept in a buffer, so each output frame only runs the
+    attentionNet. The result is the same as running the model on the
+    zero-padded sliding windows used in AudioStyleNet.__call__.
+
+    example usage:
+        stream = AudioExpressionStream(audio_encoder, aux_input)
+        for audio in audios.split(batch_size):  # [n, 16, 29]
+            latent_offsets = stream.push(audio)
+        latent_offsets = stream.flush()
+
+    args:
+        model (AudioExpressionNet3):
+        latent (torch.tensor): auxiliary input, shape [1, 4, 512]
+    """
 
-        return expression.view(b, 4, 512)  # shape: [b, 4, 512]
+    def __init__(self, model, latent):
+        self.model = model
+        self.T = model.T
+        self.latent = model.latent_in(latent.clone().view(1, -1))
+
+        # Windows at the borders are padded with zero audio frames
+        zero_audio = latent.new_zeros(1, 16, 29)
+        self.zero_expression = model.encode_frames(zero_audio, self.latent)
+        self.buffer = self.zero_expression.repeat(self.T // 2, 1)
+
+    def _windows(self, expression):
+        expression = torch.cat((self.buffer, expression), dim=0)
+        n = expression.shape[0] - (self.T - 1)
+        self.buffer = expression[max(n, 0):]
+        if n <= 0:
+            return expression.new_zeros(0, 4, 512)
+        windows = expression.unfold(0, self.T, 1)  # [n, expression_dim, T]
+        return self.model.attend(windows)
+
+    def push(self, audio):
+        """
+        Adds audio frames [n, 16, 29] and returns the latent offsets
+        [n', 4, 512] of all windows which are complete now.
+        """
+        n = audio.shape[0]
+        expression = self.model.encode_frames(
+            audio, self.latent.expand(n, -1))
+        return self._windows(expression)
+
+    def flush(self):
+        """
+        Returns the latent offsets of the remaining windows at the end of the
+        clip.
+        """
+        pad = self.T // 2 - 1
+        return self._windows(self.zero_expression.repeat(pad, 1))
 
 
 class FERModelGitHub(nn.Module):
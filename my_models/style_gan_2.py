@@ -1,3 +1,4 @@
+import contextlib
 import math
 import os
 import random
@@ -10,18 +11,37 @@ from op import FusedLeakyReLU, fused_leaky_relu, upfirdn2d
 
 RAIDROOT = os.environ['RAIDROOT']
 
+# How ModulatedConv2d applies its style, see Generator.set_modulation()
+MODULATIONS = ('grouped', 'activation')
+
+# Precisions of the synthesis network, see Generator.set_precision()
+PRECISIONS = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
 # try:
 #     import upfirdn2d
 # except ModuleNotFoundError as e:
 #     upfirdn2d_op = load('upfirdn2d', sources=['op/upfirdn2d.cpp', 'op/upfirdn2d_kernel.cu'])
 
 
+def float32(device):
+    """ Disables autocast inside the block, for the parts that stay in float32 """
+    if not hasattr(torch, 'autocast'):
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, enabled=False)
+
+
 class PixelNorm(nn.Module):
     def __init__(self):
         super().__init__()
 
     def forward(self, input):
-        return input * torch.rsqrt(torch.mean(input ** 2, dim=1, keepdim=True) + 1e-8)
+        # Float32 even under autocast, the mean of squares overflows in fp16
+        x = input.float()
+        return (x * torch.rsqrt(torch.mean(x ** 2, dim=1, keepdim=True) + 1e-8)).to(input.dtype)
 
 
 def make_kernel(k):
@@ -234,21 +254,108 @@ class ModulatedConv2d(nn.Module):
 
         self.demodulate = demodulate
 
+        # Modulated weight of a frozen style, shared by all samples
+        self.frozen_weight = None
+
+        # 'grouped' modulates the weight per sample, 'activation' the input
+        self.modulation_mode = 'grouped'
+
     def __repr__(self):
         return (
             f'{self.__class__.__name__}({self.in_channel}, {self.out_channel}, {self.kernel_size}, '
             f'upsample={self.upsample}, downsample={self.downsample})'
         )
 
-    def forward(self, input, style):
-        batch, in_channel, height, width = input.shape
+    def modulated_weight(self, style):
+        batch = style.shape[0]
 
-        style = self.modulation(style).view(batch, 1, in_channel, 1, 1)
+        style = self.modulation(style).view(batch, 1, self.in_channel, 1, 1)
         weight = self.scale * self.weight * style
 
         if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
-            weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
+            # Float32 even under autocast, the sum runs over in_channel * k * k squares
+            demod = torch.rsqrt(weight.float().pow(2).sum([2, 3, 4]) + 1e-8)
+            weight = weight * demod.to(weight.dtype).view(batch, self.out_channel, 1, 1, 1)
+
+        return weight  # [batch, out_channel, in_channel, k, k]
+
+    def freeze(self, style):
+        """
+        Precomputes the modulated weight for a single style [1, style_dim].
+        Until unfreeze() is called, forward() ignores its style argument and
+        runs one regular convolution with this weight for the whole batch.
+        """
+        with torch.no_grad():
+            self.frozen_weight = self.modulated_weight(style)[0]
+
+    def unfreeze(self):
+        self.frozen_weight = None
+
+    def shared_weight(self):
+        """ The frozen modulated weight, all modulation happened in freeze() """
+        return self.frozen_weight
+
+    def forward_shared(self, input, weight):
+        if self.upsample:
+            out = F.conv_transpose2d(
+                input, weight.transpose(0, 1), padding=0, stride=2)
+            out = self.blur(out)
+
+        elif self.downsample:
+            input = self.blur(input)
+            out = F.conv2d(input, weight, padding=0, stride=2)
+
+        else:
+            out = F.conv2d(input, weight, padding=self.padding)
+
+        return out
+
+    def forward_activation(self, input, style):
+        """
+        Modulates the activations instead of the weight: scales the input
+        channels by the style, runs one convolution with the shared weight
+        for the whole batch and scales the output channels by the
+        demodulation factors. Same result as the grouped convolution, but
+        a regular convolution instead of one with groups=batch.
+        """
+        batch = input.shape[0]
+
+        style, demod = self.activation_modulation(style)
+        weight = self.scale * self.weight[0]  # [out_channel, in_channel, k, k]
+
+        out = self.forward_shared(input * style.view(batch, self.in_channel, 1, 1), weight)
+
+        if demod is not None:
+            out = out * demod.to(out.dtype).view(batch, self.out_channel, 1, 1)
+
+        return out
+
+    def activation_modulation(self, style):
+        """
+        Input channel scales [batch, in_channel] and demodulation factors
+        [batch, out_channel] (None without demodulation) of forward_activation()
+        """
+        style = self.modulation(style)
+
+        demod = None
+        if self.demodulate:
+            # Sum of squares of the modulated weight, in float32 as in modulated_weight()
+            weight = self.scale * self.weight[0]
+            weight_sq = weight.float().pow(2).sum([2, 3])  # [out_channel, in_channel]
+            demod = torch.rsqrt(style.float().pow(2) @ weight_sq.t() + 1e-8)
+
+        return style, demod
+
+    def forward(self, input, style):
+        if self.frozen_weight is not None:
+            return self.forward_shared(input, self.shared_weight())
+
+        if self.modulation_mode == 'activation':
+            return self.forward_activation(input, style)
+
+        batch, in_channel, height, width = input.shape
+
+        weight = self.modulated_weight(style)
 
         weight = weight.view(
             batch * self.out_channel, in_channel, self.kernel_size, self.kernel_size
@@ -296,7 +403,8 @@ class NoiseInjection(nn.Module):
             batch, _, height, width = image.shape
             noise = image.new_empty(batch, 1, height, width).normal_()
 
-        return image + self.weight * noise
+        # Float32 even under autocast, the output keeps the dtype of image
+        return (image.float() + self.weight * noise.float()).to(image.dtype)
 
 
 class ConstantInput(nn.Module):
@@ -365,9 +473,11 @@ class ToRGB(nn.Module):
         out = out + self.bias
 
         if skip is not None:
-            skip = self.upsample(skip)
+            # Float32 even under autocast, the skip path accumulates the image
+            with float32(skip.device):
+                skip = self.upsample(skip.float())
 
-            out = out + skip
+            out = out.float() + skip
 
         return out
 
@@ -598,6 +708,57 @@ class Generator(nn.Module):
 
         self.noises = self.make_noise()
 
+        self.precision = 'fp32'
+
+        # (start, latent rows >= start) of freeze_styles()
+        self.frozen = None
+
+    def set_precision(self, precision):
+        """
+        Runs the synthesis network in precision 'fp32', 'fp16' or 'bf16'.
+        Reduced precision uses autocast: convolutions run in half precision,
+        while weight demodulation, noise injection and the ToRGB skip path stay
+        in float32. The mapping network always runs in float32. fp16 needs a
+        CUDA device, on CPU use bf16. Reduced precision needs PyTorch >= 1.10
+        (torch.autocast).
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, use one of {list(PRECISIONS)}")
+        if precision != 'fp32' and not hasattr(torch, 'autocast'):
+            raise RuntimeError(f"Precision {precision} needs torch.autocast, which was added in "
+                               f"PyTorch 1.10 (installed: {torch.__version__})")
+        self.precision = precision
+        return self
+
+    def set_modulation(self, mode, sizes=None):
+        """
+        Selects how the ModulatedConv2d layers of the blocks with resolution
+        in sizes (default: all) apply their style: 'grouped' runs a grouped
+        convolution with one modulated weight per sample, 'activation'
+        scales the activations around one shared convolution, which scales
+        better with the batch size on CPU. See benchmarks/bench_modulation.py.
+        """
+        if mode not in MODULATIONS:
+            raise ValueError(f"Unknown modulation {mode}, use one of {list(MODULATIONS)}")
+
+        blocks = [(4, [self.conv1, self.to_rgb1])]
+        for k, (conv1, conv2, to_rgb) in enumerate(
+                zip(self.convs[::2], self.convs[1::2], self.to_rgbs)):
+            blocks.append((2 ** (k + 3), [conv1, conv2, to_rgb]))
+
+        for size, layers in blocks:
+            if sizes is None or size in sizes:
+                for layer in layers:
+                    layer.conv.modulation_mode = mode
+        return self
+
+    def autocast(self, device):
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        if self.precision == 'fp16' and device.type != 'cuda':
+            raise ValueError("fp16 needs a CUDA device, use bf16 on CPU")
+        return torch.autocast(device.type, dtype=PRECISIONS[self.precision])
+
     def make_noise(self):
         device = self.input.input.device
 
@@ -614,6 +775,98 @@ class Generator(nn.Module):
         self.noises = [n.to(*args, **kwargs) for n in self.noises]
         return self
 
+    def synthesis_layers(self, size=None):
+        """
+        Returns the synthesis layers in execution order as tuples of
+        (layer, latent index, noise index). ToRGB layers have no noise index.
+        If size is smaller than the generator resolution, only the layers up
+        to the ToRGB of that resolution are returned.
+        """
+        layers = [(self.conv1, 0, 0), (self.to_rgb1, 1, None)]
+
+        i = 1
+        noise_i = 1
+
+        for conv1, conv2, to_rgb in zip(
+            self.convs[::2], self.convs[1::2], self.to_rgbs
+        ):
+            layers.append((conv1, i, noise_i))
+            layers.append((conv2, i + 1, noise_i + 1))
+            layers.append((to_rgb, i + 2, None))
+
+            i += 2
+            noise_i += 2
+
+        if size is not None:
+            if size not in [2 ** i for i in range(2, self.log_size + 1)]:
+                raise ValueError(f"Output size {size} is not a block resolution of the "
+                                 f"generator, a power of two from 4 to {self.size}")
+            layers = layers[:3 * int(math.log(size, 2)) - 4]
+
+        return layers
+
+    def synthesis(self, latent, noise, layers, out=None, skip=None):
+        if out is None:
+            out = self.input(latent)
+
+        with self.autocast(latent.device):
+            for layer, i, noise_i in layers:
+                if noise_i is None:
+                    skip = layer(out, latent[:, i], skip)
+                else:
+                    out = layer(out, latent[:, i], noise=noise[noise_i])
+
+        return out, skip
+
+    def prefix(self, latent, noise=None, n_fixed=4):
+        """
+        Runs all synthesis layers that only read the first n_fixed rows of
+        latent. The result can be passed as prefix to forward() for every
+        latent which shares these rows (and the same noise), which then starts
+        at the first layer reading row n_fixed.
+
+        :param latent: torch.tensor, shape [1, n_latent, style_dim]
+        :param noise: list of noise tensors, as passed to forward()
+        :param n_fixed: number of leading latent rows shared by all frames
+        :returns (out, skip, start): activations and rgb skip after the prefix
+                                     and the index of the first layer to run
+        """
+        if noise is None:
+            noise = [None] * (2 * (self.log_size - 2) + 1)
+
+        layers = self.synthesis_layers()
+        start = next((k for k, (_, i, _) in enumerate(layers) if i >= n_fixed),
+                     len(layers))
+
+        out, skip = self.synthesis(latent, noise, layers[:start])
+
+        return out, skip, start
+
+    def freeze_styles(self, latent, start=8):
+        """
+        Precomputes the modulated weights of all synthesis layers reading
+        latent rows >= start, so that frames sharing these rows do no
+        per-frame weight modulation. Call after moving the generator to its
+        device and undo with unfreeze_styles().
+
+        :param latent: torch.tensor, shape [b, n_latent, style_dim], rows >= start
+                       equal for all samples
+        :param start: first latent row that is fixed
+        """
+        rows = latent[:1, start:].detach()
+        if (latent[:, start:] != rows).any():
+            raise ValueError(f"Latent rows {start}+ differ between the samples, "
+                             "they cannot be frozen")
+        for layer, i, _ in self.synthesis_layers():
+            if i >= start:
+                layer.conv.freeze(latent[:1, i])
+        self.frozen = (start, rows.clone())
+
+    def unfreeze_styles(self):
+        for layer, _, _ in self.synthesis_layers():
+            layer.conv.unfreeze()
+        self.frozen = None
+
     def forward(
         self,
         styles,
@@ -622,7 +875,14 @@ class Generator(nn.Module):
         truncation_latent=None,
         input_is_latent=False,
         noise=None,
+        prefix=None,
+        size=None,
     ):
+        """
+        If size is smaller than the generator resolution, synthesis stops
+        after the block of that resolution and the image accumulated by its
+        ToRGB skip path is returned. The finer blocks are never run.
+        """
         if not input_is_latent:
             styles = [self.style(s).view(-1, 1, self.style_dim) for s in styles]
 
@@ -652,25 +912,25 @@ class Generator(nn.Module):
 
             latent = torch.cat([latent, latent2], 1)
 
-        out = self.input(latent)
-        out = self.conv1(out, latent[:, 0], noise=noise[0])
-
-        skip = self.to_rgb1(out, latent[:, 1])
+        # Frozen layers ignore their latent rows, frames with other rows
+        # would silently render the frozen ones
+        if self.frozen is not None:
+            start, rows = self.frozen
+            if (latent[:, start:] != rows).any():
+                raise ValueError(f"Latent rows {start}+ differ from the ones of freeze_styles()")
 
-        i = 1
-        noise_i = 1
+        layers = self.synthesis_layers(size)
 
-        for conv1, conv2, to_rgb in zip(
-            self.convs[::2], self.convs[1::2], self.to_rgbs
-        ):
-            out = conv1(out, latent[:, i], noise=noise[noise_i])
-            out = conv2(out, latent[:, i + 1], noise=noise[noise_i + 1])
-            skip = to_rgb(out, latent[:, i + 2], skip)
-
-            i += 2
-            noise_i += 2
-
-        image = skip
+        if prefix is None:
+            _, image = self.synthesis(latent, noise, layers)
+        else:
+            # Continue from cached activations of the shared latent rows
+            out, skip, start = prefix
+            batch = latent.shape[0]
+            out = out.repeat(batch // out.shape[0], 1, 1, 1)
+            if skip is not None:
+                skip = skip.repeat(batch // skip.shape[0], 1, 1, 1)
+            _, image = self.synthesis(latent, noise, layers[start:], out, skip)
 
         return image, latent
 
@@ -688,6 +948,7 @@ class PretrainedGenerator1024(Generator):
 
         repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         weight_path = os.path.join(repo_dir, 'model/stylegan2-ffhq-config-f.pt')
+        self.checkpoint = weight_path
         w = torch.load(weight_path)
         # w = torch.load(RAIDROOT + 'Networks/stylegan2-ffhq-config-f.pt')
         self.load_state_dict(w['g_ema'])
@@ -722,7 +983,8 @@ class PretrainedGenerator256(Generator):
             lr_mlp=0.01
         )
 
-        w = torch.load(RAIDROOT + 'Networks/stylegan2-ffhq-256.pt')
+        self.checkpoint = RAIDROOT + 'Networks/stylegan2-ffhq-256.pt'
+        w = torch.load(self.checkpoint)
         self.load_state_dict(w['g_ema'])
 
         self.register_buffer('latent_avg', w['latent_avg'])
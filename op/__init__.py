@@ -1,2 +1,2 @@
-from .fused_act import FusedLeakyReLU, fused_leaky_relu
-from .upfirdn2d import upfirdn2d
+from .fused_act import FusedLeakyReLU, fused_leaky_relu, fused_leaky_relu_native
+from .upfirdn2d import upfirdn2d, upfirdn2d_native
@@ -0,0 +1,118 @@
+"""
+Selects between the compiled CUDA extensions and the native PyTorch
+implementations of the ops in this package.
+
+The backend is set with the environment variable OP_BACKEND:
+    auto    (default) use the extension for CUDA tensors if it can be built,
+            the native implementation otherwise
+    cuda    use the extension for CUDA tensors, fail if it can not be built
+    native  never load the extension, always use the native implementation
+CPU tensors always take the native path, as does everything inside a
+native() block.
+
+Extensions are looked up in this order:
+    1. the installed module (python op/setup.py install)
+    2. a previous build in the extension cache, imported without invoking
+       the compiler toolchain
+    3. a fresh build into the extension cache
+    4. the native implementation
+The cache lives in OP_CACHE_DIR (default ~/.cache/audiostylenet/op). Every
+build gets its own directory named after a hash of the sources and the
+torch, CUDA and python versions, so stale builds are never picked up.
+"""
+
+import contextlib
+import hashlib
+import importlib
+import importlib.util
+import os
+import sys
+import torch
+import warnings
+
+BACKEND = os.environ.get('OP_BACKEND', 'auto').lower()
+if BACKEND not in ('auto', 'cuda', 'native'):
+    raise ValueError(f"Unknown OP_BACKEND '{BACKEND}', use 'auto', 'cuda' or 'native'")
+
+OP_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.environ.get(
+    'OP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'audiostylenet', 'op'))
+
+
+def build_directory(name, sources):
+    h = hashlib.sha1()
+    for source in sources:
+        with open(source, 'rb') as f:
+            h.update(f.read())
+    h.update(f'{torch.__version__}-{torch.version.cuda}-{sys.version_info[:2]}'.encode())
+    return os.path.join(CACHE_DIR, f'{name}-{h.hexdigest()[:16]}')
+
+
+def import_from_cache(name, build_dir):
+    path = os.path.join(build_dir, f'{name}.so')
+    if not os.path.exists(path):
+        return None
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_extension(module_name, name, sources):
+    """
+    Imports the installed extension module_name, or the cached build of
+    sources (relative to op/), building it if necessary. Returns None if the
+    native backend is selected or the extension is not available.
+    """
+    if BACKEND == 'native':
+        return None
+    if BACKEND == 'auto' and not torch.cuda.is_available():
+        return None
+
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        pass
+
+    try:
+        sources = [os.path.join(OP_DIR, s) for s in sources]
+        build_dir = build_directory(name, sources)
+
+        module = import_from_cache(name, build_dir)
+        if module is not None:
+            return module
+
+        from torch.utils.cpp_extension import load
+        os.makedirs(build_dir, exist_ok=True)
+        print(f"Building the {name} extension in {build_dir}")
+        return load(name, sources=sources, build_directory=build_dir)
+    except Exception as e:
+        if BACKEND == 'cuda':
+            raise
+        warnings.warn(f"Loading the {name} extension failed, using native ops instead:\n{e}")
+        return None
+
+
+_force_native = False
+
+
+@contextlib.contextmanager
+def native():
+    """
+    Uses the native implementations for all tensors inside the block, e.g.
+    while tracing a model for export, where calls of the extensions can not
+    be recorded
+    """
+    global _force_native
+    prev, _force_native = _force_native, True
+    try:
+        yield
+    finally:
+        _force_native = prev
+
+
+def use_native(extension, input):
+    # The CUDA kernels support float32 and float16 only
+    return (_force_native or extension is None or not input.is_cuda
+            or input.dtype == torch.bfloat16)
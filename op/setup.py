@@ -4,29 +4,22 @@ from pathlib import Path
 
 # Usage:
 # python setup.py install (or python setup.py bdist_wheel)
+# Installs the modules upfirdn2d_op and fused, which are then imported
+# directly instead of being built at runtime.
 
 rootdir = (Path(__file__).parent / '..' / 'op').resolve()
 
 setup(
-    name='upfirdn2d',
+    name='stylegan2_op',
     ext_modules=[
         CUDAExtension('upfirdn2d_op',
                       [str(rootdir / 'upfirdn2d.cpp'),
                        str(rootdir / 'upfirdn2d_kernel.cu')],
-                      )
-    ],
-    cmdclass={
-        'build_ext': BuildExtension
-    }
-)
-
-setup(
-    name='fused',
-    ext_modules=[
+                      ),
         CUDAExtension('fused',
                       [str(rootdir / 'fused_bias_act.cpp'),
                        str(rootdir / 'fused_bias_act_kernel.cu')],
-                      )
+                      ),
     ],
     cmdclass={
         'build_ext': BuildExtension
@@ -1,6 +1,7 @@
 import argparse
 import glob
 import os
+import sys
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -9,9 +10,26 @@ from tqdm import tqdm
 from lpips import PerceptualLoss
 from my_models import style_gan_2
 from PIL import Image
+from scipy.ndimage import gaussian_filter1d
 from torchvision import transforms
 from torchvision.utils import save_image
 from utils import utils
+from utils.latent_bank import LatentBank
+from utils.w_stats import w_stats
+
+
+def smooth_latents(latents, sigma):
+    """
+    Gaussian filter over time, removes the frame to frame jitter of latents
+    which were projected independently
+
+    :param latents (torch.tensor): shape [n_frames, n_latent, 512]
+    :param sigma (float): standard deviation in frames
+    """
+    if sigma <= 0:
+        return latents
+    smoothed = gaussian_filter1d(latents.cpu().numpy(), sigma, axis=0, mode='nearest')
+    return torch.from_numpy(smoothed).to(latents.device)
 
 
 class Projector:
@@ -26,6 +44,7 @@ class Projector:
                  noise_ramp_length=0.75,
                  verbose=True,
                  initial_latent=None,
+                 render_size=1024,
                  ):
 
         self.num_steps = num_steps
@@ -39,6 +58,7 @@ class Projector:
         self.noise_ramp_length = noise_ramp_length
         self.regularize_noise_weight = 1e5
         self.verbose = verbose
+        self.render_size = render_size  # 256 stops the generator at the 256 block
 
         self.latent_expr = None
         self.lpips = None
@@ -50,19 +70,16 @@ class Projector:
         self.device = next(g.parameters()).device
 
         # Find latent stats
-        self._info(
-            ('Finding W midpoint and stddev using %d samples...' % self.n_mean_latent))
-        torch.manual_seed(123)
-        with torch.no_grad():
-            noise_sample = torch.randn(
-                self.n_mean_latent, 512, device=self.device)
-            latent_out = self.g_ema.style(noise_sample)
-
-        self.latent_mean = latent_out.mean(0)
-        self.latent_std = (
-            (latent_out - self.latent_mean).pow(2).sum() / self.n_mean_latent) ** 0.5
+        self.latent_mean, self.latent_std = w_stats(self.g_ema, self.n_mean_latent)
         self._info('std = {}'.format(self.latent_std))
 
+        self.init_latent(initial_latent)
+
+        # Init loss function
+        self.lpips = PerceptualLoss(model='net-lin', net='vgg').to(self.device)
+
+    def init_latent(self, initial_latent):
+        """ Creates the optimized latent and its optimizer """
         if initial_latent is None:
             self.latent_in = self.latent_mean.detach().clone().unsqueeze(0)
             self.latent_in = self.latent_in.repeat(self.g_ema.n_latent, 1)
@@ -77,18 +94,22 @@ class Projector:
         #     [self.latent_in] + self.noises, lr=self.initial_lr)
         self.opt = torch.optim.Adam([self.latent_in], lr=self.initial_lr)
 
-        # Init loss function
-        self.lpips = PerceptualLoss(model='net-lin', net='vgg').to(self.device)
-
     def _info(self, *args):
         if self.verbose:
             print('Projector:', *args)
 
-    def update_lr(self, t):
+    def learning_rate(self, t):
         lr_ramp = min(1.0, (1.0 - t) / self.lr_rampdown_length)
         lr_ramp = 0.5 - 0.5 * np.cos(lr_ramp * np.pi)
         lr_ramp = lr_ramp * min(1.0, t / self.lr_rampup_length)
-        self.lr = self.initial_lr * lr_ramp
+        return self.initial_lr * lr_ramp
+
+    def noise_strength(self, t):
+        return self.latent_std * self.initial_noise_factor * \
+            max(0.0, 1.0 - t / self.noise_ramp_length) ** 2
+
+    def update_lr(self, t):
+        self.lr = self.learning_rate(t)
         self.opt.param_groups[0]['lr'] = self.lr
 
     def noise_regularization(self):
@@ -137,8 +158,7 @@ class Projector:
         t = self.cur_step / self.num_steps
 
         # Add noise to dlatents
-        noise_strength = self.latent_std * self.initial_noise_factor * \
-            max(0.0, 1.0 - t / self.noise_ramp_length) ** 2
+        noise_strength = self.noise_strength(t)
         latent_noise = (torch.randn_like(self.latent_in)
                         * noise_strength).to(self.device)
         self.latent_expr = self.latent_in + latent_noise
@@ -148,7 +168,8 @@ class Projector:
 
         # Train
         self.img_gen = self.g_ema(
-            [self.latent_expr.unsqueeze(0)], input_is_latent=True, noise=self.g_ema.noises)[0]
+            [self.latent_expr.unsqueeze(0)], input_is_latent=True, noise=self.g_ema.noises,
+            size=self.render_size)[0]
 
         # Downsample to 256 x 256
         self.img_gen = utils.downsample_256(self.img_gen)
@@ -181,6 +202,239 @@ class Projector:
         return self.latent_in.detach()
 
 
+class BatchProjector(Projector):
+    """
+    Projects many independent images, batch_size of them at once. Every slot
+    of the batch has its own latent, Adam state, learning rate schedule and
+    step count, the generator and LPIPS run once per step for all slots.
+    A slot is done after num_steps steps, or earlier with patience, when its
+    loss did not improve by min_delta for patience steps. Its best latent is
+    returned right away and the slot is refilled with the next image.
+
+    example usage:
+        proj = BatchProjector(g, batch_size=8)
+        for name, latent, loss in proj.project((name, image) for ...):
+            torch.save(latent.cpu(), name + '.latent.pt')
+    """
+    def __init__(self,
+                 g,
+                 batch_size=8,
+                 num_steps=2000,
+                 patience=None,
+                 min_delta=1e-4,
+                 **kwargs):
+        super().__init__(g, num_steps=num_steps, **kwargs)
+
+        self.batch_size = batch_size
+        self.patience = patience
+        self.min_delta = min_delta
+
+        # One parameter and param group per slot
+        self.latents = [torch.zeros(self.g_ema.n_latent, 512, device=self.device,
+                                    requires_grad=True) for _ in range(batch_size)]
+        self.opt = torch.optim.Adam([{'params': [latent]} for latent in self.latents],
+                                    lr=self.initial_lr)
+        self.slots = [None] * batch_size
+
+    def init_latent(self, initial_latent):
+        # Every slot has its own latent, see __init__
+        pass
+
+    def fill(self, i, name, target_image, initial_latent=None):
+        if initial_latent is None:
+            initial_latent = self.latent_mean.unsqueeze(0).repeat(self.g_ema.n_latent, 1)
+        if target_image.shape[-1] > 256:
+            target_image = utils.downsample_256(target_image.unsqueeze(0))[0]
+
+        with torch.no_grad():
+            self.latents[i].copy_(initial_latent)
+        # Fresh Adam moments for the new image
+        self.opt.state.pop(self.latents[i], None)
+
+        self.slots[i] = {
+            'name': name,
+            'target': target_image.to(self.device),
+            'step': 0,
+            'loss': None,
+            'best': float('inf'),
+            'best_latent': None,
+            'since_best': 0,
+        }
+
+    def batch_step(self, active):
+        latents = [self.latents[i] for i in active]
+        slots = [self.slots[i] for i in active]
+
+        # Add noise to dlatents and update learning rates, per slot
+        latent_expr = []
+        for i, latent, slot in zip(active, latents, slots):
+            t = slot['step'] / self.num_steps
+            latent_expr.append(latent + torch.randn_like(latent) * self.noise_strength(t))
+            self.opt.param_groups[i]['lr'] = self.learning_rate(t)
+        latent_expr = torch.stack(latent_expr)
+
+        img_gen = self.g_ema([latent_expr], input_is_latent=True, noise=self.g_ema.noises,
+                             size=self.render_size)[0]
+        img_gen = utils.downsample_256(img_gen)
+        target = torch.stack([slot['target'] for slot in slots])
+
+        # Per sample losses, the gradient of every latent only depends on its own loss
+        loss = self.lpips(img_gen, target).view(-1)
+        if self.mse_strength:
+            loss = loss + (img_gen - target).pow(2).mean(dim=[1, 2, 3]) * self.mse_strength
+
+        # Slots without gradient (not active) are skipped by Adam
+        for latent in self.latents:
+            latent.grad = None
+        loss.sum().backward()
+        self.opt.step()
+
+        return loss.detach()
+
+    def done(self, slot):
+        if slot['step'] >= self.num_steps:
+            return True
+        return self.patience is not None and slot['since_best'] >= self.patience
+
+    def project(self, targets):
+        """
+        Generator over the results, in the order the images are done
+
+        :param targets: iterable of (name, target_image), images [3, h, w] in [-1, 1]
+        :returns: yields (name, best latent [n_latent, 512], its loss)
+        """
+        targets = iter(targets)
+        exhausted = False
+        pbar = tqdm()
+        n_done = 0
+
+        while True:
+            # Refill free slots
+            for i in range(self.batch_size):
+                if self.slots[i] is None and not exhausted:
+                    try:
+                        self.fill(i, *next(targets))
+                    except StopIteration:
+                        exhausted = True
+
+            active = [i for i in range(self.batch_size) if self.slots[i] is not None]
+            if len(active) == 0:
+                break
+
+            # The losses of a step belong to the latents before the step
+            latents = [self.latents[i].detach().clone() for i in active]
+            loss = self.batch_step(active)
+
+            for i, latent, loss_i in zip(active, latents, loss.tolist()):
+                slot = self.slots[i]
+                slot['step'] += 1
+                slot['loss'] = loss_i
+                if loss_i < slot['best'] - self.min_delta:
+                    slot['best'] = loss_i
+                    slot['best_latent'] = latent
+                    slot['since_best'] = 0
+                else:
+                    slot['since_best'] += 1
+
+                if self.done(slot):
+                    self.slots[i] = None
+                    n_done += 1
+                    yield slot['name'], slot['best_latent'], slot['best']
+
+            pbar.update(1)
+            pbar.set_description(f'active: {len(active)}; done: {n_done}; '
+                                 f'mean loss: {loss.mean().item():.4f}')
+        pbar.close()
+
+    def get_image(self, latent):
+        with torch.no_grad():
+            imgs, _ = self.g_ema(
+                [latent.unsqueeze(0)], input_is_latent=True, noise=self.g_ema.noises)
+        return imgs
+
+
+class VideoProjector(Projector):
+    """
+    Projects the frames of a video in order. The first frame starts from the
+    mean latent and runs first_steps steps, every following frame starts
+    from the latent of the previous one and runs at most frame_steps steps.
+    A frame stops early when its loss did not improve by min_delta for
+    patience steps, its best latent is kept. Optionally the latents are
+    smoothed over time afterwards.
+
+    example usage:
+        proj = VideoProjector(g)
+        ids, latents = proj.project((frame_id, image) for ...)
+        LatentBank.save(video, ids, latents)
+    """
+    def __init__(self,
+                 g,
+                 first_steps=2000,
+                 frame_steps=200,
+                 patience=20,
+                 min_delta=1e-3,
+                 smooth=0.,
+                 **kwargs):
+        super().__init__(g, num_steps=first_steps, **kwargs)
+        self.first_steps = first_steps
+        self.frame_steps = frame_steps
+        self.patience = patience
+        self.min_delta = min_delta
+        self.smooth = smooth
+
+    def run_frame(self, target_image, num_steps):
+        """ Optimizes self.latent_in from its current value, returns the best latent """
+        self.num_steps = num_steps
+        self.prepare_input(target_image)
+        # Adam moments of the previous frame point in the wrong direction
+        self.opt.state.clear()
+
+        best_loss, best_latent, since_best = float('inf'), None, 0
+        for i_step in range(num_steps):
+            self.cur_step = i_step
+            latent = self.latent_in.detach().clone()
+            self.step()
+
+            # self.loss belongs to the latent before the step
+            loss = self.loss.item()
+            if loss < best_loss - self.min_delta:
+                best_loss, best_latent, since_best = loss, latent, 0
+            else:
+                since_best += 1
+            if self.patience is not None and since_best >= self.patience:
+                break
+
+        # Next frame starts from the best latent of this one
+        with torch.no_grad():
+            self.latent_in.copy_(best_latent)
+        return best_latent, best_loss, i_step + 1
+
+    def project(self, frames):
+        """
+        :param frames: iterable of (frame_id, target_image) in temporal order,
+                       images [3, h, w] in [-1, 1]
+        :returns (ids, latents): latents shape [n_frames, n_latent, 512]
+        """
+        ids, latents = [], []
+        pbar = tqdm(frames)
+        for i, (frame_id, target_image) in enumerate(pbar):
+            if i == 0:
+                with torch.no_grad():
+                    self.latent_in.copy_(self.latent_mean.unsqueeze(0).repeat(
+                        self.g_ema.n_latent, 1))
+            num_steps = self.first_steps if i == 0 else self.frame_steps
+            latent, loss, steps = self.run_frame(target_image.to(self.device), num_steps)
+            ids.append(frame_id)
+            latents.append(latent)
+            pbar.set_description(f'{frame_id}: loss: {loss:.4f}; steps: {steps}')
+
+        latents = torch.stack(latents)
+        if self.smooth > 0:
+            self._info(f'Smoothing latents over time with sigma {self.smooth}')
+            latents = smooth_latents(latents, self.smooth)
+        return ids, latents
+
+
 if __name__ == "__main__":
 
     # Parse arguments
@@ -188,6 +442,22 @@ if __name__ == "__main__":
     parser.add_argument('--input', type=str, required=True)
     parser.add_argument('--output_dir', type=str, required=True)
     parser.add_argument('--gpu', type=int, required=True)
+    parser.add_argument('--render_size', type=int, default=1024, choices=[256, 512, 1024])
+    parser.add_argument('--video', action='store_true',
+                        help="Project a directory of video frames warm started and write a latent bank")
+    parser.add_argument('--half', action='store_true', help="Store the latent bank as float16")
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="Project this many independent images at once, e.g. portraits")
+    parser.add_argument('--num_steps', type=int, default=2000,
+                        help="Steps per image (the first frame of a directory)")
+    parser.add_argument('--patience', type=int, default=None,
+                        help="Stop an image early if its loss did not improve for this many steps")
+    parser.add_argument('--frame_steps', type=int, default=200,
+                        help="Maximum steps per frame after the first one in video mode")
+    parser.add_argument('--frame_patience', type=int, default=20,
+                        help="Stop a frame if its loss did not improve for this many steps in video mode")
+    parser.add_argument('--smooth', type=float, default=0.,
+                        help="Sigma in frames of the temporal smoothing of video latents, 0 for none")
     args = parser.parse_args()
 
     # Select device
@@ -198,8 +468,6 @@ if __name__ == "__main__":
     for param in g.parameters():
         param.requires_grad = False
 
-    proj = Projector(g)
-
     # Load target image
     path = args.input
     if os.path.isdir(path):
@@ -215,31 +483,76 @@ if __name__ == "__main__":
     if save_dir[-1] != '/':
         save_dir = save_dir + '/'
 
-    # Project images
-    for i, file in tqdm(enumerate(sorted(image_files))):
-        print('Projecting {}'.format(file))
-
-        # Load image
-        target_image = Image.open(file).convert('RGB')
-        transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
-        ])
-        target_image = transform(target_image).to(device)
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
+    ])
 
-        # Run projector
-        proj.run(target_image, 2000 if i == 0 else 100)
+    if args.batch_size > 1:
+        # Independent images, every result is saved as soon as it converged
+        proj = BatchProjector(g, batch_size=args.batch_size, num_steps=args.num_steps,
+                              patience=args.patience, render_size=args.render_size)
 
-        # Collect results
-        generated = proj.get_images()
-        latents = proj.get_latents()
-        print(latents.shape)
+        def load_targets():
+            for file in sorted(image_files):
+                name = file.split('/')[-1].split('.')[0]
+                yield name, transform(Image.open(file).convert('RGB'))
 
-        # Save results
-        save_str = save_dir + file.split('/')[-1].split('.')[0]
         os.makedirs(save_dir, exist_ok=True)
-        print('Saving {}'.format(save_str + '_p.png'))
-        if bool_save_image:
-            save_image(generated, save_str + '_p.png',
+        for name, latents, loss in proj.project(load_targets()):
+            print('Saving {} (loss: {:.4f})'.format(save_dir + name + '_p.png', loss))
+            save_image(proj.get_image(latents), save_dir + name + '_p.png',
                        normalize=True, range=(-1, 1))
-        torch.save(latents.detach().cpu(), save_str + '_p.latent.pt')
+            torch.save(latents.cpu(), save_dir + name + '_p.latent.pt')
+        sys.exit()
+
+    if not bool_save_image and args.video:
+        # Frames of a video, warm started from the previous frame and saved to a latent bank
+        proj = VideoProjector(g, first_steps=args.num_steps, frame_steps=args.frame_steps,
+                              patience=args.frame_patience, smooth=args.smooth,
+                              render_size=args.render_size)
+
+        def load_frames():
+            for file in sorted(image_files):
+                frame_id = file.split('/')[-1].split('.')[0]
+                yield frame_id, transform(Image.open(file).convert('RGB'))
+
+        ids, latents = proj.project(load_frames())
+        print('Saving latent bank to {}'.format(save_dir))
+        LatentBank.save(save_dir, ids, latents, half=args.half)
+        sys.exit()
+
+    proj = Projector(g, render_size=args.render_size)
+
+    if not bool_save_image:
+        # Frames one after the other, one <frame>_p.latent.pt each
+        os.makedirs(save_dir, exist_ok=True)
+        for i, file in tqdm(enumerate(sorted(image_files))):
+            print('Projecting {}'.format(file))
+            target_image = transform(Image.open(file).convert('RGB')).to(device)
+            proj.run(target_image, args.num_steps if i == 0 else 100)
+
+            save_str = save_dir + file.split('/')[-1].split('.')[0]
+            print('Saving {}'.format(save_str + '_p.latent.pt'))
+            torch.save(proj.get_latents().cpu(), save_str + '_p.latent.pt')
+        sys.exit()
+
+    # Load image
+    file = image_files[0]
+    print('Projecting {}'.format(file))
+    target_image = Image.open(file).convert('RGB')
+    target_image = transform(target_image).to(device)
+
+    # Run projector
+    proj.run(target_image, args.num_steps)
+
+    # Collect results
+    generated = proj.get_images()
+    latents = proj.get_latents()
+
+    # Save results
+    save_str = save_dir + file.split('/')[-1].split('.')[0]
+    os.makedirs(save_dir, exist_ok=True)
+    print('Saving {}'.format(save_str + '_p.png'))
+    save_image(generated, save_str + '_p.png', normalize=True, range=(-1, 1))
+    torch.save(latents.detach().cpu(), save_str + '_p.latent.pt')
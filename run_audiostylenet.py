@@ -1,14 +1,16 @@
 """
 Test model by generating a video from an encoded still image in 'latentfile'
-and the extracted deepspeech features in 'sentence_path'. Overlay the generated
-video with the original audio from 'audiofile'. Optionally: add a further
-manipulation from 'direction'.
+and the extracted deepspeech features in 'sentence_path' (or a wav file, whose
+features are extracted once and cached, see utils/feature_cache.py). Overlay
+the generated video with the original audio from 'audiofile'. Optionally: add
+a further manipulation from 'direction'.
 """
 
 import argparse
 import os
 
-from audiostylenet import AudioStyleNet
+from audiostylenet import RENDER_SIZES, AudioStyleNet
+from utils import profiling
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--latentfile', type=str, default='data/images/yt_xOpJdHiIwhQ_2.latent.pt')
@@ -23,6 +25,11 @@ parser.add_argument('--audio_type', type=str, default='deepspeech')
 parser.add_argument('--audio_multiplier', type=float, default=2.0)
 parser.add_argument('--audio_truncation', type=float, default=0.8)
 parser.add_argument('--direction_multiplier', type=float, default=1.0)
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--render_size', type=int, default=1024, choices=RENDER_SIZES)  # 256 is faster, see benchmarks/bench_render_size.py
+parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                    help="Generator precision, bf16 on CPU, fp16 or bf16 on GPU")
+parser.add_argument('--profile', type=str, default=None, help="Write a profile of the rendering to this directory")
 args = parser.parse_args()
 
 # Check if target directory exists
@@ -36,16 +43,20 @@ model = AudioStyleNet(
     model_path=args.model_path,
     device=device,
     audio_type=args.audio_type,
-    T=8
+    T=8,
+    precision=args.precision
 )
 
-# Create video
-vid = model(test_latent=args.latentfile, test_sentence_path=args.sentence_path,
-            direction=args.direction,
-            audio_multiplier=args.audio_multiplier,
-            audio_truncation=args.audio_truncation,
-            direction_multiplier=args.direction_multiplier,
-            max_sec=args.max_sec)
-
-# Save video
-model.save_video(vid, args.audiofile, args.target_path)
+if args.profile is not None:
+    os.environ[profiling.ENV_VAR] = args.profile
+
+# Create video, frames are streamed to ffmpeg as they are generated
+model.render(test_latent=args.latentfile, test_sentence_path=args.sentence_path,
+             audiofile=args.audiofile, f=args.target_path,
+             direction=args.direction,
+             audio_multiplier=args.audio_multiplier,
+             audio_truncation=args.audio_truncation,
+             direction_multiplier=args.direction_multiplier,
+             max_sec=args.max_sec,
+             batch_size=args.batch_size,
+             render_size=args.render_size)
@@ -0,0 +1,424 @@
+"""
+Local inference server for AudioStyleNet. The models are loaded once and
+stay resident, frames of concurrent jobs are rendered in shared generator
+batches and the encoded video is streamed back while it is generated.
+
+usage:
+    python serve_audiostylenet.py --port 8000 --batch_size 16
+    python serve_audiostylenet.py --socket /tmp/audiostylenet.sock
+
+A job is a POST request to /render with a JSON body. The arguments are the
+same as for run_audiostylenet.py, paths refer to the file system of the
+server:
+    {"latentfile": "data/images/yt_xOpJdHiIwhQ_2.latent.pt",
+     "sentence_path": "data/audio/camila/",
+     "audiofile": "data/audio/camila/camila.mp3",
+     "direction": null,
+     "audio_multiplier": 2.0,
+     "audio_truncation": 0.8,
+     "direction_multiplier": 1.0,
+     "max_sec": null}
+The response is a fragmented mp4 (h264 + aac):
+    curl -d @job.json http://localhost:8000/render -o out.mp4
+    curl --unix-socket /tmp/audiostylenet.sock -d @job.json http://localhost/render -o out.mp4
+
+GET /health returns the number of jobs in progress.
+"""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import torch
+
+from audiostylenet import RENDER_SIZES, AudioStyleNet
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from my_models import models
+from subprocess import PIPE
+from torchvision.utils import make_grid
+from utils import utils
+
+
+class Job:
+    """
+    A video in progress. The audio is encoded in chunks as the Batcher asks
+    for frames, the rendered frames are queued and streamed into an ffmpeg
+    process by a writer thread of the job, whose output is read by the
+    request handler. A job with a full queue (a slow client) gets no new
+    frames until its writer catches up, without holding up the other jobs.
+    """
+    # Maximum number of frame batches waiting for the writer thread
+    max_queued = 4
+
+    def __init__(self,
+                 model,
+                 latentfile,
+                 sentence_path,
+                 audiofile,
+                 direction=None,
+                 audio_multiplier=2.0,
+                 audio_truncation=0.8,
+                 direction_multiplier=1.0,
+                 max_sec=None):
+        self.params = {
+            'audio_multiplier': audio_multiplier,
+            'audio_truncation': audio_truncation,
+            'direction_multiplier': direction_multiplier,
+        }
+
+        if not os.path.exists(audiofile):
+            raise FileNotFoundError(f"Audio file {audiofile} not found")
+
+        with torch.no_grad():
+            self.latent, self.audios, self.direction = model.load_inputs(
+                latentfile, sentence_path, direction, max_sec)
+            self.stream = models.AudioExpressionStream(
+                model.audio_encoder, self.latent[:, 4:8])
+
+        self.pos = 0
+        self.flushed = False
+        self.pending = self.latent.new_zeros(0, *self.latent.shape[1:])
+        self.prefix = None
+
+        self.writer = utils.VideoWriter('-', fps=25, audiofile=audiofile,
+                                        audio_codec='aac', stdout=PIPE)
+        self.stdout = None
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+        self.cancelled = False
+
+        self.frames = queue.Queue(maxsize=self.max_queued)
+        # Set by the Batcher, tells it that there is room in the queue again
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def finished(self):
+        return self.flushed and len(self.pending) == 0
+
+    @property
+    def blocked(self):
+        return self.frames.full()
+
+    def take(self, model, n, chunk_size):
+        """ Returns the latents of the next (up to) n frames """
+        while len(self.pending) < n and not self.flushed:
+            if self.pos < len(self.audios):
+                latent_offset = self.stream.push(
+                    self.audios[self.pos:self.pos + chunk_size])
+                self.pos += chunk_size
+            else:
+                latent_offset = self.stream.flush()
+                self.flushed = True
+
+            b = latent_offset.shape[0]
+            if b == 0:
+                continue
+            latent = model.add_offset(latent_offset, self.latent.repeat(b, 1, 1),
+                                      self.direction, **self.params)
+            self.pending = torch.cat((self.pending, latent))
+
+        latents, self.pending = self.pending[:n], self.pending[n:]
+        return latents
+
+    def write(self, frames):
+        self.writer.write(frames)
+        if not self.started.is_set():
+            self.stdout = self.writer.proc.stdout
+            self.started.set()
+
+    def put(self, frames):
+        """ Queues frames for the writer thread, None ends the video """
+        self.frames.put_nowait(frames)
+
+    def write_loop(self):
+        try:
+            while True:
+                frames = self.frames.get()
+                self.wakeup.set()
+                if frames is None or self.cancelled:
+                    break
+                self.write(frames)
+        except Exception as e:
+            self.error = e
+            self.cancel()
+        finally:
+            try:
+                self.writer.close()
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            if self.error is None and not self.started.is_set():
+                self.error = RuntimeError("No frames were rendered, is the audio empty?")
+            self.done.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.wakeup.set()
+        proc = self.writer.proc
+        if proc is not None:
+            proc.kill()
+
+
+class Batcher(threading.Thread):
+    """
+    Renders the frames of all active jobs. Every step takes up to batch_size
+    frames, shared evenly between the jobs, and runs them through the
+    generator as one batch.
+    """
+    def __init__(self, model, batch_size=16, render_size=1024):
+        super().__init__(daemon=True)
+        self.model = model
+        self.g = model.g
+        self.batch_size = batch_size
+        self.render_size = render_size
+        self.queue = queue.Queue()
+        self.active = []
+        self.wakeup = threading.Event()
+
+    def submit(self, job):
+        job.wakeup = self.wakeup
+        self.queue.put(job)
+        self.wakeup.set()
+
+    @property
+    def n_jobs(self):
+        return len(self.active) + self.queue.qsize()
+
+    def run(self):
+        while True:
+            # Wait for work if idle, then take all waiting jobs
+            if len(self.active) == 0:
+                self.active.append(self.queue.get())
+            while True:
+                try:
+                    self.active.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Writers which take a batch from their queue, new and cancelled
+            # jobs set the event after this
+            self.wakeup.clear()
+            with torch.no_grad():
+                n_frames = self.step()
+
+            # All active jobs wait for their writers
+            if n_frames == 0 and len(self.active) > 0:
+                self.wakeup.wait()
+
+    def fail(self, job, error):
+        # Keep the error of the writer thread if it cancelled the job
+        if job.error is None:
+            job.error = error
+        job.cancel()
+        self.active.remove(job)
+        try:
+            job.put(None)
+        except queue.Full:
+            # The writer thread sees the cancelled flag with the next batch
+            pass
+
+    def finish(self, job):
+        # Stays active until the end of the video fits into the queue
+        try:
+            job.put(None)
+        except queue.Full:
+            return
+        self.active.remove(job)
+
+    def step(self):
+        for job in [job for job in self.active if job.cancelled]:
+            self.fail(job, RuntimeError("Cancelled"))
+
+        # Collect frames, every job gets an equal share first, the rest of
+        # the batch is filled in order. Rotate to be fair about the rest.
+        self.active = self.active[1:] + self.active[:1]
+        budget = self.batch_size
+        share = max(1, budget // max(1, len(self.active)))
+        batch = {}
+        for limit in [share, budget]:
+            for job in list(self.active):
+                n = min(limit, budget)
+                if n == 0:
+                    break
+                if job.blocked:
+                    continue
+                try:
+                    latents = job.take(self.model, n, self.batch_size)
+                    if job.prefix is None and len(latents) > 0:
+                        job.prefix = self.g.prefix(latents[:1], noise=self.g.noises)
+                except Exception as e:
+                    batch.pop(job, None)
+                    self.fail(job, e)
+                    continue
+                if len(latents) > 0:
+                    batch[job] = torch.cat((batch[job], latents)) if job in batch else latents
+                budget -= len(latents)
+
+        if len(batch) > 0:
+            # Every job has its own prefix (latent rows 0-3), repeat them
+            # for the frames of the job
+            jobs = list(batch.keys())
+            sizes = [len(batch[job]) for job in jobs]
+            latent = torch.cat([batch[job] for job in jobs])
+            out = torch.cat([job.prefix[0].repeat(n, 1, 1, 1) for job, n in zip(jobs, sizes)])
+            skip = torch.cat([job.prefix[1].repeat(n, 1, 1, 1) for job, n in zip(jobs, sizes)])
+            prefix = (out, skip, jobs[0].prefix[2])
+
+            try:
+                # Generate images
+                pred = self.g([latent], input_is_latent=True, noise=self.g.noises,
+                              prefix=prefix, size=self.render_size)[0]
+                pred = utils.downsample_256(pred)
+
+                # Normalize
+                frames = torch.stack([make_grid(p, normalize=True, range=(-1, 1))
+                                      for p in pred.cpu()])
+            except Exception as e:
+                # E.g. out of memory, the frames of the batch are lost, but
+                # the server keeps running
+                print(f"Rendering a batch of {len(latent)} frames failed: {e!r}")
+                for job in jobs:
+                    self.fail(job, e)
+                return len(latent)
+
+            # Every job in the batch had room in its queue
+            for job, frames_job in zip(jobs, frames.split(sizes)):
+                try:
+                    job.put(frames_job)
+                except Exception as e:
+                    self.fail(job, e)
+
+        for job in [job for job in self.active if job.finished]:
+            self.finish(job)
+
+        return self.batch_size - budget
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'local'
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'jobs': self.server.batcher.n_jobs})
+        else:
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            job = Job(self.server.model, **request)
+        except Exception as e:
+            self.send_json(400, {'error': repr(e)})
+            return
+
+        self.server.batcher.submit(job)
+
+        # Wait for the first frames
+        while not job.started.wait(0.1):
+            if job.done.is_set():
+                break
+        if not job.started.is_set():
+            self.send_json(500, {'error': repr(job.error)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            while True:
+                chunk = job.stdout.read1(1 << 16)
+                if not chunk:
+                    break
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            job.done.wait()
+            if job.error is not None:
+                # Without the last chunk the client sees an incomplete response
+                self.log_error("Job failed: %r", job.error)
+                self.close_connection = True
+                return
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            job.cancel()
+            self.close_connection = True
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='model/audiostylenet.pt')
+    parser.add_argument('--gpu', type=int, default=0)
+    parser.add_argument('--audio_type', type=str, default='deepspeech')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--render_size', type=int, default=1024, choices=RENDER_SIZES)
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help="Generator precision, bf16 on CPU, fp16 or bf16 on GPU")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default=None, help="Listen on a Unix socket instead")
+    args = parser.parse_args()
+
+    device = f"cuda:{args.gpu}"
+
+    # Init model
+    model = AudioStyleNet(
+        model_path=args.model_path,
+        device=device,
+        audio_type=args.audio_type,
+        T=8,
+        precision=args.precision
+    )
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, Handler)
+        print(f"Listening on {args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        print(f"Listening on http://{args.host}:{args.port}")
+
+    server.model = model
+    server.batcher = Batcher(model, batch_size=args.batch_size,
+                             render_size=args.render_size)
+    server.batcher.start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -9,11 +9,11 @@ from datetime import datetime
 from glob import glob
 from lpips import PerceptualLoss
 from my_models import models, style_gan_2
-from subprocess import Popen, PIPE
 from torch.utils.data import DataLoader
 from torchvision.utils import save_image, make_grid
 from tqdm import tqdm
 from utils import datasets, utils
+from utils.latent_bank import LatentBank
 
 
 HOME = os.path.expanduser('~')
@@ -140,7 +140,8 @@ class Solver:
         latent_mse = latent_mse.mean()
 
         # Reconstruct image
-        pred_img = self.g([pred], input_is_latent=True, noise=self.g.noises)[0]
+        pred_img = self.g([pred], input_is_latent=True, noise=self.g.noises,
+                          size=self.args.render_size)[0]
         pred_img = utils.downsample_256(pred_img)
 
         # Visualize
@@ -311,14 +312,17 @@ class Solver:
         with torch.no_grad():
             # Forward
             pred = self.forward(audio, input_latent, aux_input)
-            input_img, _ = self.g([input_latent], input_is_latent=True, noise=self.g.noises)
+            input_img, _ = self.g([input_latent], input_is_latent=True, noise=self.g.noises,
+                                  size=self.args.render_size)
             input_img = utils.downsample_256(input_img)
 
             pred, _ = self.g(
-                [pred], input_is_latent=True, noise=self.g.noises)
+                [pred], input_is_latent=True, noise=self.g.noises,
+                size=self.args.render_size)
             pred = utils.downsample_256(pred)
             target_img, _ = self.g(
-                [target_latent], input_is_latent=True, noise=self.g.noises)
+                [target_latent], input_is_latent=True, noise=self.g.noises,
+                size=self.args.render_size)
             target_img = utils.downsample_256(target_img)
 
         # Normalize images to display
@@ -342,7 +346,11 @@ class Solver:
             if split[-2].startswith('TV'):
                 continue
             if self.args.random_inp_latent:
-                latent = random.choice(glob(sentence + '*.latent.pt'))
+                if LatentBank.exists(sentence):
+                    bank = LatentBank(sentence)
+                    latent = bank[random.choice(bank.ids)]
+                else:
+                    latent = random.choice(glob(sentence + '*.latent.pt'))
             else:
                 latent = sentence + 'mean.latent.pt'
             audio_file = '/'.join(split[:-3] + ['AudioMP3'] + [split[-2]]) + '.mp3'
@@ -356,75 +364,100 @@ class Solver:
         self.audio_encoder.eval()
         if test_sentence_path[-1] != '/':
             test_sentence_path += '/'
-        test_latent = torch.load(test_latent_path).unsqueeze(0).to(self.device)
+        if type(test_latent_path) is str:
+            test_latent = torch.load(test_latent_path)
+        else:
+            test_latent = test_latent_path
+        test_latent = test_latent.unsqueeze(0).to(self.device)
         aux_input = test_latent[:, 4:8]
 
         sentence_name = test_sentence_path.split('/')[-2]
 
         # Load audio features
         audio_type = 'deepspeech' if self.args.audio_type == 'deepspeech-synced' else self.args.audio_type
-        audio_paths = sorted(glob(test_sentence_path + f'*.{audio_type}.npy'))[:frames]
-        audios = torch.stack([torch.tensor(np.load(p), dtype=torch.float32) for p in audio_paths]).to(self.device)
+        audios = utils.load_audio_features(test_sentence_path, audio_type)[:frames]
+        audios = torch.tensor(np.array(audios), dtype=torch.float32).to(self.device)
         # Pad audio features
         pad = self.args.T // 2
         audios = F.pad(audios, (0, 0, 0, 0, pad, pad - 1), 'constant', 0.)
         audios = audios.unfold(0, self.args.T, 1).permute(0, 3, 1, 2)
 
-        target_latent_paths = sorted(glob(test_sentence_path + '*.latent.pt'))[:frames]
-        target_latents = torch.stack([torch.load(p) for p in target_latent_paths]).to(self.device)
+        if LatentBank.exists(test_sentence_path):
+            target_latents = LatentBank(test_sentence_path).get()[:frames].to(self.device)
+        else:
+            target_latent_paths = sorted(glob(test_sentence_path + '*.latent.pt'))[:frames]
+            target_latents = torch.stack([torch.load(p) for p in target_latent_paths]).to(self.device)
 
         pbar = tqdm(total=len(target_latents))
-        video = []
+        prefix = None
 
-        # Generate
-        for i, (audio, target_latent) in enumerate(zip(audios, target_latents)):
-            audio = audio.unsqueeze(0)
-            target_latent = target_latent.unsqueeze(0)
-            with torch.no_grad():
-                input_latent = test_latent.clone()
-                latent = self.forward(audio, input_latent, aux_input)
-                # Generate images
-                pred = self.g([latent], input_is_latent=True, noise=self.g.noises)[0]
-                # target_img = self.g([target_latent], input_is_latent=True, noise=self.g.noises)[0]
-                # Downsample
-                pred = utils.downsample_256(pred)
-                # target_img = utils.downsample_256(target_img)
-            pbar.update()
-            # Normalize
-            pred = make_grid(pred.cpu(), normalize=True, range=(-1, 1))
-            # target_img = make_grid(target_img.cpu(), normalize=True, range=(-1, 1))
-            # diff = (target_img - pred) * 5
-
-            # save_tensor = torch.stack((pred, target_img, diff), dim=0)
-            # video.append(make_grid(save_tensor))
-            video.append(make_grid(pred))
-
-        # Save frames as video
-        video = torch.stack(video, dim=0)
+        # Frames are streamed into ffmpeg together with the audio
         video_name = f"{self.args.save_dir}results/{mode}{sentence_name}"
         os.makedirs(f"{self.args.save_dir}results", exist_ok=True)
-        utils.write_video(f'{video_name}.mp4', video, fps=25)
+        writer = utils.VideoWriter(f'{video_name}.mov', fps=25, audiofile=audio_file_path)
 
-        # Add audio
-        p = Popen(['ffmpeg', '-y', '-i', f'{video_name}.mp4', '-i', audio_file_path, '-codec', 'copy', '-shortest', f'{video_name}.mov'],
-                  stdout=PIPE, stderr=PIPE)
-        output, error = p.communicate()
-        if p.returncode != 0:
-            print("Adding audio from %s to video %s failed with error\n%d %s %s" % (
-                  audio_file_path, f'{video_name}.mp4', p.returncode, output, error))
-        os.system(f"rm {video_name}.mp4")
+        # Generate
+        try:
+            for i, (audio, target_latent) in enumerate(zip(audios, target_latents)):
+                audio = audio.unsqueeze(0)
+                target_latent = target_latent.unsqueeze(0)
+                with torch.no_grad():
+                    input_latent = test_latent.clone()
+                    latent = self.forward(audio, input_latent, aux_input)
+                    # Layers reading only rows 0-3 are the same for every frame,
+                    # rows 8-17 are the same as well
+                    if prefix is None:
+                        prefix = self.g.prefix(latent, noise=self.g.noises)
+                        self.g.freeze_styles(latent, start=8)
+                    # Generate images
+                    pred = self.g([latent], input_is_latent=True, noise=self.g.noises,
+                                  prefix=prefix, size=self.args.render_size)[0]
+                    # target_img = self.g([target_latent], input_is_latent=True, noise=self.g.noises)[0]
+                    # Downsample
+                    pred = utils.downsample_256(pred)
+                    # target_img = utils.downsample_256(target_img)
+                pbar.update()
+                # Normalize
+                pred = make_grid(pred.cpu(), normalize=True, range=(-1, 1))
+                # target_img = make_grid(target_img.cpu(), normalize=True, range=(-1, 1))
+                # diff = (target_img - pred) * 5
 
-        self.audio_encoder.train()
+                # save_tensor = torch.stack((pred, target_img, diff), dim=0)
+                # writer.write(make_grid(save_tensor))
+                writer.write(make_grid(pred))
+        finally:
+            self.g.unfreeze_styles()
+
+            try:
+                writer.close()
+            except RuntimeError as e:
+                print(e)
+
+            self.audio_encoder.train()
 
 
 def load_data(args):
     # Load data
-    train_paths = datasets.get_video_paths_by_file(
-        args.data_path, args.train_paths_file, args.max_frames_per_vid)
-    val_paths = datasets.get_video_paths_by_file(
-        args.data_path, args.val_paths_file, args.max_frames_per_vid)
-    test_paths = datasets.get_video_paths_by_file(
-        args.data_path, args.test_paths_file, args.max_frames_per_vid)
+    if args.packed_data_path is not None:
+        # Videos packed with data_helpers.pack_dataset
+        def get_paths(paths_file):
+            return datasets.get_packed_video_paths_by_file(
+                args.data_path, args.packed_data_path, paths_file, args.max_frames_per_vid)
+
+        def make_dataset(paths, **kwargs):
+            return datasets.PackedAudioVisualDataset(
+                paths=paths, packed_root=args.packed_data_path, **kwargs)
+    else:
+        def get_paths(paths_file):
+            return datasets.get_video_paths_by_file(
+                args.data_path, paths_file, args.max_frames_per_vid)
+
+        def make_dataset(paths, **kwargs):
+            return datasets.AudioVisualDataset(paths=paths, **kwargs)
+
+    train_paths = get_paths(args.train_paths_file)
+    val_paths = get_paths(args.val_paths_file)
+    test_paths = get_paths(args.test_paths_file)
 
     if args.overfit:
         train_paths = [train_paths[0]]
@@ -438,7 +471,7 @@ def load_data(args):
     for i in range(5):
         print(val_paths[i][0])
 
-    train_ds = datasets.AudioVisualDataset(
+    train_ds = make_dataset(
         paths=train_paths,
         audio_type=args.audio_type,
         load_img=True,
@@ -450,7 +483,7 @@ def load_data(args):
         std=[0.5, 0.5, 0.5],
         image_size=256,
     )
-    val_ds = datasets.AudioVisualDataset(
+    val_ds = make_dataset(
         paths=val_paths,
         audio_type=args.audio_type,
         load_img=True,
@@ -517,6 +550,7 @@ if __name__ == '__main__':
     parser.add_argument('--random_inp_latent', type=bool, default=False)
     parser.add_argument('--static_random_inp_latent', type=bool, default=False)
     parser.add_argument('--image_loss_type', type=str, default='lpips')  # 'lpips' or 'l1'
+    parser.add_argument('--render_size', type=int, default=1024, choices=[256, 512, 1024])  # 1024 or 256, 256 skips the two finest generator blocks
 
     parser.add_argument('--test_multiplier', type=float, default=2.0)  # During test time, direction is multiplied with
     parser.add_argument('--test_truncation', type=float, default=.8)  # After multiplication, truncate to mean latent
@@ -543,6 +577,7 @@ if __name__ == '__main__':
                         default=f'{DATAROOT}AudioVisualDataset/split_files/val_videos.txt')
     parser.add_argument('--test_paths_file', type=str,
                         default=f'{DATAROOT}AudioVisualDataset/split_files/test_videos.txt')
+    parser.add_argument('--packed_data_path', type=str, default=None)  # Output of data_helpers.pack_dataset, None reads data_path
     parser.add_argument('--model_path', type=str, default=None)
     args = parser.parse_args()
 
@@ -83,7 +83,8 @@ class solverEncoder:
 
         # Decode
         img_gen, _ = self.g(
-            [latent], input_is_latent=True, noise=self.g.noises)
+            [latent], input_is_latent=True, noise=self.g.noises,
+            size=self.args.render_size)
         # Downsample to 256 x 256
         img_gen = utils.downsample_256(img_gen)
 
@@ -221,7 +222,8 @@ class solverEncoder:
         with torch.no_grad():
             # Generate random image
             z = torch.randn(self.args.batch_size, 512, device=self.device)
-            img, _ = self.g([z], truncation=0.9, truncation_latent=self.latent_avg)
+            img, _ = self.g([z], truncation=0.9, truncation_latent=self.latent_avg,
+                            size=self.args.render_size)
             img = utils.downsample_256(img)
 
             # Forward
@@ -310,6 +312,7 @@ if __name__ == '__main__':
 
     parser.add_argument('--batch_size', type=int, default=4)  # 4
     parser.add_argument('--lr', type=int, default=0.01)  # 0.01
+    parser.add_argument('--render_size', type=int, default=1024)  # 1024 or 256
     parser.add_argument('--n_iters', type=int, default=50000)  # 150000
     parser.add_argument('--log_train_every', type=int, default=100)  # 1
     parser.add_argument('--log_val_every', type=int, default=1000)   # 1000
@@ -42,13 +42,20 @@ def align_videos(root_path, group):
         aligner.align_video(video, save_dir)
 
 
-def encode_frames(root_path):
+def encode_frames(root_path, half=False):
+    """
+    Encodes the frames of every video in root_path and saves their latents
+    as one LatentBank per video (float16 if half). Videos which already have
+    a bank are skipped.
+    """
+    from utils.latent_bank import LatentBank
+
     if root_path[-1] != '/':
         root_path += '/'
 
     videos = sorted(glob(root_path + '*/'))
-    videos = [sorted(glob(v + '*.png')) for v in videos]
-    all_frames = [item for sublist in videos for item in sublist]
+    videos = [(v, sorted(glob(v + '*.png'))) for v in videos]
+    all_frames = [item for _, sublist in videos for item in sublist]
     assert len(all_frames) > 0
     print(len(all_frames))
 
@@ -77,54 +84,193 @@ def encode_frames(root_path):
         transforms.Normalize([0.5, 0.5, 0.5], [0.5, 0.5, 0.5])
     ])
 
-    for frame in tqdm(all_frames):
-        save_path = frame.split('.')[0] + '.latent.pt'
-        # print(save_path)
-        if os.path.exists(save_path):
+    for video, frames in tqdm(videos):
+        if len(frames) == 0 or LatentBank.exists(video):
             continue
 
-        # Load image
-        img = t(Image.open(frame)).unsqueeze(0).to(device)
-
-        # Encoder image
-        with torch.no_grad():
-            latent_offset = e(img)[0].cpu()
-            latent = latent_offset + latent_avg
-
-        # Visualize
-        from torchvision.utils import make_grid
-        from utils.utils import downsample_256
-        print(save_path, latent.shape)
-        img_gen = g.to(device)([latent.unsqueeze(0).to(device)],
-                               input_is_latent=True, noise=g.noises)[0].cpu()
-        img_gen = downsample_256(img_gen)
-        img_gen = make_grid(torch.cat((img_gen, img.cpu()),
-                                      dim=0), normalize=True, range=(-1, 1))
-        img_gen = transforms.ToPILImage('RGB')(img_gen)
-        img_gen.show()
-        1 / 0
+        latents = []
+        for frame in frames:
+            # Load image
+            img = t(Image.open(frame)).unsqueeze(0).to(device)
+
+            # Encoder image
+            with torch.no_grad():
+                latent_offset = e(img)[0].cpu()
+                latent = latent_offset + latent_avg
+
+            # Visualize
+            # from torchvision.utils import make_grid
+            # from utils.utils import downsample_256
+            # img_gen = g.to(device)([latent.unsqueeze(0).to(device)],
+            #                        input_is_latent=True, noise=g.noises)[0].cpu()
+            # img_gen = downsample_256(img_gen)
+            # img_gen = make_grid(torch.cat((img_gen, img.cpu()),
+            #                               dim=0), normalize=True, range=(-1, 1))
+            # img_gen = transforms.ToPILImage('RGB')(img_gen)
+            # img_gen.show()
+            # 1 / 0
+
+            latents.append(latent)
 
         # Save
-        torch.save(latent, save_path)
+        ids = [f.split('/')[-1].split('.')[0] for f in frames]
+        LatentBank.save(video, ids, torch.stack(latents), half=half)
 
 
 def get_mean_latents(root):
+    from utils.latent_bank import LatentBank
+
     # Load paths
     videos = sorted(glob(root + '*/'))
 
     for video in tqdm(videos):
-        latent_paths = sorted(glob(video + '*.latent.pt'))
-
-        mean_latent = []
-        for latent_path in latent_paths:
-            latent = torch.load(latent_path).unsqueeze(0)
-            mean_latent.append(latent)
-        mean_latent = torch.cat(mean_latent, dim=0).mean(dim=0)
+        if LatentBank.exists(video):
+            mean_latent = LatentBank(video).mean()
+        else:
+            # Legacy per-frame latents
+            latent_paths = sorted(glob(video + '*.latent.pt'))
+
+            mean_latent = []
+            for latent_path in latent_paths:
+                latent = torch.load(latent_path).unsqueeze(0)
+                mean_latent.append(latent)
+            mean_latent = torch.cat(mean_latent, dim=0).mean(dim=0)
 
         # Save
         torch.save(mean_latent, video + 'mean.latent.pt')
 
 
+def bank_latents(root, half=False, remove=False):
+    """
+    Converts the per-frame latents (00001.latent.pt, ...) of all videos in
+    root into one LatentBank per video
+    """
+    from utils.latent_bank import LatentBank
+
+    if root[-1] != '/':
+        root += '/'
+    videos = sorted(glob(root + '*/'))
+
+    for video in tqdm(videos):
+        latent_paths = sorted(p for p in glob(video + '*.latent.pt')
+                              if not p.endswith('mean.latent.pt'))
+        if len(latent_paths) == 0 or LatentBank.exists(video):
+            continue
+
+        ids = [p.split('/')[-1].split('.')[0] for p in latent_paths]
+        latents = torch.stack([torch.load(p) for p in latent_paths])
+        LatentBank.save(video, ids, latents, half=half)
+
+        if remove:
+            for p in latent_paths:
+                os.remove(p)
+
+
+def pack_audio_features(root, audio_type='deepspeech', remove=False):
+    """
+    Converts the per-frame audio features (00001.deepspeech.npy, ...) of all
+    videos in root into one packed file per video
+    (see utils.load_audio_features)
+    """
+    import numpy as np
+    from utils.utils import packed_audio_path
+
+    if root[-1] != '/':
+        root += '/'
+    videos = sorted(glob(root + '*/'))
+
+    for video in tqdm(videos):
+        audio_paths = sorted(glob(video + f'*.{audio_type}.npy'))
+        if len(audio_paths) == 0:
+            continue
+
+        # Row i of the packed file must be frame i + 1
+        frames = [int(p.split('/')[-1].split('.')[0]) for p in audio_paths]
+        if frames != list(range(1, len(frames) + 1)):
+            print(f"Skipping {video}, frames are not numbered 1 to {len(frames)}")
+            continue
+
+        audio = np.stack([np.load(p) for p in audio_paths]).astype(np.float32)
+        np.save(packed_audio_path(video, audio_type), audio)
+
+        if remove:
+            for p in audio_paths:
+                os.remove(p)
+
+
+def pack_dataset(root, target, audio_types=('deepspeech',), half=False):
+    """
+    Packs every video of an Aligned256 tree (root/<video>/00001.png,
+    00001.latent.pt, 00001.deepspeech.npy, mean.latent.pt, ...) into
+    contiguous arrays for datasets.PackedAudioVisualDataset:
+
+        target/<video>/index.txt          frame names, one per line
+        target/<video>/frames.npy         uint8, [n_frames, h, w, 3]
+        target/<video>/latents.npy        LatentBank (float16 if half)
+        target/<video>/mean.latent.npy    float32, [18, 512]
+        target/<video>/<audio_type>.npy   float32, [n_frames, 16, 29]
+
+    Row k of every array belongs to line k of index.txt. Videos which are
+    already packed are skipped.
+    """
+    import numpy as np
+    from utils.latent_bank import LatentBank
+    from utils.utils import load_audio_features
+
+    if root[-1] != '/':
+        root += '/'
+    videos = sorted(glob(root + '*/'))
+    assert len(videos) > 0
+
+    for video in tqdm(videos):
+        names = sorted([os.path.basename(p).split('.')[0] for p in glob(video + '*.png')])
+        if len(names) == 0:
+            continue
+
+        # Row k of the arrays must be frame k + 1
+        numbers = [int(name) if name.isdigit() else -1 for name in names]
+        if numbers != list(range(1, len(names) + 1)):
+            print(f"Skipping {video}, frames are not numbered 1 to {len(names)}")
+            continue
+
+        save_dir = os.path.join(target, video.split('/')[-2])
+        if os.path.exists(os.path.join(save_dir, 'index.txt')):
+            continue
+        os.makedirs(save_dir, exist_ok=True)
+        frames = [video + name for name in names]
+
+        # Images, written frame by frame
+        img = np.asarray(Image.open(frames[0] + '.png').convert('RGB'))
+        frames_out = np.lib.format.open_memmap(
+            os.path.join(save_dir, 'frames.npy'), mode='w+', dtype=np.uint8,
+            shape=(len(frames),) + img.shape)
+        for i, frame in enumerate(frames):
+            frames_out[i] = np.asarray(Image.open(frame + '.png').convert('RGB'))
+        frames_out.flush()
+        del frames_out
+
+        # Latents
+        if LatentBank.exists(video):
+            LatentBank.save(save_dir, names, LatentBank(video).get(names), half=half)
+        elif os.path.exists(frames[0] + '.latent.pt'):
+            latents = torch.stack([torch.load(f + '.latent.pt') for f in frames])
+            LatentBank.save(save_dir, names, latents, half=half)
+        if os.path.exists(video + 'mean.latent.pt'):
+            np.save(os.path.join(save_dir, 'mean.latent.npy'),
+                    torch.load(video + 'mean.latent.pt').numpy().astype(np.float32))
+
+        # Audio, row i of the features belongs to frame i + 1
+        for audio_type in audio_types:
+            audio = load_audio_features(video, audio_type)
+            rows = [int(name) - 1 for name in names]
+            np.save(os.path.join(save_dir, f'{audio_type}.npy'),
+                    np.asarray(audio[rows], dtype=np.float32))
+
+        # The index is written last, it marks the video as complete
+        with open(os.path.join(save_dir, 'index.txt'), 'w') as f:
+            f.write('\n'.join(names) + '\n')
+
+
 if __name__ == "__main__":
 
     path = sys.argv[1]
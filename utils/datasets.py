@@ -3,6 +3,7 @@ File to specify dataloaders for different datasets
 """
 
 import numpy as np
+import os
 import random
 import torch
 
@@ -12,7 +13,8 @@ from PIL import Image
 from torch.utils.data import Sampler
 from torch.utils.data.dataset import Dataset, IterableDataset
 from torchvision import transforms
-from utils.utils import downsample_256
+from utils.latent_bank import LatentBank
+from utils.utils import downsample_256, packed_audio_path
 
 
 class Downsample(object):
@@ -91,6 +93,8 @@ class AudioVisualDataset(Dataset):
         self.len_dataset = len_dataset
 
         self.paths = [item for sublist in paths for item in sublist]
+        self.packed_audio = {}
+        self.latent_banks = {}
 
         # Transforms
         if int(np.log2(image_size)) - np.log2(image_size) == 0:
@@ -104,6 +108,26 @@ class AudioVisualDataset(Dataset):
     def __len__(self):
         return self.len_dataset if self.len_dataset else len(self.paths)
 
+    def load_packed_audio(self, video):
+        """
+        Memory maps the packed audio features of video, None if the video
+        only has per-frame files
+        """
+        if video not in self.packed_audio:
+            path = packed_audio_path(video, self.audio_type)
+            self.packed_audio[video] = np.load(path, mmap_mode='r') \
+                if os.path.exists(path) else None
+        return self.packed_audio[video]
+
+    def load_latent_bank(self, video):
+        """
+        LatentBank of video, None if the video only has per-frame latents
+        """
+        if video not in self.latent_banks:
+            self.latent_banks[video] = LatentBank(video) \
+                if LatentBank.exists(video) else None
+        return self.latent_banks[video]
+
     def __getitem__(self, indices):
         paths = [self.paths[i] for i in indices]
         audio_paths = paths[:-1]
@@ -113,11 +137,17 @@ class AudioVisualDataset(Dataset):
         video = '/'.join(input_path.split('/')[:-1]) + '/'
 
         # Load audio
-        audio = []
-        for p in audio_paths:
-            audio.append(torch.tensor(
-                np.load(f"{p}.{self.audio_type}.npy"), dtype=torch.float32)[:, :32])
-        audio = torch.stack(audio, dim=0)
+        packed = self.load_packed_audio(video)
+        if packed is not None:
+            # Row i of the packed file belongs to frame i + 1
+            rows = [int(p.split('/')[-1]) - 1 for p in audio_paths]
+            audio = torch.tensor(packed[rows], dtype=torch.float32)[:, :, :32]
+        else:
+            audio = []
+            for p in audio_paths:
+                audio.append(torch.tensor(
+                    np.load(f"{p}.{self.audio_type}.npy"), dtype=torch.float32)[:, :32])
+            audio = torch.stack(audio, dim=0)
 
         # Load images
         if self.load_img:
@@ -127,11 +157,144 @@ class AudioVisualDataset(Dataset):
 
         # Load latents
         if self.load_latent:
+            bank = self.load_latent_bank(video)
             if self.random_inp_latent:
-                input_latent = torch.load(input_path + ".latent.pt")
+                if bank is not None:
+                    input_latent = bank[input_path.split('/')[-1]]
+                else:
+                    input_latent = torch.load(input_path + ".latent.pt")
             else:
                 input_latent = torch.load(video + 'mean.latent.pt')
-            target_latent = torch.load(target_path + ".latent.pt")
+            if bank is not None:
+                target_latent = bank[target_path.split('/')[-1]]
+            else:
+                target_latent = torch.load(target_path + ".latent.pt")
+        else:
+            target_latent = torch.tensor(0.)
+            input_latent = torch.tensor(0.)
+
+        return {
+            'audio': audio,
+            'target_img': target_img,
+            'input_latent': input_latent,
+            'target_latent': target_latent,
+            'indices': indices,
+            'paths': paths
+        }
+
+
+class PackedAudioVisualDataset(Dataset):
+    """
+    AudioVisualDataset on videos packed with data_helpers.pack_dataset. The
+    arrays of every video are memory mapped once per worker, a sample does
+    no file system access apart from reading the mapped pages.
+
+    paths are the same as for AudioVisualDataset (.../<video>/<frame>), e.g.
+    from get_packed_video_paths_by_file, so RandomAudioSampler works
+    unchanged. Only the video and frame names are used to look up the rows
+    in packed_root.
+
+    example usage:
+        paths = get_packed_video_paths_by_file(data_path, packed_root, paths_file)
+        ds = PackedAudioVisualDataset(paths, packed_root, load_latent=True)
+
+    args:
+        paths (list of lists): frame paths of every video
+        packed_root (str): target directory of data_helpers.pack_dataset
+        other args as for AudioVisualDataset
+    """
+    def __init__(self,
+                 paths,
+                 packed_root,
+                 audio_type='deepspeech',
+                 load_img=True,
+                 load_latent=False,
+                 random_inp_latent=False,
+                 T=8,
+                 normalize=False,
+                 mean=[0.5, 0.5, 0.5],
+                 std=[0.5, 0.5, 0.5],
+                 image_size=256,
+                 len_dataset=None):
+        super().__init__()
+        self.packed_root = packed_root
+        self.audio_type = audio_type
+        self.load_img = load_img
+        self.load_latent = load_latent
+        self.random_inp_latent = random_inp_latent
+        self.normalize = normalize
+        self.mean = mean
+        self.std = std
+        self.T = T
+        self.len_dataset = len_dataset
+
+        self.paths = [item for sublist in paths for item in sublist]
+
+        # Map every path to (video, row)
+        self.rows = []
+        indices = {}
+        for path in self.paths:
+            video, frame = path.split('/')[-2:]
+            if video not in indices:
+                index = read_packed_index(packed_root, video)
+                indices[video] = {name: row for row, name in enumerate(index)}
+            self.rows.append((video, indices[video][frame]))
+
+        # Memory maps, opened lazily in every worker
+        self.arrays = {}
+        self.latent_banks = {}
+
+        # Transforms
+        if int(np.log2(image_size)) - np.log2(image_size) == 0:
+            trans = [transforms.ToTensor(), Downsample(image_size)]
+        else:
+            trans = [transforms.ToPILImage(), transforms.Resize(image_size),
+                     transforms.ToTensor()]
+        if self.normalize:
+            trans.append(transforms.Normalize(mean=self.mean, std=self.std))
+        self.t = transforms.Compose(trans)
+
+    def __len__(self):
+        return self.len_dataset if self.len_dataset else len(self.paths)
+
+    def array(self, video, name):
+        key = (video, name)
+        if key not in self.arrays:
+            path = os.path.join(self.packed_root, video, f'{name}.npy')
+            self.arrays[key] = np.load(path, mmap_mode='r')
+        return self.arrays[key]
+
+    def latent_bank(self, video):
+        if video not in self.latent_banks:
+            self.latent_banks[video] = LatentBank(
+                os.path.join(self.packed_root, video))
+        return self.latent_banks[video]
+
+    def __getitem__(self, indices):
+        paths = [self.paths[i] for i in indices]
+        rows = [self.rows[i][1] for i in indices]
+        video = self.rows[indices[-1]][0]
+        audio_rows = rows[:-1]
+        target_row = rows[self.T // 2]
+
+        # Load audio
+        audio = self.array(video, self.audio_type)[audio_rows]
+        audio = torch.tensor(audio, dtype=torch.float32)
+
+        # Load images
+        if self.load_img:
+            target_img = self.t(np.array(self.array(video, 'frames')[target_row]))
+        else:
+            target_img = torch.tensor(0.)
+
+        # Load latents
+        if self.load_latent:
+            bank = self.latent_bank(video)
+            if self.random_inp_latent:
+                input_latent = bank[paths[-1].split('/')[-1]]
+            else:
+                input_latent = torch.tensor(self.array(video, 'mean.latent'))
+            target_latent = bank[paths[self.T // 2].split('/')[-1]]
         else:
             target_latent = torch.tensor(0.)
             input_latent = torch.tensor(0.)
@@ -147,11 +310,12 @@ class AudioVisualDataset(Dataset):
 
 
 class StyleGANDataset(IterableDataset):
-    def __init__(self, batch_size, downsample=True, device='cuda'):
+    def __init__(self, batch_size, downsample=True, render_size=1024, device='cuda'):
         super(StyleGANDataset, self).__init__()
         self.batch_size = batch_size
         self.device = device
         self.downsample = downsample
+        self.render_size = render_size
 
         # Init generator
         self.g = Generator(1024, 512, 8, pretrained=True).eval().to(self.device)
@@ -166,9 +330,10 @@ class StyleGANDataset(IterableDataset):
 
         # Generate image
         with torch.no_grad():
-            img, _ = self.g([z], truncation=0.9, truncation_latent=self.g.latent_avg)
+            img, _ = self.g([z], truncation=0.9, truncation_latent=self.g.latent_avg,
+                            size=self.render_size)
 
-        # Resize from 1024 to 256
+        # Resize to 256
         if self.downsample:
             img = downsample_256(img)
 
@@ -186,6 +351,28 @@ def get_video_paths_by_file(root_path, filename, max_frames_per_vid=-1):
     return videos
 
 
+def read_packed_index(packed_root, video):
+    with open(os.path.join(packed_root, video, 'index.txt'), 'r') as f:
+        return f.read().split()
+
+
+def get_packed_video_paths_by_file(root_path, packed_root, filename, max_frames_per_vid=-1):
+    """
+    Same as get_video_paths_by_file, but reads the frames of every video from
+    the index written by data_helpers.pack_dataset instead of globbing
+    root_path.
+    """
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+    videos = [line.replace('\n', '') for line in lines]
+    random.shuffle(videos)
+
+    videos = [[root_path + v + '/' + frame for frame in read_packed_index(packed_root, v)][:max_frames_per_vid]
+              for v in videos]
+
+    return videos
+
+
 class RandomAudioSampler(Sampler):
     """
     Samples batches of sequential indices of length T + 1 (last index is for
@@ -0,0 +1,158 @@
+"""
+Content-addressed cache of extracted audio features. A clip which was
+rendered before, with whatever settings, never runs the DeepSpeech
+extraction again.
+
+Entries are keyed by the sha1 of the wav file and the extraction config
+(graph file, target fps, window size and stride) and stored as packed
+feature arrays [n_frames, window_size, 29]:
+
+    <FEATURE_CACHE_DIR>/<key>.npy
+
+The cache lives in FEATURE_CACHE_DIR (default
+~/.cache/audiostylenet/features). When it grows beyond FEATURE_CACHE_SIZE MB
+(default 10240), the least recently used entries are deleted.
+
+On a miss, deepspeech/run_voca_feature_extraction.py runs in a subprocess
+with the python set in DEEPSPEECH_PYTHON (default: this python), e.g. the
+python of the deepspeech conda environment.
+
+example usage:
+    features = load_features('data/audio/camila/camila.wav')
+"""
+
+import hashlib
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEEPSPEECH_DIR = os.path.join(ROOT_DIR, 'deepspeech')
+DEEPSPEECH_GRAPH = os.path.join(DEEPSPEECH_DIR, 'ds_graph', 'output_graph.pb')
+DEEPSPEECH_PYTHON = os.environ.get('DEEPSPEECH_PYTHON', sys.executable)
+
+CACHE_DIR = os.environ.get(
+    'FEATURE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'audiostylenet', 'features'))
+CACHE_SIZE = int(os.environ.get('FEATURE_CACHE_SIZE', 10240)) * 2 ** 20
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extraction_config(graph_fname=DEEPSPEECH_GRAPH, target_fps=25, window_size=16, window_stride=1):
+    """
+    Config of the feature extraction as part of the cache key. The graph is
+    identified by path, size and modification time, hashing its contents on
+    every lookup would take longer than the lookup itself.
+    """
+    stat = os.stat(graph_fname)
+    return {
+        'graph': os.path.realpath(graph_fname),
+        'graph_size': stat.st_size,
+        'graph_mtime': int(stat.st_mtime),
+        'target_fps': float(target_fps),
+        'window_size': window_size,
+        'window_stride': window_stride,
+    }
+
+
+class FeatureCache:
+    """
+    args:
+        root (str): cache directory
+        max_bytes (int): total size of all entries, older entries are evicted
+    """
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def key(self, audiofile, config):
+        h = hashlib.sha1(file_hash(audiofile).encode())
+        for k in sorted(config):
+            h.update(f'{k}={config[k]};'.encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def get(self, key, mmap_mode='r'):
+        """ Cached features of key or None, marks the entry as recently used """
+        path = self.path(key)
+        try:
+            features = np.load(path, mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return features
+
+    def put(self, key, features):
+        os.makedirs(self.root, exist_ok=True)
+        # Write to a temporary file first, readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(features, dtype=np.float32))
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        """ Deletes least recently used entries until the cache fits max_bytes """
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.root, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.root, name))
+            total -= size
+
+    def clear(self):
+        if not os.path.exists(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.root, name))
+
+
+def run_extractor(audiofile, graph_fname=DEEPSPEECH_GRAPH, target_fps=25):
+    """ Runs deepspeech/run_voca_feature_extraction.py on one wav file """
+    with tempfile.TemporaryDirectory() as out_dir:
+        subprocess.run([DEEPSPEECH_PYTHON, 'run_voca_feature_extraction.py',
+                        '--audiofiles', os.path.abspath(audiofile),
+                        '--ds_fname', os.path.abspath(graph_fname),
+                        '--target_fps', str(target_fps),
+                        '--out_path', out_dir],
+                       cwd=DEEPSPEECH_DIR, check=True)
+        name = os.path.basename(audiofile).split('.')[0]
+        return np.load(os.path.join(out_dir, name, 'deepspeech.packed.npy'))
+
+
+def load_features(audiofile, cache=None, graph_fname=DEEPSPEECH_GRAPH, target_fps=25):
+    """
+    DeepSpeech features of a wav file, shape [n_frames, 16, 29], from the
+    cache or extracted (and cached) on a miss
+    """
+    if cache is None:
+        cache = FeatureCache()
+
+    # run_voca_feature_extraction.py always uses windows of 16 with stride 1
+    config = extraction_config(graph_fname, target_fps, window_size=16, window_stride=1)
+    key = cache.key(audiofile, config)
+
+    features = cache.get(key)
+    if features is None:
+        print(f"Extracting audio features of {audiofile}")
+        features = run_extractor(audiofile, graph_fname, target_fps)
+        cache.put(key, features)
+
+    return features
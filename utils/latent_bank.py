@@ -0,0 +1,102 @@
+"""
+Latent bank: all per-frame latents of a video in one file instead of one
+*.latent.pt pickle per frame
+"""
+
+import numpy as np
+import os
+import torch
+
+
+class LatentBank:
+    """
+    Latents of the frames of a video, stored in the video directory as
+
+        latents.npy       float32 or float16, [n_frames, n_latent, 512]
+        latents.ids.npy   frame ids (e.g. '00001'), row i belongs to ids[i]
+
+    The latents are memory mapped on first access, only the rows which are
+    used are read from disk. Rows are returned as float32 tensors.
+
+    example usage:
+        LatentBank.save(video, ids, latents, half=True)
+        bank = LatentBank(video)
+        latent = bank['00001']
+        mean_latent = bank.mean()
+
+    args:
+        video (str): directory of the video
+    """
+    FILENAME = 'latents.npy'
+    IDS_FILENAME = 'latents.ids.npy'
+
+    def __init__(self, video):
+        self.path = os.path.join(video, self.FILENAME)
+        self.ids_path = os.path.join(video, self.IDS_FILENAME)
+        self._latents = None
+        self._ids = None
+        self._rows = None
+
+    @classmethod
+    def exists(cls, video):
+        return os.path.exists(os.path.join(video, cls.IDS_FILENAME))
+
+    @classmethod
+    def save(cls, video, ids, latents, half=False):
+        """
+        Write a latent bank
+
+        :param video (str): directory of the video
+        :param ids (list of str): frame ids
+        :param latents (torch.tensor or np.array): shape [n_frames, n_latent, 512]
+        :param half (bool): store as float16
+        """
+        if torch.is_tensor(latents):
+            latents = latents.detach().cpu().numpy()
+        assert len(ids) == len(latents)
+        os.makedirs(video, exist_ok=True)
+        np.save(os.path.join(video, cls.FILENAME),
+                latents.astype(np.float16 if half else np.float32))
+        # The ids are written last, they mark the bank as complete
+        np.save(os.path.join(video, cls.IDS_FILENAME), np.array(ids, dtype=str))
+
+    @property
+    def latents(self):
+        """ Memory mapped array of all latents in storage dtype """
+        if self._latents is None:
+            self._latents = np.load(self.path, mmap_mode='r')
+        return self._latents
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = [str(i) for i in np.load(self.ids_path)]
+        return self._ids
+
+    def row(self, frame_id):
+        if self._rows is None:
+            self._rows = {frame_id: row for row, frame_id in enumerate(self.ids)}
+        return self._rows[frame_id]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, frame_id):
+        return frame_id in self.ids
+
+    def __getitem__(self, frame_id):
+        """ Latent of frame_id as float32 tensor, shape [n_latent, 512] """
+        return torch.tensor(self.latents[self.row(frame_id)], dtype=torch.float32)
+
+    def get(self, frame_ids=None):
+        """ Latents of frame_ids (all frames if None), shape [n, n_latent, 512] """
+        if frame_ids is None:
+            latents = self.latents
+        else:
+            latents = self.latents[[self.row(i) for i in frame_ids]]
+        return torch.tensor(latents, dtype=torch.float32)
+
+    def mean(self):
+        """ Mean latent over all frames, shape [n_latent, 512] """
+        return torch.tensor(self.latents.mean(axis=0, dtype=np.float64),
+                            dtype=torch.float32)
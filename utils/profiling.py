@@ -0,0 +1,391 @@
+"""
+Opt-in profiling of the rendering hot path.
+
+A Profiler registers forward hooks on all submodules of the given models,
+wraps the weight modulation / demodulation of every ModulatedConv2d (in both
+modulation modes and with frozen styles) and the upfirdn2d and
+fused_leaky_relu calls of the generator, and records wall time, bytes of the
+produced tensors, memory allocated and peak memory (both relative to the
+start of the call) and call counts of every call. Memory is that of the CUDA
+allocator if the modules are on a GPU, otherwise the resident set size of
+the process (Linux only), whose peak is sampled every millisecond and misses
+shorter spikes. Calls from several threads share the memory counters. Blocks of the
+Generator are named by resolution (g.b1024.conv1, g.b1024.to_rgb, ...).
+Code outside of modules, e.g. the frame loop of AudioStyleNet.generate(), is
+recorded with span().
+
+Results are written as
+    <out>.trace.json   Chrome trace events (chrome://tracing, ui.perfetto.dev,
+                       speedscope.app show them as flame chart)
+    <out>.folded       collapsed stacks with self time in us (flamegraph.pl,
+                       speedscope.app)
+    <out>.txt          summary table, also printed
+
+example usage:
+    with Profiler({'g': model.g, 'audio_encoder': model.audio_encoder},
+                  out='profile/camila'):
+        model.render(...)
+
+or, for every video rendered by AudioStyleNet:
+    AUDIOSTYLENET_PROFILE=profile/ python run_audiostylenet.py ...
+
+On CUDA the device is synchronized before and after every recorded call,
+which makes the times attributable but the whole run slower.
+"""
+
+import contextlib
+import functools
+import json
+import op
+import os
+import sys
+import threading
+import time
+import torch
+
+from collections import defaultdict
+from my_models import style_gan_2
+from my_models.models import AudioExpressionNet3
+from torch import nn
+
+ENV_VAR = 'AUDIOSTYLENET_PROFILE'
+
+_active = None
+_missing = object()
+
+
+@contextlib.contextmanager
+def span(name):
+    """ Records the enclosed code as name if a Profiler is active """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    profiler.push(name)
+    try:
+        yield
+    finally:
+        profiler.pop()
+
+
+def from_env(modules, name):
+    """
+    Profiler writing to $AUDIOSTYLENET_PROFILE/<name> if the variable is set
+    and no other profiler is active, a no-op context manager otherwise
+    """
+    out_dir = os.environ.get(ENV_VAR)
+    if not out_dir or _active is not None:
+        return contextlib.nullcontext()
+    return Profiler(modules, out=os.path.join(out_dir, name), name=name)
+
+
+def rss():
+    """ Resident set size of this process in bytes, None without /proc """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class Memory:
+    """
+    Memory in use and its peak since the last reset_peak() in bytes, of the
+    CUDA allocator for a CUDA device and the RSS of the process otherwise.
+    On CPU a thread samples the RSS between start() and stop().
+    """
+    def __init__(self, device, interval=0.001):
+        self.device = device
+        self.interval = interval
+        self.max_rss = 0
+
+    def current(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.memory_allocated(self.device)
+        return rss() or 0
+
+    def peak(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device)
+        return max(self.max_rss, self.current())
+
+    def reset_peak(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.max_rss = self.current()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.max_rss = max(self.max_rss, self.current())
+
+    def start(self):
+        self.reset_peak()
+        if self.device.type != 'cuda' and rss() is not None:
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if hasattr(self, 'thread'):
+            self.stopped.set()
+            self.thread.join()
+            del self.thread
+
+
+def nbytes(x):
+    if torch.is_tensor(x):
+        return x.numel() * x.element_size()
+    if isinstance(x, (list, tuple)):
+        return sum(nbytes(y) for y in x)
+    return 0
+
+
+def block_names(g):
+    """ Names of the synthesis blocks of a Generator by resolution """
+    names = {g.conv1: 'b4.conv1', g.to_rgb1: 'b4.to_rgb'}
+    for k, (conv1, conv2, to_rgb) in enumerate(
+            zip(g.convs[::2], g.convs[1::2], g.to_rgbs)):
+        res = 2 ** (k + 3)
+        names[conv1] = f'b{res}.conv1'
+        names[conv2] = f'b{res}.conv2'
+        names[to_rgb] = f'b{res}.to_rgb'
+    return names
+
+
+class Profiler:
+    """
+    Records all calls of the modules in modules while active. Not nestable,
+    calls from several threads are recorded with separate stacks. The whole
+    time the profiler is active is recorded as name, its self time is the
+    time spent outside of modules and spans, e.g. in the Python frame loop.
+
+    args:
+        modules (dict): name -> nn.Module
+        out (str): output path without extension, nothing is written if None
+        name (str): name of the outermost frame, e.g. the video
+        sync (bool): synchronize CUDA around every call, default: if any of
+                     the modules is on a CUDA device
+    """
+    def __init__(self, modules, out=None, name='run', sync=None):
+        self.modules = modules
+        self.out = out
+        self.name = name
+        if sync is None:
+            sync = any(p.is_cuda for m in modules.values() for p in m.parameters())
+        self.sync = sync and torch.cuda.is_available()
+        devices = [p.device for m in modules.values() for p in m.parameters() if p.is_cuda]
+        self.memory = Memory(devices[0] if devices else torch.device('cpu'))
+
+        self.events = []
+        self.local = threading.local()
+        self.handles = []
+        self.patches = []
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def push(self, name, label=None, root=False):
+        stack = self.stack()
+        if label is None:
+            # Spans and functions are named after the module calling them
+            label = name
+            if stack and not stack[-1]['root']:
+                label = f'{stack[-1]["label"]}.{name}'
+        # The peak counter is reset for every call, the peak of the caller
+        # so far is kept in its frame
+        memory = self.memory.current()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], self.memory.peak())
+        self.memory.reset_peak()
+        stack.append({'name': name, 'label': label, 'root': root,
+                      'children': 0., 'memory': memory, 'peak': memory,
+                      'start': self.now()})
+
+    def pop(self, output=None):
+        end = self.now()
+        stack = self.stack()
+        frame = stack.pop()
+        dur = end - frame['start']
+        peak = max(frame['peak'], self.memory.peak())
+        if stack:
+            stack[-1]['children'] += dur
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        self.events.append({
+            'name': frame['name'],
+            'label': frame['label'],
+            'stack': tuple(f['name'] for f in stack) + (frame['name'],),
+            'start': frame['start'],
+            'dur': dur,
+            'self': dur - frame['children'],
+            'bytes': nbytes(output),
+            'allocated': self.memory.current() - frame['memory'],
+            'peak': peak - frame['memory'],
+            'tid': threading.get_ident(),
+        })
+
+    def hook(self, module, name, label):
+        def pre_hook(module, input):
+            self.push(name, label)
+
+        def post_hook(module, input, output):
+            self.pop(output)
+
+        self.handles.append(module.register_forward_pre_hook(pre_hook))
+        self.handles.append(module.register_forward_hook(post_hook))
+
+    def hook_all(self, module, name, label, blocks):
+        if not isinstance(module, nn.ModuleList):
+            self.hook(module, name, label)
+        for child_name, child in module.named_children():
+            if child in blocks:
+                child_name = blocks[child]
+                child_label = f'{label.split(".")[0]}.{child_name}'
+            else:
+                child_label = f'{label}.{child_name}'
+            self.hook_all(child, child_name, child_label, blocks)
+
+    def patch(self, owner, attr, name):
+        """ Records all calls of owner.attr as name until the profiler exits """
+        fn = getattr(owner, attr)
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            self.push(name)
+            output = None
+            try:
+                output = fn(*args, **kwargs)
+                return output
+            finally:
+                self.pop(output)
+
+        self.patches.append((owner, attr, owner.__dict__.get(attr, _missing)))
+        setattr(owner, attr, wrapped)
+
+    def alias(self, owner, attr, fn):
+        """ Replaces owner.attr with fn until the profiler exits """
+        self.patches.append((owner, attr, owner.__dict__.get(attr, _missing)))
+        setattr(owner, attr, fn)
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError("Another profiler is active")
+
+        for name, model in self.modules.items():
+            blocks = block_names(model) if isinstance(model, style_gan_2.Generator) else {}
+            self.hook_all(model, name, name, blocks)
+
+            for module in model.modules():
+                if isinstance(module, style_gan_2.ModulatedConv2d):
+                    self.patch(module, 'modulated_weight', 'modulate')
+                    self.patch(module, 'activation_modulation', 'modulate')
+                    self.patch(module, 'shared_weight', 'modulate')
+                elif isinstance(module, AudioExpressionNet3):
+                    self.patch(module, 'encode_frames', 'encode_frames')
+                    self.patch(module, 'attend', 'attend')
+
+        # Patch the ops in the modules which define them (FusedLeakyReLU
+        # calls op.fused_act.fused_leaky_relu), the names imported from
+        # there get the same wrapper, so every call is recorded once
+        for module, attr in [(sys.modules['op.upfirdn2d'], 'upfirdn2d'),
+                             (sys.modules['op.fused_act'], 'fused_leaky_relu')]:
+            self.patch(module, attr, attr)
+            self.alias(op, attr, getattr(module, attr))
+            self.alias(style_gan_2, attr, getattr(module, attr))
+
+        _active = self
+        self.memory.start()
+        self.start = self.now()
+        self.push(self.name, root=True)
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+
+        # After an exception, calls which did not return are still open
+        while self.stack():
+            self.pop()
+        self.memory.stop()
+
+        for handle in self.handles:
+            handle.remove()
+        for owner, attr, fn in reversed(self.patches):
+            if fn is _missing:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, fn)
+        self.handles = []
+        self.patches = []
+
+        if self.out is not None:
+            self.save(self.out)
+            print(self.summary())
+
+    def summary(self):
+        """
+        Table of calls, time, produced bytes and the largest peak memory of a
+        call per module, slowest first
+        """
+        rows = defaultdict(lambda: [0, 0., 0., 0, 0])
+        for e in self.events:
+            row = rows[e['label']]
+            row[0] += 1
+            row[1] += e['dur']
+            row[2] += e['self']
+            row[3] += e['bytes']
+            row[4] = max(row[4], e['peak'])
+
+        # Time of the outermost frames, i.e. the whole recorded run
+        total = sum(e['dur'] for e in self.events if len(e['stack']) == 1)
+
+        width = max([len(label) for label in rows] + [6])
+        lines = [f'{"module":<{width}} {"calls":>8} {"total ms":>10} {"self ms":>10} '
+                 f'{"mean ms":>10} {"%":>6} {"out MB":>10} {"peak MB":>10}']
+        for label, (calls, dur, self_dur, n_bytes, peak) in sorted(
+                rows.items(), key=lambda x: -x[1][1]):
+            lines.append(f'{label:<{width}} {calls:>8} {1000 * dur:>10.2f} '
+                         f'{1000 * self_dur:>10.2f} {1000 * dur / calls:>10.3f} '
+                         f'{100 * dur / max(total, 1e-9):>6.1f} {n_bytes / 2 ** 20:>10.1f} '
+                         f'{peak / 2 ** 20:>10.1f}')
+        return '\n'.join(lines)
+
+    def trace(self):
+        """ Events in the Chrome trace event format """
+        return {'traceEvents': [{
+            'name': e['name'],
+            'cat': e['label'].split('.')[0],
+            'ph': 'X',
+            'ts': 1e6 * (e['start'] - self.start),
+            'dur': 1e6 * e['dur'],
+            'pid': os.getpid(),
+            'tid': e['tid'],
+            'args': {'module': e['label'], 'out_bytes': e['bytes'],
+                     'allocated_bytes': e['allocated'], 'peak_bytes': e['peak']},
+        } for e in self.events]}
+
+    def folded(self):
+        """ Collapsed stacks with self time in us, one line per stack """
+        stacks = defaultdict(float)
+        for e in self.events:
+            stacks[';'.join(e['stack'])] += e['self']
+        return '\n'.join(f'{stack} {int(1e6 * t)}' for stack, t in stacks.items())
+
+    def save(self, out):
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out + '.trace.json', 'w') as f:
+            json.dump(self.trace(), f)
+        with open(out + '.folded', 'w') as f:
+            f.write(self.folded() + '\n')
+        with open(out + '.txt', 'w') as f:
+            f.write(self.summary() + '\n')
+        print(f"Saved profile to {out}.trace.json, {out}.folded and {out}.txt")
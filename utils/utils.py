@@ -9,9 +9,11 @@ import os
 import torch
 
 from argparse import Namespace
+from glob import glob
 from imageio import mimwrite
 from PIL import Image
 from scipy.ndimage.filters import gaussian_filter
+from subprocess import Popen, PIPE
 from torch.utils.tensorboard import SummaryWriter
 from typing import Union, Dict, Any
 
@@ -399,6 +401,38 @@ class HparamWriter(SummaryWriter):
         writer.add_summary(sei)
 
 
+def packed_audio_path(video, audio_type='deepspeech'):
+    """
+    Path of the packed audio features of a video. Written by
+    deepspeech/utils/audio_feature_extractor.py or
+    data_helpers.pack_audio_features.
+    """
+    return os.path.join(video, f'{audio_type}.packed.npy')
+
+
+def load_audio_features(video, audio_type='deepspeech', mmap_mode='r'):
+    """
+    Load the audio features of all frames of a video, row i belongs to frame
+    i + 1. Reads the packed file of the video if it exists and falls back to
+    the per-frame files (00001.deepspeech.npy, ...) otherwise.
+
+    :param video (str): directory of the video
+    :param audio_type (str): e.g. 'deepspeech'
+    :param mmap_mode (str): memory map the packed file, None loads it
+    :returns np.array: float32, shape [n_frames, 16, 29]
+    """
+    path = packed_audio_path(video, audio_type)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode=mmap_mode)
+
+    if video[-1] != '/':
+        video += '/'
+    audio_paths = sorted(glob(video + f'*.{audio_type}.npy'))
+    if len(audio_paths) == 0:
+        raise FileNotFoundError(f"Found no {audio_type} features in {video}")
+    return np.stack([np.load(p) for p in audio_paths]).astype(np.float32)
+
+
 def write_video(path, video, fps):
     """
     Save a sequence of torch tensors of np arrays as video to path
@@ -411,3 +445,111 @@ def write_video(path, video, fps):
         video = np.transpose(video.data.numpy() * 255.,
                              [0, 2, 3, 1]).astype(np.uint8)
     mimwrite(path, video, fps=fps)
+
+
+class VideoWriter:
+    """
+    Streams frames into a single ffmpeg process which encodes the video and
+    muxes the audio in one pass. Frames are written as they come in, so
+    memory does not grow with the length of the video.
+
+    example usage:
+        with VideoWriter('out.avi', fps=25, audiofile='audio.mp3') as writer:
+            for frames in frame_generator:
+                writer.write(frames)
+
+    args:
+        path (str): save path, '-' writes to stdout (or to the file object
+                    passed as stdout)
+        fps (int): target fps of the video
+        audiofile (str): optional, audio track to add to the video
+        audio_codec (str): 'copy' keeps the audio stream as it is
+        format (str): optional, container format. Defaults to fragmented mp4
+                      when writing to stdout and to the file extension
+                      otherwise
+        stdout (file object): optional, output for path '-'. Defaults to the
+                              stdout of this process
+    """
+    def __init__(self, path, fps=25, audiofile=None, audio_codec='copy',
+                 format=None, stdout=None):
+        self.path = path
+        self.fps = fps
+        self.audiofile = audiofile
+        self.audio_codec = audio_codec
+        self.format = format
+        if path == '-' and format is None:
+            self.format = 'mp4'
+        self.stdout = stdout
+        self.proc = None
+        self.finished = False
+        self.n_frames = 0
+
+    def _open(self, h, w):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}',
+               '-r', str(self.fps), '-i', '-']
+        if self.audiofile is not None:
+            cmd += ['-i', self.audiofile, '-map', '0:v', '-map', '1:a',
+                    '-c:a', self.audio_codec, '-shortest']
+        cmd += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+        if self.path == '-' and self.format == 'mp4':
+            # mp4 needs seekable output unless it is fragmented
+            cmd += ['-movflags', 'frag_keyframe+empty_moov']
+        if self.format is not None:
+            cmd += ['-f', self.format]
+        cmd += [self.path]
+
+        self.proc = Popen(cmd, stdin=PIPE, stdout=self.stdout, stderr=PIPE)
+
+    def write(self, frames):
+        """
+        Write frames to the video
+
+        :param frames (torch.tensor or np.array): a frame or batch of frames,
+                                                  either float tensors in
+                                                  [0, 1] of shape [(b,) 3, h, w]
+                                                  (like write_video) or uint8
+                                                  arrays of shape [(b,) h, w, 3]
+        """
+        if torch.is_tensor(frames):
+            if frames.dim() == 3:
+                frames = frames.unsqueeze(0)
+            frames = (frames.detach() * 255.).to(torch.uint8)
+            frames = frames.permute(0, 2, 3, 1).cpu().numpy()
+        elif frames.ndim == 3:
+            frames = frames[None]
+
+        # ffmpeg stops reading once the audio ends (-shortest)
+        if self.finished:
+            return
+
+        if self.proc is None:
+            self._open(frames.shape[1], frames.shape[2])
+
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frames).tobytes())
+        except BrokenPipeError:
+            self.close()
+            return
+        self.n_frames += len(frames)
+
+    def close(self):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        self.finished = True
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = proc.stderr.read()
+        proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError("Writing video %s failed with error\n%d %s" % (
+                self.path, proc.returncode, error.decode()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,104 @@
+"""
+Statistics of the W space of a generator: the mean latent [512] and the
+standard deviation sqrt(E[|w - mean|^2]) the projector scales its latent
+noise with.
+
+Pretrained generators load latent_avg and latent_std with their checkpoint,
+these are used directly. A per dimension latent_std is reduced to the same
+sqrt(E[|w - mean|^2]), but from the samples of the checkpoint, so the noise
+scale of the projector differs slightly from an estimate with 10000 random z
+(seed 123). For other checkpoints the statistics are estimated once from
+random z and stored next to the weights,
+
+    <checkpoint without extension>.wstats.pt
+
+together with the sha1 of the checkpoint, so they are recomputed when the
+weights change. Generators without a checkpoint file are estimated on every
+call.
+
+example usage:
+    latent_mean, latent_std = w_stats(g)
+"""
+
+import os
+import torch
+
+from utils.feature_cache import file_hash
+
+
+def stats_path(checkpoint):
+    return os.path.splitext(checkpoint)[0] + '.wstats.pt'
+
+
+def estimate(g, n_samples=10000, seed=123):
+    device = next(g.parameters()).device
+    # Own generator, the global RNG of the caller is left alone
+    rng = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        noise_sample = torch.randn(n_samples, 512, generator=rng).to(device)
+        latent_out = g.style(noise_sample)
+
+    latent_mean = latent_out.mean(0)
+    latent_std = ((latent_out - latent_mean).pow(2).sum() / n_samples) ** 0.5
+    return latent_mean, latent_std
+
+
+def load(checkpoint, n_samples):
+    """ Stored statistics of checkpoint, None if missing or outdated """
+    path = stats_path(checkpoint)
+    if not os.path.exists(path):
+        return None
+    stats = torch.load(path, map_location='cpu')
+    if stats['n_samples'] != n_samples:
+        return None
+
+    # Hashing the checkpoint takes longer than loading it, size and
+    # modification time tell whether it is worth it
+    stat = os.stat(checkpoint)
+    if (stats['size'], stats['mtime']) != (stat.st_size, int(stat.st_mtime)):
+        if stats['sha1'] != file_hash(checkpoint):
+            return None
+        stats['size'], stats['mtime'] = stat.st_size, int(stat.st_mtime)
+        torch.save(stats, path)
+
+    return stats['latent_mean'], stats['latent_std']
+
+
+def save(checkpoint, n_samples, latent_mean, latent_std):
+    stat = os.stat(checkpoint)
+    torch.save({
+        'sha1': file_hash(checkpoint),
+        'size': stat.st_size,
+        'mtime': int(stat.st_mtime),
+        'n_samples': n_samples,
+        'latent_mean': latent_mean.cpu(),
+        'latent_std': latent_std.cpu(),
+    }, stats_path(checkpoint))
+
+
+def w_stats(g, n_samples=10000):
+    """
+    Mean latent and standard deviation of W of generator g
+
+    :returns (latent_mean, latent_std): shapes [512] and [], on the device of g
+    """
+    device = next(g.parameters()).device
+
+    # Loaded with the pretrained checkpoints
+    if hasattr(g, 'latent_avg') and hasattr(g, 'latent_std'):
+        latent_std = g.latent_std
+        if latent_std.numel() > 1:
+            # Per dimension standard deviation
+            latent_std = latent_std.pow(2).sum().sqrt()
+        return g.latent_avg.view(-1).to(device), latent_std.view([]).to(device)
+
+    checkpoint = getattr(g, 'checkpoint', None)
+    if checkpoint is not None:
+        stats = load(checkpoint, n_samples)
+        if stats is not None:
+            return stats[0].to(device), stats[1].to(device)
+
+    latent_mean, latent_std = estimate(g, n_samples)
+    if checkpoint is not None:
+        save(checkpoint, n_samples, latent_mean, latent_std)
+    return latent_mean, latent_std